@@ -1,12 +1,16 @@
 # backend.py — FastAPI + MySQL + JWT + optional GraphRAG + Voice (TTS/STT) + Hybrid BM25/FAISS
 import os
+import json
 import uuid
 import bcrypt
 import datetime as dt
 from pathlib import Path
 from typing import Optional, List, Dict, Any, Literal
 import base64
+import asyncio
+import threading
 import time  # đo thời gian
+from collections import OrderedDict
 
 from dotenv import load_dotenv, find_dotenv
 
@@ -52,11 +56,15 @@ from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Req
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 from jose import jwt, JWTError
 from pydantic import BaseModel, Field
 
+from .db_pool import ConnectionPool, PoolTimeout
+from .write_behind import WriteBehindQueue
+
 # =========================
 # Paths & Config helpers
 # =========================
@@ -78,19 +86,41 @@ DB_PORT = int(os.getenv("DB_PORT", "3306"))
 DB_USER = os.getenv("DB_USER", "root")
 DB_PASS = os.getenv("DB_PASS", "")
 DB_NAME = os.getenv("DB_NAME", "medchat")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_RECYCLE_S = float(os.getenv("DB_POOL_RECYCLE_S", "1800"))
+DB_POOL_PING_S = float(os.getenv("DB_POOL_PING_S", "30"))
+
+# Ghi chat_messages / updated_at theo lô ở thread nền (write-behind)
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "200"))
+WRITE_BEHIND_INTERVAL_S = float(os.getenv("WRITE_BEHIND_INTERVAL_S", "0.5"))
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "10000"))
 
 JWT_SECRET = os.getenv("JWT_SECRET", "dev_secret_change_me")
 JWT_ALG = "HS256"
 ACCESS_MIN = int(os.getenv("ACCESS_MIN", "30"))
 REFRESH_DAYS = int(os.getenv("REFRESH_DAYS", "30"))
+# "db": mỗi request tra bảng users (mặc định)
+# "stateless": tin uid/usr trong access token đã verify, chỉ kiểm tra user còn tồn tại qua cache TTL
+AUTH_MODE = os.getenv("AUTH_MODE", "db").lower()
+AUTH_CACHE_TTL_S = float(os.getenv("AUTH_CACHE_TTL_S", "60"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
 
 GRAPHRAG_ENABLED = os.getenv("GRAPHRAG_ENABLED", "false").lower() == "true"
 
 # data/graph paths (mặc định data ở ../data; alias_map ở ../)
 DATA_DIR = resolve_path(os.getenv("DATA_DIR"), PROJECT_DIR.parent / "data")
 CHUNKS_PATH = resolve_path(os.getenv("CHUNKS_PATH"), Path(DATA_DIR) / "chunks.jsonl")
+# bản nhị phân (scripts/build_chunks_bin.py), đọc qua mmap nếu khớp với chunks.jsonl
+CHUNKS_BIN_PATH = resolve_path(os.getenv("CHUNKS_BIN_PATH"), Path(DATA_DIR) / "chunks.bin")
 GRAPH_PATH = resolve_path(os.getenv("GRAPH_PATH"), Path(DATA_DIR) / "graph.json")
+GRAPH_BIN_PATH = resolve_path(os.getenv("GRAPH_BIN_PATH"), Path(DATA_DIR) / "graph.bin")
 ALIAS_PATH = resolve_path(os.getenv("ALIAS_PATH"), PROJECT_DIR.parent / "alias_map.json")
+# traversal best-first: số node tối đa được mở, số evidence tối đa được chấm, số bước từ seed
+GRAPH_NODE_BUDGET = int(os.getenv("GRAPH_NODE_BUDGET", "30"))
+GRAPH_MAX_COST = int(os.getenv("GRAPH_MAX_COST", "2000"))
+GRAPH_MAX_HOPS = int(os.getenv("GRAPH_MAX_HOPS", "2"))
 
 print("[GraphRAG] DATA_DIR   =", DATA_DIR)
 print("[GraphRAG] CHUNKS_PATH=", CHUNKS_PATH)
@@ -121,6 +151,13 @@ try:
 except Exception:
     client = None
 
+# client async cho /chat (không giữ thread trong lúc chờ LLM)
+try:
+    from openai import AsyncOpenAI
+    aclient = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+except Exception:
+    aclient = None
+
 
 # =========================
 # DB helpers
@@ -137,13 +174,32 @@ def db_conn():
     )
 
 
+DB_POOL = ConnectionPool(
+    db_conn,
+    max_size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    max_lifetime=DB_POOL_RECYCLE_S,
+    ping_after=DB_POOL_PING_S,
+)
+
+
+def _conn_broken(e: BaseException) -> bool:
+    # lỗi SQL thường (ProgrammingError, IntegrityError...) không làm hỏng kết nối
+    return isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError)) or not isinstance(
+        e, pymysql.err.MySQLError
+    )
+
+
 def db_exec(sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(sql, params)
-            if cur.description:
-                return list(cur.fetchall())
-            return []
+    try:
+        with DB_POOL.connection(is_broken=_conn_broken) as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                if cur.description:
+                    return list(cur.fetchall())
+                return []
+    except PoolTimeout:
+        raise HTTPException(503, "Database is busy, please retry")
 
 
 def db_exec_one(sql: str, params: tuple = ()) -> Optional[Dict[str, Any]]:
@@ -151,6 +207,36 @@ def db_exec_one(sql: str, params: tuple = ()) -> Optional[Dict[str, Any]]:
     return rows[0] if rows else None
 
 
+WRITE_BEHIND = (
+    WriteBehindQueue(
+        lambda: DB_POOL.connection(is_broken=_conn_broken),
+        max_queue=WRITE_BEHIND_MAX_QUEUE,
+        batch_size=WRITE_BEHIND_BATCH,
+        flush_interval=WRITE_BEHIND_INTERVAL_S,
+        is_transient=_conn_broken,
+    )
+    if WRITE_BEHIND_ENABLED
+    else None
+)
+
+
+def db_exec_later(sql: str, params: tuple = ()) -> None:
+    """Ghi không cần kết quả: xếp vào write-behind, queue đầy/tắt thì ghi trực tiếp."""
+    if not (WRITE_BEHIND and WRITE_BEHIND.execute(sql, params)):
+        db_exec(sql, params)
+
+
+def touch_conversation(convo_id: str) -> None:
+    if not (WRITE_BEHIND and WRITE_BEHIND.touch(convo_id)):
+        db_exec("UPDATE conversations SET updated_at=NOW() WHERE id=%s", (convo_id,))
+
+
+def sync_pending_writes() -> None:
+    # đọc lại dữ liệu vừa ghi (list/delete) → chờ write-behind ghi xong trước
+    if WRITE_BEHIND:
+        WRITE_BEHIND.flush(timeout=WRITE_BEHIND_INTERVAL_S * 10)
+
+
 # =========================
 # Auth helpers
 # =========================
@@ -185,6 +271,47 @@ def _issue_tokens(user_id: int, username: str) -> Dict[str, str]:
     }
 
 
+class UserStateCache:
+    """Cache TTL: user_id -> còn tồn tại hay không (cả kết quả âm, để token của user đã xoá không dội DB)."""
+
+    def __init__(self, ttl: float, max_items: int):
+        self.ttl = ttl
+        self.max_items = max(1, max_items)
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uid) -> Optional[bool]:
+        with self._lock:
+            item = self._data.get(uid)
+            if item is None:
+                return None
+            expires, exists = item
+            if expires < time.monotonic():
+                del self._data[uid]
+                return None
+            return exists
+
+    def put(self, uid, exists: bool) -> bool:
+        with self._lock:
+            self._data[uid] = (time.monotonic() + self.ttl, exists)
+            self._data.move_to_end(uid)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+        return exists
+
+    def invalidate(self, uid) -> None:
+        with self._lock:
+            self._data.pop(uid, None)
+
+
+USER_STATE = UserStateCache(AUTH_CACHE_TTL_S, AUTH_CACHE_SIZE)
+
+
+def invalidate_user(uid) -> None:
+    """Gọi sau khi xoá / khoá user để stateless auth không còn chấp nhận token của user đó."""
+    USER_STATE.invalidate(uid)
+
+
 # Dependency: MUST be a callable
 def get_current_user(request: Request):
     auth = request.headers.get("Authorization", "")
@@ -198,6 +325,13 @@ def get_current_user(request: Request):
     if data.get("type") != "access":
         raise HTTPException(401, "Not an access token")
     uid = data.get("uid")
+    if AUTH_MODE == "stateless":
+        exists = USER_STATE.get(uid)
+        if exists is None:
+            exists = USER_STATE.put(uid, bool(db_exec_one("SELECT id FROM users WHERE id=%s", (uid,))))
+        if not exists:
+            raise HTTPException(401, "User not found")
+        return {"user_id": uid, "username": data.get("usr")}
     user = db_exec_one("SELECT id, username FROM users WHERE id=%s", (uid,))
     if not user:
         raise HTTPException(401, "User not found")
@@ -250,26 +384,48 @@ class TTSIn(BaseModel):
     speed: float = Field(1.0, ge=0.25, le=4.0, description="Tốc độ đọc")
 
 
+# =========================
+# Shared chunk store (parse chunks.jsonl 1 lần cho BM25 / FAISS / GraphRAG)
+# =========================
+from .chunk_store import load_chunk_store  # noqa: E402
+
+CHUNK_STORE = None
+try:
+    CHUNK_STORE = load_chunk_store(CHUNKS_PATH, bin_path=CHUNKS_BIN_PATH)
+    print(f"[Chunks] loaded {len(CHUNK_STORE)} chunks ({type(CHUNK_STORE).__name__})")
+except Exception as e:
+    print("[Chunks] init failed:", e)
+    CHUNK_STORE = None
+
 # =========================
 # Optional GraphRAG wiring
 # =========================
 ALIAS = CHUNKS = GRAPH = None
 if GRAPHRAG_ENABLED:
     try:
+        if CHUNK_STORE is None:
+            raise RuntimeError("chunk store is not available")
+
         from .graph_retriever import (
             load_alias_map,
-            load_chunks as graph_load_chunks,
             load_graph,
             entity_link,
             expand_and_collect,
             build_context,
             detect_intent_sections,
+            chunk_tokens,
+            get_linker,
+            graph_stats,
         )
 
 
         ALIAS = load_alias_map(ALIAS_PATH)
-        CHUNKS = graph_load_chunks(CHUNKS_PATH)
-        GRAPH = load_graph(GRAPH_PATH)
+        CHUNKS = CHUNK_STORE
+        GRAPH = load_graph(GRAPH_PATH, bin_path=GRAPH_BIN_PATH)
+        print(f"[GraphRAG] graph loaded ({type(GRAPH).__name__})")
+        # lô evidence theo node + cận trên cho dừng sớm, token set của chunk cho kw_overlap: tính 1 lần lúc khởi động
+        graph_stats(GRAPH).rows_for(chunk_tokens(CHUNKS))
+        get_linker(ALIAS)      # trie/trigram index cho entity_link
         print("GraphRAG enabled. alias_map entries:", len(ALIAS or {}))
     except Exception as e:
         print("GraphRAG init failed:", e)
@@ -304,17 +460,20 @@ SAFETY_RULES = (
 # =========================
 # Lexical / Vector stores (BM25 + FAISS + hybrid utils)
 # =========================
-from .hybrid_retriever import rrf_merge, dedup_by_source_section, filter_by_section  # noqa: E402
+from .hybrid_retriever import rrf_merge, dedup_by_source_section, filter_by_section, merge_adjacent  # noqa: E402
 
 BM25_STORE = None
 FAISS_STORE = None
 
 try:
-    from .bm25_index import BM25Store, load_chunks as bm25_load_chunks  # noqa: E402
-
-    bm25_chunks = bm25_load_chunks(CHUNKS_PATH)
-    BM25_STORE = BM25Store(bm25_chunks)
-    print(f"[BM25] loaded {len(bm25_chunks)} chunks")
+    from .bm25_index import BM25Store  # noqa: E402
+
+    if CHUNK_STORE is None:
+        raise RuntimeError("chunk store is not available")
+    # index build sẵn bởi scripts/build_bm25.py (mmap); thiếu/không khớp thì build trong RAM
+    bm25_index_path = resolve_path(os.getenv("BM25_INDEX_PATH"), Path(DATA_DIR) / "bm25.idx")
+    BM25_STORE = BM25Store(CHUNK_STORE, index_path=bm25_index_path)
+    print(f"[BM25] loaded {len(CHUNK_STORE)} chunks")
 except Exception as e:
     print("[BM25] init failed:", e)
     BM25_STORE = None
@@ -328,12 +487,44 @@ try:
         index_path=faiss_index_path,
         ids_path=faiss_ids_path,
         chunks_path=CHUNKS_PATH,
+        chunks=CHUNK_STORE,
     )
     print("[FAISS] index loaded")
 except Exception as e:
     print("[FAISS] init failed:", e)
     FAISS_STORE = None
 
+# =========================
+# Reranker (sau RRF/dedup, trước khi cắt top_k)
+# =========================
+# "off" (mặc định) | "features" (không cần model) | "onnx" (cross-encoder, cần onnxruntime + tokenizers).
+# Chưa bật mặc định: mức tăng Hit@k mới đo trên chính bộ eval dùng để chọn trọng số.
+RERANKER = os.getenv("RERANKER", "off").lower()
+RERANK_STAGE = None
+try:
+    from .reranker import RerankStage, make_reranker  # noqa: E402
+
+    _reranker = make_reranker(
+        RERANKER,
+        idf=BM25_STORE.index if BM25_STORE else None,
+        model_path=resolve_path(os.getenv("RERANK_MODEL_PATH"), Path(DATA_DIR) / "reranker" / "model.onnx"),
+        tokenizer_path=resolve_path(os.getenv("RERANK_TOKENIZER_PATH"), Path(DATA_DIR) / "reranker" / "tokenizer.json"),
+    )
+    if _reranker is not None:
+        RERANK_STAGE = RerankStage(
+            _reranker,
+            budget_ms=float(os.getenv("RERANK_BUDGET_MS", "150")),
+            max_candidates=int(os.getenv("RERANK_CANDIDATES", "20")),
+            batch_size=int(os.getenv("RERANK_BATCH_SIZE", "16")),
+            prior_weight=float(os.getenv("RERANK_PRIOR_WEIGHT", "0.3")),
+            section_weight=float(os.getenv("RERANK_SECTION_WEIGHT", "0.4")),
+            cache_size=int(os.getenv("RERANK_CACHE_SIZE", "4096")),
+        )
+        print(f"[Rerank] {_reranker.name} enabled")
+except Exception as e:
+    print("[Rerank] init failed:", e)
+    RERANK_STAGE = None
+
 
 # =========================
 # FastAPI app
@@ -396,6 +587,7 @@ def register(body: AuthIn):
         (body.username, hpw),
     )
     u = db_exec_one("SELECT id, username FROM users WHERE username=%s", (body.username,))
+    USER_STATE.put(u["id"], True)
     return _issue_tokens(u["id"], u["username"])
 
 
@@ -432,6 +624,7 @@ def me(user=Depends(get_current_user)):
 # =========================
 @app.get("/conversations", tags=["Conversations"])
 def list_convos(user=Depends(get_current_user)):
+    sync_pending_writes()
     return db_exec(
         "SELECT id, user_id, title, created_at, updated_at "
         "FROM conversations WHERE user_id=%s ORDER BY updated_at DESC, created_at DESC",
@@ -462,6 +655,7 @@ def rename_convo(cid: str, body: ConvoIn, user=Depends(get_current_user)):
 
 @app.delete("/conversations/{cid}", tags=["Conversations"])
 def delete_convo(cid: str, user=Depends(get_current_user)):
+    sync_pending_writes()
     db_exec("DELETE FROM chat_messages WHERE convo_id=%s AND user_id=%s", (cid, user["user_id"]))
     db_exec("DELETE FROM conversations WHERE id=%s AND user_id=%s", (cid, user["user_id"]))
     return {"ok": True}
@@ -469,6 +663,7 @@ def delete_convo(cid: str, user=Depends(get_current_user)):
 
 @app.get("/conversations/{cid}/messages", tags=["Conversations"])
 def list_messages(cid: str, user=Depends(get_current_user)):
+    sync_pending_writes()
     rows = db_exec(
         "SELECT role AS role, CASE WHEN image_path IS NULL THEN 'text' ELSE 'image' END AS mtype, "
         "question AS content, answer, image_path, created_at "
@@ -499,26 +694,51 @@ def list_messages(cid: str, user=Depends(get_current_user)):
 # =========================
 # Chat (TEXT) — hybrid BM25/FAISS + optional GraphRAG, with trace + timing
 # =========================
-@app.post("/chat", response_model=ChatOut, tags=["Chat"])
-def chat(body: ChatIn, user=Depends(get_current_user)):
-    # bắt đầu đo thời gian toàn pipeline
-    t0 = time.perf_counter()
+# Mỗi kênh retrieval có timeout riêng: kênh chậm bị bỏ qua, các kênh còn lại vẫn dùng được
+CHANNEL_TIMEOUT_S = float(os.getenv("CHANNEL_TIMEOUT_S", "4.0"))
+# Ghép các chunk cửa sổ liền kề của cùng tài liệu (build_chunks.py --chunking window) thành 1 passage
+MERGE_ADJACENT_CHUNKS = os.getenv("MERGE_ADJACENT_CHUNKS", "true").lower() == "true"
 
-    user_input = (body.question or "").strip()
-    if not user_input:
-        raise HTTPException(400, "question is required")
 
-    # ensure conversation exists
-    if not db_exec_one(
-        "SELECT id FROM conversations WHERE id=%s AND user_id=%s",
-        (body.convo_id, user["user_id"]),
-    ):
-        db_exec(
-            "INSERT INTO conversations (id, user_id, title, created_at, updated_at) "
-            "VALUES (%s,%s,%s,NOW(),NOW())",
-            (body.convo_id, user["user_id"], user_input[:200]),
-        )
+async def _run_channel(name: str, coro, timeout: float = CHANNEL_TIMEOUT_S) -> Optional[List[Dict[str, Any]]]:
+    """Chạy 1 kênh retrieval; trả None nếu timeout, [] nếu lỗi."""
+    try:
+        hits = await asyncio.wait_for(coro, timeout=timeout)
+    except asyncio.TimeoutError:
+        print(f"[{name.upper()}] timeout after {timeout}s")
+        return None
+    except Exception as e:
+        print(f"[{name.upper()}] search error:", e)
+        return []
+    for h in hits or []:
+        h["channel"] = name
+    return hits or []
+
+
+def _graph_search(user_input: str, intent_nodes: set, top_k: int):
+    seeds = entity_link(user_input, ALIAS, topn=3)
+    if not seeds:
+        return seeds, []
+    hits = expand_and_collect(
+        seeds,
+        GRAPH,
+        CHUNKS,
+        budget=GRAPH_NODE_BUDGET,
+        topk=min(5, top_k),
+        query=user_input,
+        intent_sections=intent_nodes,
+        allowed_sections=None,
+        max_hops=GRAPH_MAX_HOPS,
+        max_cost=GRAPH_MAX_COST,
+    )
+    return seeds, hits
 
+
+async def retrieve_context(user_input: str, top_k: int) -> Dict[str, Any]:
+    """
+    Chạy song song BM25 / FAISS / GraphRAG rồi hợp nhất.
+    Trả về {"hits": context_hits, "context": context_block, "trace": trace_info}.
+    """
     # trace defaults
     trace_info: Dict[str, Any] = {
         "mode": "llm_only",
@@ -541,31 +761,35 @@ def chat(body: ChatIn, user=Depends(get_current_user)):
         if isinstance(node, str) and node.startswith("sec:")
     }
 
-    # ---------- 2. BM25 + FAISS ----------
-    context_block = None
-    context_hits: List[Dict[str, Any]] = []
+    # ---------- 2. BM25 + FAISS + GraphRAG (song song) ----------
+    k = max(top_k, 8)
+    channels: Dict[str, Any] = {}
+    if BM25_STORE:
+        channels["bm25"] = asyncio.to_thread(BM25_STORE.search, user_input, k)
+    if FAISS_STORE:
+        channels["faiss"] = FAISS_STORE.asearch(user_input, k)
 
-    bm25_hits: List[Dict[str, Any]] = []
-    faiss_hits: List[Dict[str, Any]] = []
-    hybrid_hits: List[Dict[str, Any]] = []
+    graph_result: Dict[str, Any] = {}
+    if GRAPHRAG_ENABLED:
+        async def _graph():
+            seeds, hits = await asyncio.to_thread(_graph_search, user_input, intent_nodes, top_k)
+            graph_result["seeds"] = seeds
+            return hits
 
-    if BM25_STORE:
-        try:
-            bm25_hits = BM25_STORE.search(user_input, k=max(body.top_k, 8))
-            for h in bm25_hits:
-                h["channel"] = "bm25"
-        except Exception as e:
-            print("[BM25] search error:", e)
-            bm25_hits = []
+        channels["graph"] = _graph()
 
-    if FAISS_STORE:
-        try:
-            faiss_hits = FAISS_STORE.search(user_input, k=max(body.top_k, 8))
-            for h in faiss_hits:
-                h["channel"] = "faiss"
-        except Exception as e:
-            print("[FAISS] search error:", e)
-            faiss_hits = []
+    names = list(channels)
+    results = await asyncio.gather(*(_run_channel(n, channels[n]) for n in names))
+    by_channel = dict(zip(names, results))
+
+    timeouts = [n for n, r in by_channel.items() if r is None]
+    if timeouts:
+        trace_info["timeouts"] = timeouts
+
+    bm25_hits: List[Dict[str, Any]] = by_channel.get("bm25") or []
+    faiss_hits: List[Dict[str, Any]] = by_channel.get("faiss") or []
+    graph_hits: List[Dict[str, Any]] = by_channel.get("graph") or []
+    seeds = graph_result.get("seeds")
 
     trace_info["bm25_k"] = len(bm25_hits)
     trace_info["faiss_k"] = len(faiss_hits)
@@ -575,7 +799,7 @@ def chat(body: ChatIn, user=Depends(get_current_user)):
     if bm25_hits or faiss_hits:
         if bm25_hits and faiss_hits:
             # RRF fusion
-            hybrid_hits = rrf_merge(bm25_hits, faiss_hits, k=max(body.top_k, 8), k_bias=60)
+            hybrid_hits = rrf_merge(bm25_hits, faiss_hits, k=k, k_bias=60)
             # nếu người dùng hỏi rõ về "triệu chứng", "xét nghiệm", ... thì filter theo section
             if intent_section_names:
                 filtered = filter_by_section(hybrid_hits, intent_section_names)
@@ -601,36 +825,23 @@ def chat(body: ChatIn, user=Depends(get_current_user)):
             trace_info["mode"] = "faiss_only"
 
     # ---------- 3. GraphRAG (optional) ----------
-    graph_hits: List[Dict[str, Any]] = []
-    seeds = None
-    if GRAPHRAG_ENABLED:
-        try:
-            seeds = entity_link(user_input, ALIAS, topn=3)
-            if seeds:
-                graph_hits = expand_and_collect(
-                    seeds,
-                    GRAPH,
-                    CHUNKS,
-                    budget=30,
-                    topk=min(5, body.top_k),
-                    query=user_input,
-                    intent_sections=intent_nodes,
-                    allowed_sections=None,
-                )
-                for h in graph_hits:
-                    h["channel"] = "graph"
-        except Exception as e:
-            print("[GraphRAG] error:", e)
-            graph_hits = []
-
     trace_info["graph_k"] = len(graph_hits)
 
     # ---------- 4. Merge hits + build context ----------
+    context_block = None
+    context_hits: List[Dict[str, Any]] = []
     if base_hits or graph_hits:
         combined = base_hits + graph_hits
+        if MERGE_ADJACENT_CHUNKS and CHUNK_STORE is not None:
+            combined = merge_adjacent(combined, CHUNK_STORE)
         combined = dedup_by_source_section(combined)
+        if RERANK_STAGE is not None:
+            # quá RERANK_BUDGET_MS thì giữ thứ tự RRF
+            combined, trace_info["rerank"] = await RERANK_STAGE.arerank(
+                user_input, combined, intent_section_names
+            )
         # keep at most top_k passages
-        context_hits = combined[: body.top_k]
+        context_hits = combined[:top_k]
         context_block = build_context(context_hits)
         trace_info["used_context"] = True
 
@@ -642,6 +853,7 @@ def chat(body: ChatIn, user=Depends(get_current_user)):
                 "source": h.get("source"),
                 "score": h.get("score"),
                 "rrf": h.get("rrf"),
+                "rerank": h.get("rerank"),
                 "channel": h.get("channel"),
             }
             for h in context_hits
@@ -654,10 +866,11 @@ def chat(body: ChatIn, user=Depends(get_current_user)):
                 trace_info["mode"] = "graph_only"
             elif "graph" not in (trace_info["mode"] or ""):
                 trace_info["mode"] = f"{trace_info['mode']}+graph"
-    else:
-        context_block = None
 
-    # ---------- 5. Build messages ----------
+    return {"hits": context_hits, "context": context_block, "trace": trace_info}
+
+
+def build_messages(user_input: str, context_block: Optional[str], history) -> List[Dict[str, str]]:
     messages = [{"role": "system", "content": SAFETY_RULES}]
     if context_block:
         messages += [
@@ -667,16 +880,75 @@ def chat(body: ChatIn, user=Depends(get_current_user)):
             },
             {"role": "system", "content": context_block},
         ]
-    for pair in (body.history or []):
+    for pair in (history or []):
         if isinstance(pair, (list, tuple)) and len(pair) == 2:
             messages.append({"role": "user", "content": pair[0] or ""})
             messages.append({"role": "assistant", "content": pair[1] or ""})
     messages.append({"role": "user", "content": user_input})
+    return messages
+
+
+def _ensure_conversation(convo_id: str, user_id: int, title: str) -> None:
+    if not db_exec_one(
+        "SELECT id FROM conversations WHERE id=%s AND user_id=%s",
+        (convo_id, user_id),
+    ):
+        db_exec(
+            "INSERT INTO conversations (id, user_id, title, created_at, updated_at) "
+            "VALUES (%s,%s,%s,NOW(),NOW())",
+            (convo_id, user_id, title[:200]),
+        )
+
+
+def _save_chat_message(convo_id: str, user_id: int, question: str, answer: str) -> None:
+    # persist single row (user question + assistant answer)
+    db_exec_later(
+        "INSERT INTO chat_messages (convo_id, user_id, role, message_type, question, answer, created_at) "
+        "VALUES (%s,%s,'user','text',%s,%s,NOW())",
+        (convo_id, user_id, question, answer),
+    )
+    touch_conversation(convo_id)
+
+
+def _log_trace(trace_info: Dict[str, Any]) -> None:
+    # Log trace ra terminal
+    mode = trace_info.get("mode")
+    used = trace_info.get("used_context")
+    cands = trace_info.get("candidates") or []
+    k = len(cands)
+    top_titles = [c.get("title") or c.get("chunk_id") for c in cands[:3]]
+    seeds = trace_info.get("seeds")
+
+    print(
+        f"[TRACE] mode={mode} used={used} k={k} "
+        f"elapsed={trace_info['elapsed_ms']}ms "
+        f"seeds={seeds} top={top_titles}"
+    )
+
+
+@app.post("/chat", response_model=ChatOut, tags=["Chat"])
+async def chat(body: ChatIn, user=Depends(get_current_user)):
+    # bắt đầu đo thời gian toàn pipeline
+    t0 = time.perf_counter()
+
+    user_input = (body.question or "").strip()
+    if not user_input:
+        raise HTTPException(400, "question is required")
+
+    # ensure conversation exists (DB sync → chạy trong threadpool)
+    await run_in_threadpool(_ensure_conversation, body.convo_id, user["user_id"], user_input)
+
+    # ---------- 1–4. Retrieval ----------
+    retrieved = await retrieve_context(user_input, body.top_k)
+    trace_info = retrieved["trace"]
+
+    # ---------- 5. Build messages ----------
+    messages = build_messages(user_input, retrieved["context"], body.history)
 
     # ---------- 6. Call LLM ----------
-    if client:
+    if aclient:
         try:
-            resp = client.chat.completions.create(
+            resp = await aclient.chat.completions.create(
                 model=OPENAI_MODEL,
                 messages=messages,
                 temperature=0.2,
@@ -692,28 +964,10 @@ def chat(body: ChatIn, user=Depends(get_current_user)):
     elapsed_ms = (time.perf_counter() - t0) * 1000.0
     trace_info["elapsed_ms"] = round(elapsed_ms, 1)
 
-    # persist single row (user question + assistant answer)
-    db_exec(
-        "INSERT INTO chat_messages (convo_id, user_id, role, message_type, question, answer, created_at) "
-        "VALUES (%s,%s,'user','text',%s,%s,NOW())",
-        (body.convo_id, user["user_id"], user_input, answer),
-    )
-    db_exec("UPDATE conversations SET updated_at=NOW() WHERE id=%s", (body.convo_id,))
+    await run_in_threadpool(_save_chat_message, body.convo_id, user["user_id"], user_input, answer)
 
-    # Log trace ra terminal
     if body.trace:
-        mode = trace_info.get("mode")
-        used = trace_info.get("used_context")
-        cands = trace_info.get("candidates") or []
-        k = len(cands)
-        top_titles = [c.get("title") or c.get("chunk_id") for c in cands[:3]]
-        seeds = trace_info.get("seeds")
-
-        print(
-            f"[TRACE] mode={mode} used={used} k={k} "
-            f"elapsed={trace_info['elapsed_ms']}ms "
-            f"seeds={seeds} top={top_titles}"
-        )
+        _log_trace(trace_info)
 
     return {
         "answer": answer,
@@ -723,6 +977,99 @@ def chat(body: ChatIn, user=Depends(get_current_user)):
     }
 
 
+# =========================
+# Chat (TEXT, streaming) — Server-Sent Events
+# =========================
+# task ghi DB đang chạy nền (được shield khỏi việc huỷ request)
+_BG_TASKS: "set[asyncio.Task]" = set()
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/chat/stream", tags=["Chat"])
+async def chat_stream(body: ChatIn, user=Depends(get_current_user)):
+    """
+    Giống /chat nhưng trả về text/event-stream:
+      event: trace  → metadata retrieval (mode, candidates, ...), chỉ gửi khi body.trace (như /chat)
+      event: token  → {"delta": "..."} từng phần câu trả lời của LLM
+      event: done   → {"convo_id", "elapsed_ms"}
+    Row chat_messages luôn được ghi khi stream kết thúc — kể cả khi client ngắt giữa chừng
+    (lưu phần câu trả lời đã sinh được), giống /chat không bao giờ mất câu hỏi.
+    """
+    t0 = time.perf_counter()
+
+    user_input = (body.question or "").strip()
+    if not user_input:
+        raise HTTPException(400, "question is required")
+
+    await run_in_threadpool(_ensure_conversation, body.convo_id, user["user_id"], user_input)
+
+    retrieved = await retrieve_context(user_input, body.top_k)
+    trace_info = retrieved["trace"]
+    messages = build_messages(user_input, retrieved["context"], body.history)
+
+    # câu trả lời được gom lại trong lúc stream để lưu DB khi kết thúc
+    parts: List[str] = []
+
+    def _persist():
+        answer = "".join(parts).strip()
+        try:
+            _save_chat_message(body.convo_id, user["user_id"], user_input, answer)
+        except Exception as e:
+            print("[chat/stream] save error:", e)
+        if body.trace and "elapsed_ms" in trace_info:
+            _log_trace(trace_info)
+
+    async def events():
+        try:
+            trace_info["retrieval_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+            if body.trace:
+                yield _sse("trace", trace_info)
+
+            if aclient:
+                try:
+                    stream = await aclient.chat.completions.create(
+                        model=OPENAI_MODEL,
+                        messages=messages,
+                        temperature=0.2,
+                        stream=True,
+                    )
+                    async for ev in stream:
+                        if not ev.choices:
+                            continue
+                        delta = ev.choices[0].delta.content or ""
+                        if delta:
+                            parts.append(delta)
+                            yield _sse("token", {"delta": delta})
+                except Exception as e:
+                    print("OpenAI error:", e)
+                    parts.clear()
+                    parts.append("Xin lỗi, hệ thống đang gặp sự cố. Vui lòng thử lại sau.")
+                    yield _sse("error", {"message": parts[0]})
+            else:
+                parts.append("[demo] No OpenAI configured. This is a placeholder answer.")
+                yield _sse("token", {"delta": parts[0]})
+
+            trace_info["elapsed_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+            yield _sse("done", {"convo_id": body.convo_id, "elapsed_ms": trace_info["elapsed_ms"]})
+        finally:
+            # Client ngắt (ClientDisconnect / huỷ task) thì generator bị đóng ngay tại yield và
+            # BackgroundTask của response không chạy -> ghi ở đây. shield: việc ghi vẫn chạy hết
+            # dù task đang bị huỷ; _BG_TASKS giữ tham chiếu tới khi xong.
+            task = asyncio.ensure_future(run_in_threadpool(_persist))
+            _BG_TASKS.add(task)
+            task.add_done_callback(_BG_TASKS.discard)
+            await asyncio.shield(task)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # =========================
 # Chat (IMAGE) — Vision với gpt-4o-mini
 # =========================
@@ -808,13 +1155,13 @@ def chat_image(
                 "Bạn có thể thử lại sau, hoặc mô tả vấn đề bằng chữ để chatbot hỗ trợ."
             )
 
-    # Lưu vào DB như cũ
-    db_exec(
+    # Lưu vào DB như cũ (qua write-behind)
+    db_exec_later(
         "INSERT INTO chat_messages (convo_id, user_id, role, message_type, question, answer, image_path, created_at) "
         "VALUES (%s,%s,'user','image',%s,%s,%s,NOW())",
         (convo_id, user["user_id"], question, answer, f"/uploads/{fname}"),
     )
-    db_exec("UPDATE conversations SET updated_at=NOW() WHERE id=%s", (convo_id,))
+    touch_conversation(convo_id)
 
     return {
         "answer": answer,
@@ -949,10 +1296,25 @@ def voice_voices():
 # =========================
 @app.get("/healthz")
 def healthz():
-    return {"ok": True}
+    out: Dict[str, Any] = {"ok": True, "db_pool": DB_POOL.stats()}
+    if WRITE_BEHIND:
+        out["write_behind"] = WRITE_BEHIND.stats()
+    if FAISS_STORE:
+        out["emb_cache"] = FAISS_STORE.emb_cache.snapshot()
+    if RERANK_STAGE is not None:
+        out["rerank"] = RERANK_STAGE.snapshot()
+    return out
 
 from fastapi.responses import RedirectResponse
 
+@app.on_event("shutdown")
+def _close_db_pool():
+    # ghi nốt write-behind trước khi đóng pool
+    if WRITE_BEHIND:
+        WRITE_BEHIND.close()
+    DB_POOL.close_all()
+
+
 @app.get("/")
 def root():
     return RedirectResponse(url="/docs")
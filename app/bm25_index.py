@@ -1,7 +1,9 @@
+import json, re, math, mmap, os, struct
+from collections import Counter
+from typing import List, Dict, Any, Union, Tuple, Optional
+import numpy as np
 
-import json, re
-from typing import List, Dict, Any
-from rank_bm25 import BM25Okapi
+from .chunk_store import ChunkStore
 
 def load_chunks(path="data/chunks.jsonl") -> List[Dict[str, Any]]:
     chunks = []
@@ -15,24 +17,233 @@ def load_chunks(path="data/chunks.jsonl") -> List[Dict[str, Any]]:
 def _tok(s: str) -> List[str]:
     return re.findall(r"[a-zA-Z0-9À-ỹ]+", (s or "").lower())
 
+
+class BM25Index:
+    """
+    BM25 (Okapi, cùng công thức/idf floor với rank_bm25.BM25Okapi) trên inverted index:
+      vocab:   term -> term id
+      indptr:  int64[V + 1], postings của term t nằm trong [indptr[t], indptr[t+1])
+      rows:    int32[P], row của document trong ChunkStore
+      impacts: float32[P], idf(t) * tf*(k1+1) / (tf + k1*(1-b+b*dl/avgdl)) tính sẵn
+    Chấm điểm query = cộng impacts trên postings của các term trong query,
+    chỉ đụng tới document có chứa term (không quét toàn corpus).
+    """
+
+    def __init__(self, vocab: Dict[str, int], indptr: np.ndarray, rows: np.ndarray,
+                 impacts: np.ndarray, n_docs: int, params: Optional[Dict[str, float]] = None):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.rows = rows
+        self.impacts = impacts
+        self.n_docs = int(n_docs)
+        self.params = params or {}
+        self.doc_ids: Optional[np.ndarray] = None  # chunk id theo row (có khi load từ file)
+        self.digest: Optional[bytes] = None        # ChunkStore.digest lúc build (có khi load từ file)
+
+    @classmethod
+    def build(cls, corpus: List[List[str]], k1=1.5, b=0.75, epsilon=0.25) -> "BM25Index":
+        n_docs = len(corpus)
+        doc_len = np.array([len(d) for d in corpus], dtype=np.float64)
+        avgdl = float(doc_len.sum()) / max(n_docs, 1)
+
+        # term -> [(row, tf)]
+        post: Dict[str, List[Tuple[int, int]]] = {}
+        for row, doc in enumerate(corpus):
+            for term, tf in Counter(doc).items():
+                post.setdefault(term, []).append((row, tf))
+
+        # idf như BM25Okapi: idf âm được thay bằng epsilon * idf trung bình
+        idf: Dict[str, float] = {}
+        for term, plist in post.items():
+            df = len(plist)
+            idf[term] = math.log(n_docs - df + 0.5) - math.log(df + 0.5)
+        eps = epsilon * (sum(idf.values()) / len(idf)) if idf else 0.0
+        for term, v in idf.items():
+            if v < 0:
+                idf[term] = eps
+
+        vocab: Dict[str, int] = {}
+        indptr = np.zeros(len(post) + 1, dtype=np.int64)
+        rows = np.empty(sum(len(p) for p in post.values()), dtype=np.int32)
+        impacts = np.empty(rows.shape[0], dtype=np.float32)
+        norm = k1 * (1 - b + b * doc_len / avgdl) if n_docs else doc_len
+        pos = 0
+        for tid, term in enumerate(sorted(post)):
+            vocab[term] = tid
+            plist = post[term]
+            r = np.fromiter((p[0] for p in plist), dtype=np.int32, count=len(plist))
+            tf = np.fromiter((p[1] for p in plist), dtype=np.float64, count=len(plist))
+            rows[pos:pos + len(plist)] = r
+            impacts[pos:pos + len(plist)] = idf[term] * (tf * (k1 + 1) / (tf + norm[r]))
+            pos += len(plist)
+            indptr[tid + 1] = pos
+        return cls(vocab, indptr, rows, impacts, n_docs,
+                   params={"k1": k1, "b": b, "epsilon": epsilon, "avgdl": avgdl})
+
+    # ---------- Persisted artifact (scripts/build_bm25.py) ----------
+    # Layout (little-endian, các section căn 8 byte):
+    #   header   : magic(8s) version(u32) n_docs(u32) n_terms(u64) n_postings(u64) k1 b epsilon avgdl (f64)
+    #              corpus_digest(16s)  ChunkStore.digest (file_digest của chunks.jsonl) lúc build
+    #   doc_ids  : int64[n_docs]       chunk id theo row, để kiểm tra khớp với ChunkStore
+    #   indptr   : int64[n_terms + 1]
+    #   rows     : int32[n_postings]
+    #   impacts  : float32[n_postings]
+    #   term_offs: int64[n_terms + 1]  offset trong blob term (term đã sort, term id = vị trí)
+    #   term blob: UTF-8
+    MAGIC = b"BM25IDX\0"
+    VERSION = 2
+    _HEADER = struct.Struct("<8sIIQQdddd16s")
+
+    def save(self, path: str, doc_ids: np.ndarray, digest: Optional[bytes] = None) -> None:
+        terms = sorted(self.vocab, key=self.vocab.__getitem__)
+        blobs = [t.encode("utf-8") for t in terms]
+        term_offs = np.zeros(len(blobs) + 1, dtype="<i8")
+        term_offs[1:] = np.cumsum([len(t) for t in blobs])
+        p = self.params
+        parts = [
+            self._HEADER.pack(self.MAGIC, self.VERSION, self.n_docs, len(terms), int(self.rows.shape[0]),
+                              p.get("k1", 0.0), p.get("b", 0.0), p.get("epsilon", 0.0), p.get("avgdl", 0.0),
+                              bytes(digest or b"")),
+            np.asarray(doc_ids, dtype="<i8").tobytes(),
+            np.asarray(self.indptr, dtype="<i8").tobytes(),
+            np.asarray(self.rows, dtype="<i4").tobytes(),
+            np.asarray(self.impacts, dtype="<f4").tobytes(),
+            term_offs.tobytes(),
+            b"".join(blobs),
+        ]
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            for part in parts:
+                f.write(part + b"\0" * (-len(part) % 8))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """Mở file index qua mmap; các mảng postings là view trên mmap (không copy)."""
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_docs, n_terms, n_post, k1, b, eps, avgdl, digest = cls._HEADER.unpack_from(mm, 0)
+        if magic != cls.MAGIC:
+            raise ValueError(f"{path}: not a BM25 index file")
+        if version != cls.VERSION:
+            raise ValueError(f"{path}: unsupported BM25 index version {version}")
+
+        off = cls._HEADER.size
+
+        def take(dtype: str, count: int) -> np.ndarray:
+            nonlocal off
+            arr = np.frombuffer(mm, dtype=dtype, count=count, offset=off)
+            off += arr.nbytes + (-arr.nbytes % 8)
+            return arr
+
+        doc_ids = take("<i8", n_docs)
+        indptr = take("<i8", n_terms + 1)
+        rows = take("<i4", n_post)
+        impacts = take("<f4", n_post)
+        term_offs = take("<i8", n_terms + 1)
+        raw = mm[off:off + int(term_offs[-1])]
+        offs = term_offs.tolist()
+        vocab = {raw[offs[i]:offs[i + 1]].decode("utf-8"): i for i in range(n_terms)}
+
+        idx = cls(vocab, indptr, rows, impacts, n_docs,
+                  params={"k1": k1, "b": b, "epsilon": eps, "avgdl": avgdl})
+        idx.doc_ids = doc_ids
+        idx.digest = digest if any(digest) else None
+        idx._mm = mm
+        return idx
+
+    def _postings(self, tokens: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        # giữ term lặp lại trong query (BM25Okapi cũng cộng 2 lần)
+        tids = [self.vocab[t] for t in tokens if t in self.vocab]
+        if not tids:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        rows = np.concatenate([self.rows[self.indptr[t]:self.indptr[t + 1]] for t in tids])
+        imps = np.concatenate([self.impacts[self.indptr[t]:self.indptr[t + 1]] for t in tids])
+        return rows, imps
+
+    def score(self, tokens: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Trả về (rows, scores) chỉ cho các document chứa ít nhất 1 term của query."""
+        rows, imps = self._postings(tokens)
+        if not rows.size:
+            return rows, np.empty(0, dtype=np.float64)
+        uniq, inv = np.unique(rows, return_inverse=True)
+        return uniq, np.bincount(inv, weights=imps)
+
+    def score_many(self, queries: List[List[str]]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Chấm điểm nhiều query trong 1 lần gom postings (khoá = query * n_docs + row)."""
+        keys, imps = [], []
+        for qi, tokens in enumerate(queries):
+            rows, w = self._postings(tokens)
+            keys.append(rows.astype(np.int64) + qi * self.n_docs)
+            imps.append(w)
+        if not queries:
+            return []
+        all_keys = np.concatenate(keys)
+        uniq, inv = np.unique(all_keys, return_inverse=True)
+        sums = np.bincount(inv, weights=np.concatenate(imps)) if uniq.size else np.empty(0)
+        bounds = np.searchsorted(uniq, np.arange(len(queries) + 1, dtype=np.int64) * self.n_docs)
+        return [
+            (uniq[bounds[qi]:bounds[qi + 1]] - qi * self.n_docs, sums[bounds[qi]:bounds[qi + 1]])
+            for qi in range(len(queries))
+        ]
+
+
 class BM25Store:
-    def __init__(self, chunks: List[Dict[str, Any]]):
-        self.chunks = chunks
-        corpus = [_tok(c.get("text","")) for c in chunks]
-        self.bm25 = BM25Okapi(corpus)
+    def __init__(self, chunks: Union[ChunkStore, List[Dict[str, Any]]], index_path: Optional[str] = None):
+        # nhận ChunkStore dùng chung; list dict (kiểu cũ) thì bọc lại
+        self.chunks = chunks if isinstance(chunks, ChunkStore) else ChunkStore(chunks)
+        self.index = self._load_index(index_path) if index_path else None
+        if self.index is None:
+            self.index = BM25Index.build([_tok(t) for t in self.chunks.texts()])
+
+    def _load_index(self, path: str) -> Optional[BM25Index]:
+        """
+        Dùng index build sẵn nếu có và được build từ đúng corpus của ChunkStore (cùng digest
+        chunks.jsonl và cùng thứ tự chunk id); không thì None.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            index = BM25Index.load(path)
+        except Exception as e:
+            print(f"[BM25] cannot load {path}:", e)
+            return None
+        if (index.digest is None or index.digest != self.chunks.digest
+                or not np.array_equal(index.doc_ids, self.chunks.ids)):
+            print(f"[BM25] {path} does not match the chunk store, rebuilding in memory")
+            return None
+        return index
+
+    def _hits(self, rows: np.ndarray, scores: np.ndarray, k: int) -> List[Dict[str, Any]]:
+        return [self.chunks.hit(int(rows[i]), scores[i]) for i in topk_rows(scores, k)]
 
     def search(self, query: str, k=8) -> List[Dict[str, Any]]:
-        scores = self.bm25.get_scores(_tok(query))
-        ids = sorted(range(len(scores)), key=lambda i: -scores[i])[:k]
-        out = []
-        for rank, i in enumerate(ids, 1):
-            ch = self.chunks[i]
-            out.append({
-                "id": int(ch["id"]),
-                "score": float(scores[i]),
-                "title": ch.get("title",""),
-                "section": ch.get("section",""),
-                "source": ch.get("source",""),
-                "text": (ch.get("text","") or "").strip()
-            })
-        return out
+        """Top-k theo BM25; chỉ trả về chunk có chứa ít nhất 1 term của query."""
+        rows, scores = self.index.score(_tok(query))
+        return self._hits(rows, scores, k)
+
+    def search_many(self, queries: List[str], k=8) -> List[List[Dict[str, Any]]]:
+        """Chấm điểm nhiều query trong 1 lần, rồi chọn top-k cho từng query."""
+        scored = self.index.score_many([_tok(q) for q in queries])
+        return [self._hits(rows, scores, k) for rows, scores in scored]
+
+
+def topk_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Chỉ số top-k theo điểm giảm dần, chọn bằng np.partition O(N) rồi chỉ sort k phần tử.
+    Hoà điểm thì index nhỏ đứng trước (giống sorted(..., key=-score) ổn định),
+    kể cả các phần tử hoà đúng ở ranh giới thứ k.
+    """
+    n = scores.shape[0]
+    k = min(int(k), n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        kth = np.partition(scores, n - k)[n - k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[: k - above.size]
+        part = np.concatenate([above, ties])
+    else:
+        part = np.arange(n)
+    order = np.lexsort((part, -scores[part]))
+    return part[order]
@@ -0,0 +1,292 @@
+# chunk_store.py
+# -*- coding: utf-8 -*-
+"""
+Kho chunk dùng chung cho BM25 / FAISS / GraphRAG.
+
+chunks.jsonl chỉ được parse MỘT lần mỗi worker; các retriever đọc qua
+cùng một ChunkStore (bất biến) thay vì mỗi bên giữ một bản copy riêng.
+
+Ngoài ra có định dạng nhị phân chunks.bin (scripts/build_chunks_bin.py)
+được đọc qua mmap: các worker trên cùng máy dùng chung page cache, text
+chỉ được decode khi cần (top-k hits).
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# Các cột metadata lặp lại nhiều giữa các chunk (cùng title/source/section/parent)
+_META_FIELDS = ("title", "source", "section", "date_accessed", "hash", "parent")
+# Vị trí chunk trong tài liệu gốc (chunker cửa sổ token): seq, start, end; -1 nếu không có
+_SPAN_FIELDS = ("seq", "start", "end")
+DIGEST_SIZE = 16
+
+
+def file_digest(path: str, piece: int = 1 << 20) -> bytes:
+    """blake2b (16 byte) nội dung file — so khớp file build sẵn (.bin/.idx) với nguồn hiện tại."""
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(piece)
+            if not b:
+                return h.digest()
+            h.update(b)
+
+
+class ChunkStore:
+    """
+    Lưu chunk theo dạng cột (column-oriented):
+      - ids:     np.int64 array, ids[row] = chunk id
+      - _offset: dict chunk id -> row
+      - metadata: list các chuỗi đã intern (title/source/... dùng chung 1 object)
+      - texts:   list text theo row
+      - spans:   np.int64[n, 3] = (seq, start, end) trong tài liệu "parent", -1 nếu không có
+      - digest:  file_digest của chunks.jsonl mà store được đọc / build từ đó (None nếu dựng từ records)
+    """
+
+    digest: Optional[bytes] = None
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        n = len(records)
+        self.ids = np.empty(n, dtype=np.int64)
+        self._cols: Dict[str, List[str]] = {f: [] for f in _META_FIELDS}
+        self._texts: List[str] = []
+        self.spans = np.full((n, len(_SPAN_FIELDS)), -1, dtype=np.int64)
+        for row, obj in enumerate(records):
+            self.ids[row] = int(obj["id"])
+            for f in _META_FIELDS:
+                self._cols[f].append(sys.intern(str(obj.get(f, "") or "")))
+            self._texts.append(obj.get("text", "") or "")
+            for j, f in enumerate(_SPAN_FIELDS):
+                if obj.get(f) is not None:
+                    self.spans[row, j] = int(obj[f])
+        self.ids.setflags(write=False)
+        self.spans.setflags(write=False)
+        self._offset: Dict[int, int] = {int(cid): row for row, cid in enumerate(self.ids)}
+
+    # ---------- Loaders ----------
+    @classmethod
+    def from_jsonl(cls, path: str) -> "ChunkStore":
+        records = []
+        h = hashlib.blake2b(digest_size=DIGEST_SIZE)    # = file_digest(path), tính trong lúc đọc
+        with Path(path).open("rb") as f:
+            for ln in f:
+                h.update(ln)
+                ln = ln.strip()
+                if ln:
+                    records.append(json.loads(ln))
+        store = cls(records)
+        store.digest = h.digest()
+        return store
+
+    # ---------- Lookup ----------
+    def __len__(self) -> int:
+        return int(self.ids.shape[0])
+
+    def __contains__(self, cid) -> bool:
+        return int(cid) in self._offset
+
+    def row_of(self, cid: int) -> Optional[int]:
+        return self._offset.get(int(cid))
+
+    def text(self, row: int) -> str:
+        return self._texts[row]
+
+    def texts(self) -> Iterator[str]:
+        """Duyệt text theo thứ tự row (dùng khi build index)."""
+        for row in range(len(self)):
+            yield self.text(row)
+
+    def field(self, row: int, name: str) -> str:
+        return self._cols[name][row]
+
+    def span(self, row: int) -> Optional[tuple]:
+        """(seq, start, end) của chunk trong tài liệu parent, hoặc None (chunk theo đoạn kiểu cũ)."""
+        seq, start, end = (int(v) for v in self.spans[row])
+        return None if seq < 0 else (seq, start, end)
+
+    def row(self, row: int) -> Dict[str, Any]:
+        """Dựng dict chunk (giống 1 dòng chunks.jsonl) cho row."""
+        out: Dict[str, Any] = {"id": int(self.ids[row])}
+        for f in _META_FIELDS:
+            out[f] = self.field(row, f)
+        span = self.span(row)
+        if span is not None:
+            out.update(zip(_SPAN_FIELDS, span))
+        out["text"] = self.text(row)
+        return out
+
+    def get(self, cid, default=None):
+        """Tương thích với dict {id: chunk} cũ: chunks.get(cid)."""
+        row = self.row_of(cid)
+        return default if row is None else self.row(row)
+
+    def __getitem__(self, cid) -> Dict[str, Any]:
+        row = self.row_of(cid)
+        if row is None:
+            raise KeyError(cid)
+        return self.row(row)
+
+    def hit(self, row: int, score: float) -> Dict[str, Any]:
+        """Định dạng hit chung cho các retriever: id, score, title, section, source, text."""
+        return {
+            "id": int(self.ids[row]),
+            "score": float(score),
+            "title": self.field(row, "title"),
+            "section": self.field(row, "section"),
+            "source": self.field(row, "source"),
+            "text": self.text(row).strip(),
+        }
+
+
+# =============================
+# Packed binary corpus (chunks.bin)
+# =============================
+# Layout (little-endian, các section căn 8 byte):
+#   header     : magic(8s) version(u32) n(u32) n_strings(u32) pad(u32) src_size(u64) src_digest(16s)
+#   ids        : int64[n]
+#   meta       : int32[n, len(_META_FIELDS)]   -> index vào string table
+#   spans      : int64[n, len(_SPAN_FIELDS)]   -> seq/start/end (-1 nếu không có)
+#   text_offs  : int64[n + 1]                   -> offset trong text blob
+#   str_offs   : int64[n_strings + 1]           -> offset trong string blob
+#   str blob   : UTF-8
+#   text blob  : UTF-8
+BIN_MAGIC = b"CHUNKBIN"
+BIN_VERSION = 3
+_HEADER = struct.Struct("<8sIIIIQ16s")
+
+
+def _pad8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def write_chunk_bin(records: List[Dict[str, Any]], path: str, src_size: int = 0, src_digest: bytes = b"") -> None:
+    """Ghi records (dict giống chunks.jsonl) thành chunks.bin; src_size / src_digest: kích thước / file_digest của chunks.jsonl nguồn."""
+    n = len(records)
+    ids = np.array([int(r["id"]) for r in records], dtype="<i8")
+
+    strings: List[bytes] = []
+    str_index: Dict[str, int] = {}
+    meta = np.empty((n, len(_META_FIELDS)), dtype="<i4")
+    for row, r in enumerate(records):
+        for j, f in enumerate(_META_FIELDS):
+            v = str(r.get(f, "") or "")
+            if v not in str_index:
+                str_index[v] = len(strings)
+                strings.append(v.encode("utf-8"))
+            meta[row, j] = str_index[v]
+
+    spans = np.array(
+        [[-1 if r.get(f) is None else int(r[f]) for f in _SPAN_FIELDS] for r in records],
+        dtype="<i8",
+    ).reshape(n, len(_SPAN_FIELDS))
+
+    texts = [(r.get("text", "") or "").encode("utf-8") for r in records]
+    text_offs = np.zeros(n + 1, dtype="<i8")
+    text_offs[1:] = np.cumsum([len(t) for t in texts])
+    str_offs = np.zeros(len(strings) + 1, dtype="<i8")
+    str_offs[1:] = np.cumsum([len(b) for b in strings])
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(BIN_MAGIC, BIN_VERSION, n, len(strings), 0, int(src_size), bytes(src_digest)))
+        for part in (ids.tobytes(), meta.tobytes(), spans.tobytes(), text_offs.tobytes(),
+                     str_offs.tobytes(), b"".join(strings)):
+            f.write(part + b"\0" * (_pad8(len(part)) - len(part)))
+        f.write(b"".join(texts))
+    os.replace(tmp, path)
+
+
+def read_bin_source(path: str) -> Optional[Tuple[int, bytes]]:
+    """(src_size, src_digest) trong header: chunks.jsonl lúc build, để phát hiện file cũ."""
+    with open(path, "rb") as f:
+        head = f.read(_HEADER.size)
+    if len(head) < _HEADER.size:
+        return None
+    magic, version, _, _, _, src_size, src_digest = _HEADER.unpack(head)
+    if magic != BIN_MAGIC or version != BIN_VERSION:
+        return None
+    return int(src_size), src_digest
+
+
+class MmapChunkStore(ChunkStore):
+    """
+    ChunkStore đọc từ chunks.bin qua mmap (zero-copy cho các cột numpy).
+    Text / metadata chỉ được decode khi truy cập.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, n_strings, _, src_size, src_digest = _HEADER.unpack_from(self._mm, 0)
+        if magic != BIN_MAGIC:
+            raise ValueError(f"{path}: not a chunk corpus file")
+        if version != BIN_VERSION:
+            raise ValueError(f"{path}: unsupported version {version}")
+        self.src_size = int(src_size)
+        self.digest = src_digest if any(src_digest) else None
+
+        off = _HEADER.size
+        self.ids = np.frombuffer(self._mm, dtype="<i8", count=n, offset=off)
+        off += 8 * n
+        self._meta = np.frombuffer(
+            self._mm, dtype="<i4", count=n * len(_META_FIELDS), offset=off
+        ).reshape(n, len(_META_FIELDS))
+        off += _pad8(4 * n * len(_META_FIELDS))
+        self.spans = np.frombuffer(
+            self._mm, dtype="<i8", count=n * len(_SPAN_FIELDS), offset=off
+        ).reshape(n, len(_SPAN_FIELDS))
+        off += 8 * n * len(_SPAN_FIELDS)
+        self._text_offs = np.frombuffer(self._mm, dtype="<i8", count=n + 1, offset=off)
+        off += 8 * (n + 1)
+        self._str_offs = np.frombuffer(self._mm, dtype="<i8", count=n_strings + 1, offset=off)
+        off += 8 * (n_strings + 1)
+        self._str_base = off
+        self._text_base = off + _pad8(int(self._str_offs[-1]))
+
+        self._view = memoryview(self._mm)
+        self._field_idx = {f: j for j, f in enumerate(_META_FIELDS)}
+        self._strings: Dict[int, str] = {}
+        self._offset = {int(cid): row for row, cid in enumerate(self.ids)}
+
+    def text(self, row: int) -> str:
+        a = self._text_base + int(self._text_offs[row])
+        b = self._text_base + int(self._text_offs[row + 1])
+        return str(self._view[a:b], "utf-8")
+
+    def field(self, row: int, name: str) -> str:
+        si = int(self._meta[row, self._field_idx[name]])
+        s = self._strings.get(si)
+        if s is None:
+            a = self._str_base + int(self._str_offs[si])
+            b = self._str_base + int(self._str_offs[si + 1])
+            s = sys.intern(str(self._view[a:b], "utf-8"))
+            self._strings[si] = s
+        return s
+
+
+def load_chunk_store(path: str = "data/chunks.jsonl", bin_path: Optional[str] = None) -> ChunkStore:
+    """
+    Ưu tiên chunks.bin (mmap) nếu có và được build từ đúng chunks.jsonl hiện tại
+    (so khớp kích thước rồi digest nội dung file); ngược lại parse chunks.jsonl.
+    """
+    if path.endswith(".bin"):
+        return MmapChunkStore(path)
+    if bin_path and os.path.exists(bin_path):
+        src = read_bin_source(bin_path)
+        if src is not None and (
+            not os.path.exists(path)
+            or (src[0] == os.path.getsize(path) and src[1] == file_digest(path))
+        ):
+            return MmapChunkStore(bin_path)
+        print(f"[Chunks] {bin_path} is stale or invalid, falling back to {path}")
+    return ChunkStore.from_jsonl(path)
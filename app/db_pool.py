@@ -0,0 +1,141 @@
+# db_pool.py
+# -*- coding: utf-8 -*-
+"""
+Pool kết nối MySQL (thread-safe, có giới hạn) cho db_exec / db_exec_one.
+
+- Tối đa max_size kết nối mở cùng lúc; khi hết thì chờ tối đa `timeout` giây
+  rồi báo PoolTimeout (tránh vượt max_connections của MySQL lúc burst).
+- Kết nối idle quá ping_after giây được ping trước khi dùng lại.
+- Kết nối sống quá max_lifetime giây bị đóng và mở lại (recycle).
+"""
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        max_size: int = 10,
+        timeout: float = 5.0,
+        max_lifetime: float = 1800.0,
+        ping_after: float = 30.0,
+    ):
+        self._connect = connect
+        self.max_size = max(1, int(max_size))
+        self.timeout = float(timeout)
+        self.max_lifetime = float(max_lifetime)
+        self.ping_after = float(ping_after)
+
+        # (conn, created_at, last_used) — LIFO để kết nối "nóng" được dùng lại trước
+        self._idle: "queue.LifoQueue[Tuple[Any, float, float]]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._lock = threading.Lock()
+        self.metrics: Dict[str, int] = {
+            "created": 0,
+            "reused": 0,
+            "recycled": 0,
+            "broken": 0,
+            "timeouts": 0,
+            "in_use": 0,
+        }
+
+    def _inc(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self.metrics[key] += n
+
+    @staticmethod
+    def _close(conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _take_idle(self):
+        """Lấy 1 kết nối idle còn dùng được, hoặc None."""
+        while True:
+            try:
+                conn, created, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+            now = time.monotonic()
+            if now - created > self.max_lifetime:
+                self._close(conn)
+                self._inc("recycled")
+                continue
+            if now - last_used > self.ping_after:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._close(conn)
+                    self._inc("broken")
+                    continue
+            return conn, created
+
+    def acquire(self) -> Tuple[Any, float]:
+        if not self._slots.acquire(timeout=self.timeout):
+            self._inc("timeouts")
+            raise PoolTimeout(f"no DB connection available after {self.timeout}s")
+        try:
+            got = self._take_idle()
+            if got is None:
+                got = (self._connect(), time.monotonic())
+                self._inc("created")
+            else:
+                self._inc("reused")
+        except Exception:
+            self._slots.release()
+            raise
+        self._inc("in_use")
+        return got
+
+    def release(self, conn, created: float, broken: bool = False) -> None:
+        try:
+            if broken:
+                self._close(conn)
+                self._inc("broken")
+            elif time.monotonic() - created > self.max_lifetime:
+                self._close(conn)
+                self._inc("recycled")
+            else:
+                self._idle.put((conn, created, time.monotonic()))
+        finally:
+            self._inc("in_use", -1)
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, is_broken: Callable[[BaseException], bool] = lambda e: True) -> Iterator[Any]:
+        """
+        with pool.connection() as conn: ...
+        Nếu có exception và is_broken(e) là True thì kết nối bị đóng thay vì trả về pool.
+        """
+        conn, created = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except BaseException as e:
+            broken = is_broken(e)
+            raise
+        finally:
+            self.release(conn, created, broken=broken)
+
+    def close_all(self) -> None:
+        while True:
+            try:
+                conn, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(conn)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.metrics, idle=self._idle.qsize(), max_size=self.max_size)
@@ -0,0 +1,120 @@
+# embed_cache.py
+# -*- coding: utf-8 -*-
+"""
+Cache embedding cho query (dùng bởi FaissStore._embed).
+
+- Key = sha1(model + query đã chuẩn hoá), nên "Triệu chứng  bệnh lậu là gì?"
+  và "triệu chứng bệnh lậu là gì?" dùng chung 1 vector.
+- Tầng 1: LRU trong RAM (giới hạn số entry).
+- Tầng 2 (tuỳ chọn): SQLite trên đĩa, sống qua restart và dùng chung giữa
+  các worker uvicorn trên cùng máy.
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    t = unicodedata.normalize("NFC", text or "")
+    return re.sub(r"\s+", " ", t).strip().lower()
+
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha1(f"{model}\n{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, max_items: int = 2048, db_path: Optional[str] = None):
+        self.max_items = max(0, int(max_items))
+        self.db_path = db_path or None
+        self._lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats: Dict[str, int] = {"hits": 0, "disk_hits": 0, "misses": 0}
+        if self.db_path:
+            with self._db() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS emb_cache ("
+                    " key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vec BLOB NOT NULL)"
+                )
+
+    # mỗi thread giữ 1 connection riêng (sqlite3 không chia sẻ connection giữa thread)
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key: str, vec: np.ndarray) -> None:
+        if not self.max_items:
+            return
+        with self._lock:
+            self._lru[key] = vec
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_items:
+                self._lru.popitem(last=False)
+
+    def peek(self, model: str, text: str) -> Optional[np.ndarray]:
+        """Chỉ tra LRU trong RAM (không I/O, gọi được trên event loop); None thì dùng get()."""
+        key = cache_key(model, text)
+        with self._lock:
+            vec = self._lru.get(key)
+            if vec is not None:
+                self._lru.move_to_end(key)
+                self.stats["hits"] += 1
+            return vec
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        vec = self.peek(model, text)
+        if vec is not None:
+            return vec
+
+        key = cache_key(model, text)
+        if self.db_path:
+            try:
+                row = self._db().execute(
+                    "SELECT dim, vec FROM emb_cache WHERE key=?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                print("[EmbCache] read error:", e)
+                row = None
+            if row:
+                vec = np.frombuffer(row[1], dtype="float32").reshape(1, int(row[0]))
+                self._remember(key, vec)
+                with self._lock:
+                    self.stats["disk_hits"] += 1
+                return vec
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, model: str, text: str, vec: np.ndarray) -> None:
+        key = cache_key(model, text)
+        vec = np.ascontiguousarray(vec, dtype="float32").reshape(1, -1)
+        vec.setflags(write=False)
+        self._remember(key, vec)
+        if self.db_path:
+            try:
+                with self._db() as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO emb_cache (key, dim, vec) VALUES (?,?,?)",
+                        (key, int(vec.shape[1]), vec.tobytes()),
+                    )
+            except sqlite3.Error as e:
+                print("[EmbCache] write error:", e)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, size=len(self._lru))
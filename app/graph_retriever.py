@@ -1,31 +1,184 @@
 # graph_retriever.py
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import json, re
-from typing import Dict, Any, List, Tuple
-from collections import deque, defaultdict
-from rapidfuzz import fuzz
+import json, re, os, mmap, struct, heapq, weakref, unicodedata
+from typing import Dict, Any, List, Tuple, Iterator, Optional, Union
+from collections import OrderedDict, defaultdict
+import numpy as np
+from rapidfuzz import fuzz, process
+
+from .chunk_store import ChunkStore, file_digest
 
 # ---------- Loaders ----------
 def load_alias_map(path: str) -> Dict[str, Dict[str, Any]]:
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def load_chunks(path: str) -> Dict[int, Dict[str, Any]]:
-    chunks = {}
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            obj = json.loads(line)
-            chunks[int(obj["id"])] = obj
-    return chunks
+def load_chunks(path: str) -> ChunkStore:
+    return ChunkStore.from_jsonl(path)
 
-def load_graph(path: str) -> Dict[str, Any]:
+def load_graph(path: str, bin_path: Optional[str] = None) -> Union[Dict[str, Any], "GraphCSR"]:
+    """
+    Ưu tiên graph.bin (CSR, mmap, không parse JSON) nếu có và được build cùng lúc
+    với graph.json hiện tại (so khớp kích thước rồi digest nội dung file như chunks.bin);
+    ngược lại đọc graph.json.
+    """
+    if path.endswith(".bin"):
+        return GraphCSR(path)
+    if bin_path and os.path.exists(bin_path):
+        src = read_graph_bin_source(bin_path)
+        if src is not None and (
+            not os.path.exists(path)
+            or (src[0] == os.path.getsize(path) and src[1] == file_digest(path))
+        ):
+            return GraphCSR(bin_path)
+        print(f"[Graph] {bin_path} is stale or invalid, falling back to {path}")
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
+# ---------- Packed graph (graph.bin) ----------
+# Cạnh đã gộp theo (src, dst, rel), lưu dạng CSR (little-endian, các section căn 8 byte):
+#   header    : magic(8s) version(u32) n_nodes(u32) n_edges(u32) n_evidence(u32) n_strings(u32) pad(u32) src_size(u64) src_digest(16s)
+#   nodes     : int32[n_nodes, 3]      -> (id, type, name) index vào string table
+#   edge_ptr  : int32[n_nodes + 1]     -> cạnh của node i nằm trong [edge_ptr[i], edge_ptr[i+1])
+#   edge_dst  : int32[n_edges]         -> node index
+#   edge_rel  : int32[n_edges]         -> string index
+#   edge_w    : float32[n_edges]       -> trọng số trên mỗi evidence
+#   ev_ptr    : int32[n_edges + 1]     -> evidence của cạnh e nằm trong [ev_ptr[e], ev_ptr[e+1])
+#   evidence  : int32[n_evidence]      -> chunk id
+#   str_offs  : int64[n_strings + 1], str blob UTF-8
+GRAPH_MAGIC = b"GRAPHBIN"
+GRAPH_VERSION = 2
+_GRAPH_HEADER = struct.Struct("<8sIIIIIIQ16s")
+
+def write_graph_bin(graph: Dict[str, Any], path: str, src_size: int = 0, src_digest: bytes = b"") -> None:
+    """Ghi graph dạng dict {"nodes", "adj"} (cạnh đã gộp) thành graph.bin; src_size / src_digest của graph.json."""
+    strings: List[bytes] = []
+    str_index: Dict[str, int] = {}
+
+    def sid(v: str) -> int:
+        v = str(v or "")
+        if v not in str_index:
+            str_index[v] = len(strings)
+            strings.append(v.encode("utf-8"))
+        return str_index[v]
+
+    nodes = dict(graph.get("nodes", {}))
+    adj = graph.get("adj", {})
+    for src, edges in adj.items():
+        nodes.setdefault(src, {})
+        for e in edges:
+            nodes.setdefault(e["dst"], {})
+    node_ids = list(nodes)
+    node_idx = {nid: i for i, nid in enumerate(node_ids)}
+    node_tab = np.array([[sid(n), sid(nodes[n].get("type", "")), sid(nodes[n].get("name", ""))]
+                         for n in node_ids], dtype="<i4").reshape(len(node_ids), 3)
+
+    edge_ptr = np.zeros(len(node_ids) + 1, dtype="<i4")
+    dst, rel, w, ev_ptr, evidence = [], [], [], [0], []
+    for i, n in enumerate(node_ids):
+        for e in adj.get(n, []):
+            dst.append(node_idx[e["dst"]])
+            rel.append(sid(e.get("rel", "")))
+            w.append(float(e.get("weight", 1.0)))
+            evidence.extend(int(c) for c in e.get("evidence", []))
+            ev_ptr.append(len(evidence))
+        edge_ptr[i + 1] = len(dst)
+
+    str_offs = np.zeros(len(strings) + 1, dtype="<i8")
+    str_offs[1:] = np.cumsum([len(b) for b in strings])
+    parts = [
+        node_tab.tobytes(),
+        edge_ptr.tobytes(),
+        np.array(dst, dtype="<i4").tobytes(),
+        np.array(rel, dtype="<i4").tobytes(),
+        np.array(w, dtype="<f4").tobytes(),
+        np.array(ev_ptr, dtype="<i4").tobytes(),
+        np.array(evidence, dtype="<i4").tobytes(),
+        str_offs.tobytes(),
+        b"".join(strings),
+    ]
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_GRAPH_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, len(node_ids), len(dst), len(evidence),
+                                   len(strings), 0, int(src_size), bytes(src_digest)))
+        for part in parts:
+            f.write(part + b"\0" * (-len(part) % 8))
+    os.replace(tmp, path)
+
+def read_graph_bin_source(path: str) -> Optional[Tuple[int, bytes]]:
+    """(src_size, src_digest) của graph.json lúc build graph.bin, để phát hiện file cũ."""
+    with open(path, "rb") as f:
+        head = f.read(_GRAPH_HEADER.size)
+    if len(head) < _GRAPH_HEADER.size:
+        return None
+    magic, version, *_, src_size, src_digest = _GRAPH_HEADER.unpack(head)
+    if magic != GRAPH_MAGIC or version != GRAPH_VERSION:
+        return None
+    return int(src_size), src_digest
+
+class GraphCSR:
+    """
+    Graph đọc từ graph.bin qua mmap: mảng CSR là view numpy (không copy),
+    chỉ bảng node / rel (nhỏ) được decode lúc load.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_nodes, n_edges, n_ev, n_strings, _, _, _ = _GRAPH_HEADER.unpack_from(self._mm, 0)
+        if magic != GRAPH_MAGIC:
+            raise ValueError(f"{path}: not a graph file")
+        if version != GRAPH_VERSION:
+            raise ValueError(f"{path}: unsupported graph version {version}")
+
+        off = _GRAPH_HEADER.size
+
+        def take(dtype: str, count: int) -> np.ndarray:
+            nonlocal off
+            arr = np.frombuffer(self._mm, dtype=dtype, count=count, offset=off)
+            off += arr.nbytes + (-arr.nbytes % 8)
+            return arr
+
+        node_tab = take("<i4", n_nodes * 3).reshape(n_nodes, 3)
+        self.edge_ptr = take("<i4", n_nodes + 1)
+        self.edge_dst = take("<i4", n_edges)
+        self.edge_rel = take("<i4", n_edges)
+        self.edge_w = take("<f4", n_edges)
+        self.ev_ptr = take("<i4", n_edges + 1)
+        self.evidence = take("<i4", n_ev)
+        str_offs = take("<i8", n_strings + 1).tolist()
+        blob = self._mm[off:off + str_offs[-1]]
+        strings = [blob[str_offs[i]:str_offs[i + 1]].decode("utf-8") for i in range(n_strings)]
+
+        self.node_ids = [strings[i] for i in node_tab[:, 0].tolist()]
+        self.nodes = {
+            strings[a]: {"type": strings[b], "name": strings[c]} for a, b, c in node_tab.tolist()
+        }
+        self._index = {nid: i for i, nid in enumerate(self.node_ids)}
+        self._rels = strings
+
+    def __contains__(self, nid) -> bool:
+        return nid in self._index
+
+    def edges(self, nid: str) -> Iterator[Tuple[str, str, float, np.ndarray]]:
+        """(dst, rel, weight, evidence chunk ids) của các cạnh ra từ nid."""
+        i = self._index.get(nid)
+        if i is None:
+            return
+        for e in range(int(self.edge_ptr[i]), int(self.edge_ptr[i + 1])):
+            yield (self.node_ids[self.edge_dst[e]], self._rels[self.edge_rel[e]], float(self.edge_w[e]),
+                   self.evidence[self.ev_ptr[e]:self.ev_ptr[e + 1]])
+
+def iter_edges(graph, nid: str) -> Iterator[Tuple[str, str, float, Any]]:
+    """Duyệt cạnh (dst, rel, weight, evidence) cho cả GraphCSR lẫn graph.json dạng dict."""
+    if isinstance(graph, GraphCSR):
+        yield from graph.edges(nid)
+        return
+    for edge in graph.get("adj", {}).get(nid, []):
+        yield edge.get("dst"), edge.get("rel", ""), float(edge.get("weight", 1.0)), edge.get("evidence", [])
+
 # ---------- Intent mapping (VI/EN) ----------
 INTENT_SECTIONS = {
     # vi -> section
@@ -53,77 +206,539 @@ def detect_intent_sections(query: str):
 def _norm(s: str) -> str:
     return re.sub(r"\s+", " ", (s or "").lower()).strip()
 
+_WORD_RE = re.compile(r"[^\W_]+")
+
+def fold_diacritics(s: str) -> str:
+    """Bỏ dấu tiếng Việt: "bệnh lậu" -> "benh lau" (đ -> d)."""
+    t = unicodedata.normalize("NFD", s).replace("đ", "d").replace("Đ", "D")
+    return unicodedata.normalize("NFC", "".join(ch for ch in t if not unicodedata.combining(ch)))
+
+def _trigrams(s: str) -> set:
+    s = f" {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+class EntityLinker:
+    """
+    Link thực thể query -> node của alias_map, độ trễ gần như không đổi khi alias_map lớn lên:
+      1) Exact: trie theo token của alias (tên + aliases), quét mọi vị trí token của query -> score 100.
+      2) Fuzzy (node chưa khớp exact): chỉ chấm các alias chung nhiều trigram ký tự với query
+         (blocking index), bằng rapidfuzz.process.extract với token_set_ratio như trước.
+    Query không có dấu được so với alias đã bỏ dấu; query có dấu chỉ so với alias gốc, tránh nhầm
+    kiểu "lâu" -> "lậu". Alias 1 từ mà bỏ dấu làm đổi chữ ("lậu" -> "lau") thì không bỏ dấu: 1 âm tiết
+    không dấu quá mơ hồ ("bao lau", "lau chua"), chỉ khớp khi query gõ đúng dấu như linker cũ.
+    """
+
+    def __init__(self, alias_map: Dict[str, Dict[str, Any]], max_candidates: int = 64, min_shared: float = 0.3):
+        self.max_candidates = max_candidates
+        self.min_shared = min_shared
+        self.choice_nid: List[str] = []
+        self.choices: Dict[bool, List[str]] = {False: [], True: []}      # folded? -> alias đã chuẩn hoá
+        self._trie: Dict[bool, Dict[str, Any]] = {False: {}, True: {}}
+        self._grams: Dict[bool, Dict[str, List[int]]] = {False: defaultdict(list), True: defaultdict(list)}
+        self._n_grams: Dict[bool, List[int]] = {False: [], True: []}
+        self._order = {nid: i for i, nid in enumerate(alias_map)}     # hoà điểm: theo thứ tự alias_map
+
+        for nid, obj in alias_map.items():
+            names = [obj.get("name", "")] + obj.get("aliases", [])
+            for a in dict.fromkeys(_norm(x) for x in names if x):
+                if not a:
+                    continue
+                idx = len(self.choice_nid)
+                self.choice_nid.append(nid)
+                plain = fold_diacritics(a)
+                if plain != a and len(_WORD_RE.findall(a)) < 2:
+                    plain = a
+                for folded in (False, True):
+                    text = plain if folded else a
+                    self.choices[folded].append(text)
+                    node = self._trie[folded]
+                    for tok in _WORD_RE.findall(text):
+                        node = node.setdefault(tok, {})
+                    node.setdefault("", set()).add(nid)
+                    grams = _trigrams(text)
+                    for g in grams:
+                        self._grams[folded][g].append(idx)
+                    self._n_grams[folded].append(len(grams))
+
+    def _exact(self, tokens: List[str], folded: bool) -> set:
+        found = set()
+        root = self._trie[folded]
+        for i in range(len(tokens)):
+            node = root
+            for tok in tokens[i:]:
+                node = node.get(tok)
+                if node is None:
+                    break
+                found.update(node.get("", ()))
+        return found
+
+    def _blocked(self, q: str, folded: bool) -> List[int]:
+        """Alias chung >= min_shared trigram (theo tỉ lệ trigram của alias) với query."""
+        shared: Dict[int, int] = defaultdict(int)
+        index, n_grams = self._grams[folded], self._n_grams[folded]
+        for g in _trigrams(q):
+            for idx in index.get(g, ()):
+                shared[idx] += 1
+        cands = [(c / n_grams[idx], idx) for idx, c in shared.items()
+                 if c >= self.min_shared * n_grams[idx]]
+        cands.sort(reverse=True)
+        return [idx for _, idx in cands[:self.max_candidates]]
+
+    def link(self, query: str, topn: int = 3, thresh: float = 82) -> List[Tuple[str, float]]:
+        q = _norm(query)
+        if not q:
+            return []
+        folded = fold_diacritics(q) == q        # query không dấu -> so với alias đã bỏ dấu
+        best: Dict[str, float] = {}
+        for nid in self._exact(_WORD_RE.findall(q), folded):
+            best[nid] = 100.0
+
+        # alias của node đã khớp exact (100) thì không cần chấm fuzzy nữa
+        cands = [idx for idx in self._blocked(q, folded) if self.choice_nid[idx] not in best]
+        if cands:
+            choices = {idx: self.choices[folded][idx] for idx in cands}
+            for _, score, idx in process.extract(q, choices, scorer=fuzz.token_set_ratio,
+                                                 score_cutoff=thresh, limit=None):
+                nid = self.choice_nid[idx]
+                if score > best.get(nid, -1.0):
+                    best[nid] = score
+
+        ranked = sorted(best.items(), key=lambda x: (-x[1], self._order[x[0]]))
+        return ranked[:topn]
+
+_LINKERS: "OrderedDict[int, Tuple[Dict[str, Any], int, EntityLinker]]" = OrderedDict()
+_LINKERS_MAX = 4
+
+def get_linker(alias_map: Dict[str, Dict[str, Any]]) -> EntityLinker:
+    """
+    EntityLinker dựng sẵn cho alias_map (cache theo object, giữ tối đa _LINKERS_MAX map gần nhất;
+    gọi lúc init để warm). Thêm/bớt node thì tự dựng lại; sửa alias tại chỗ thì gọi invalidate_linker.
+    """
+    key = id(alias_map)
+    got = _LINKERS.get(key)
+    if got is None or got[0] is not alias_map or got[1] != len(alias_map):
+        got = _LINKERS[key] = (alias_map, len(alias_map), EntityLinker(alias_map))
+        while len(_LINKERS) > _LINKERS_MAX:
+            _LINKERS.popitem(last=False)
+    _LINKERS.move_to_end(key)
+    return got[2]
+
+def invalidate_linker(alias_map: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+    """Bỏ EntityLinker đã cache của alias_map (None = tất cả), lần gọi sau dựng lại."""
+    if alias_map is None:
+        _LINKERS.clear()
+    else:
+        _LINKERS.pop(id(alias_map), None)
+
 def entity_link(query: str, alias_map: Dict[str, Dict[str, Any]], topn=3, thresh=82) -> List[Tuple[str, int]]:
     """Ghép thực thể từ query vào alias_map; trả về [(node_id, score), ...]."""
-    q = _norm(query)
-    cands: List[Tuple[str,int]] = []
-    for nid, obj in alias_map.items():
-        names = [obj.get("name", "")] + obj.get("aliases", [])
-        if not any(names): 
-            continue
-        score = max(fuzz.token_set_ratio(q, _norm(a)) for a in names if a)
-        if score >= thresh:
-            cands.append((nid, score))
-    cands.sort(key=lambda x: -x[1])
-    return cands[:topn]
+    if not alias_map:
+        return []
+    return get_linker(alias_map).link(query, topn=topn, thresh=thresh)
+
+# ---------- Chunk token index (cho kw_overlap) ----------
+_KW_RE = re.compile(r"[a-zA-Z0-9À-ỹ]+")
+
+def _kw_tokens(text: str) -> set:
+    return set(_KW_RE.findall((text or "").lower()))
+
+class ChunkTokens:
+    """
+    Tập token (không trùng) của mỗi chunk, tính 1 lần lúc load, lưu dạng CSR:
+      indptr:  int64[n + 1], token id của row r nằm trong indices[indptr[r]:indptr[r+1]]
+      indices: int32 token id
+    Overlap với query = đếm token id của chunk có trong mask query (vector hoá cho cả lô).
+    """
+
+    def __init__(self, chunks: ChunkStore):
+        self.vocab: Dict[str, int] = {}
+        lens, ids = [], []
+        for text in chunks.texts():
+            toks = [self.vocab.setdefault(t, len(self.vocab)) for t in _kw_tokens(text)]
+            lens.append(len(toks))
+            ids.extend(toks)
+        self.indptr = np.zeros(len(lens) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(lens)
+        self.indices = np.asarray(ids, dtype=np.int32)
+
+        # chunk id -> row dạng mảng khi id đủ "dày" (trường hợp thường gặp: 0..n-1)
+        cids = np.asarray(chunks.ids, dtype=np.int64)
+        self._chunks = chunks
+        self._id2row = None
+        if cids.size and cids.min() >= 0 and cids.max() < 4 * cids.size + 1024:
+            self._id2row = np.full(int(cids.max()) + 1, -1, dtype=np.int64)
+            self._id2row[cids] = np.arange(cids.size)
+
+    def lookup(self, cids) -> np.ndarray:
+        """Row của các chunk id, -1 cho id không có trong store (cùng shape với cids)."""
+        c = np.asarray(cids, dtype=np.int64)
+        if self._id2row is not None:
+            r = np.full(c.shape, -1, dtype=np.int64)
+            ok = (c >= 0) & (c < self._id2row.shape[0])
+            r[ok] = self._id2row[c[ok]]
+            return r
+        return np.fromiter((-1 if (x := self._chunks.row_of(v)) is None else x for v in c.tolist()),
+                           dtype=np.int64, count=c.size)
+
+    def rows_of(self, cids) -> np.ndarray:
+        """Row của các chunk id (bỏ id không có trong store), giữ nguyên thứ tự."""
+        r = self.lookup(cids)
+        return r[r >= 0]
+
+    def overlap(self, rows: np.ndarray, qtoks: set) -> np.ndarray:
+        """|q ∩ tokens(row)| / (1 + |q|) cho từng row — giống kw_overlap cũ."""
+        out = np.zeros(rows.shape[0], dtype=np.float64)
+        q_ids = [self.vocab[t] for t in qtoks if t in self.vocab]
+        if not q_ids or not rows.size:
+            return out
+        qmask = np.zeros(len(self.vocab), dtype=bool)
+        qmask[q_ids] = True
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        lens = ends - starts
+        # gom token của mọi row ứng viên thành 1 mảng phẳng, đánh dấu token có trong query
+        flat = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(int(lens.sum()))
+        hits = qmask[self.indices[flat]]
+        counts = np.bincount(np.repeat(np.arange(rows.shape[0]), lens), weights=hits, minlength=rows.shape[0])
+        return counts / (1 + len(qtoks))
+
+_TOKEN_CACHE: "weakref.WeakKeyDictionary[ChunkStore, ChunkTokens]" = weakref.WeakKeyDictionary()
+
+def chunk_tokens(chunks: ChunkStore) -> ChunkTokens:
+    """ChunkTokens dùng chung cho 1 ChunkStore (build lần đầu, gọi lúc init để warm)."""
+    tok = _TOKEN_CACHE.get(chunks)
+    if tok is None:
+        tok = _TOKEN_CACHE[chunks] = ChunkTokens(chunks)
+    return tok
 
 # ---------- Graph expand + collect evidence ----------
+# cạnh Disease -> Symptom/Test/Drug (và chiều ngược) ứng với section nào khi boost theo intent
+REL_SECTIONS = {
+    "has_symptom": "sec:symptoms", "symptom_of": "sec:symptoms",
+    "diagnosed_by": "sec:diagnosis", "detects": "sec:diagnosis",
+    "treated_by": "sec:treatment", "treats": "sec:treatment",
+}
+INTENT_BOOST = 1.8
+OVERLAP_WEIGHT = 0.30
+
+class GraphStats:
+    """
+    Dữ liệu tĩnh theo node, tính 1 lần cho mỗi graph (dùng cho best-first + dừng sớm):
+      batch[nid]  = (dsts, rels, edge weight[], evidence chunk id[], edge index của từng evidence[])
+                    -> mở 1 node = vài phép numpy trên cả lô, không lặp theo cạnh
+      chunks[nid] = chunk id (không trùng) mà node trỏ tới
+      cost[nid]   = số evidence trên các cạnh ra (công việc phải làm khi mở node)
+      damping[nid]= 1 / (1 + log degree): node "hub" như "sốt" được mở muộn và đóng góp ít
+      wmax[nid]   = weight lớn nhất trên các cạnh ra
+      pot_ids / pot_w / pot_n: theo chunk id, tổng damping * wmax (và tổng damping) của mọi node
+                    trỏ tới chunk -> cận trên phần điểm từ các node traversal chưa gặp
+    """
+
+    def __init__(self, graph):
+        self.batch: Dict[str, Tuple[List[str], List[str], np.ndarray, np.ndarray, np.ndarray]] = {}
+        self.chunks: Dict[str, np.ndarray] = {}
+        self.cost: Dict[str, int] = {}
+        self.damping: Dict[str, float] = {}
+        self.wmax: Dict[str, float] = {}
+        nids = graph.node_ids if isinstance(graph, GraphCSR) else list(graph.get("adj", {}))
+        pot_ids, pot_w, pot_n = [], [], []
+        for nid in nids:
+            dsts, rels, ws, evs = [], [], [], []
+            for dst, rel, w, evidence in iter_edges(graph, nid):
+                dsts.append(dst)
+                rels.append(rel)
+                ws.append(w)
+                evs.append(np.asarray(evidence, dtype=np.int64))
+            lens = [e.size for e in evs]
+            ev = np.concatenate(evs) if evs else np.empty(0, dtype=np.int64)
+            w = np.asarray(ws, dtype=np.float64)
+            self.batch[nid] = (dsts, rels, w, ev, np.repeat(np.arange(len(evs)), lens))
+            self.chunks[nid] = np.unique(ev)
+            self.cost[nid] = int(ev.size)
+            self.damping[nid] = 1.0 / (1.0 + float(np.log(max(len(dsts), 1))))
+            self.wmax[nid] = float(w.max()) if w.size else 0.0
+            u = self.chunks[nid]
+            pot_ids.append(u)
+            pot_w.append(np.full(u.size, self.damping[nid] * self.wmax[nid]))
+            pot_n.append(np.full(u.size, self.damping[nid]))
+        ids = np.concatenate(pot_ids) if pot_ids else np.empty(0, dtype=np.int64)
+        self.pot_ids, inv = np.unique(ids, return_inverse=True)
+        self.pot_w = np.bincount(inv, weights=np.concatenate(pot_w), minlength=self.pot_ids.size) if ids.size else np.empty(0)
+        self.pot_n = np.bincount(inv, weights=np.concatenate(pot_n), minlength=self.pot_ids.size) if ids.size else np.empty(0)
+        self._rows: "weakref.WeakKeyDictionary[ChunkTokens, _GraphRows]" = weakref.WeakKeyDictionary()
+
+    def rows_for(self, tokens: "ChunkTokens") -> "_GraphRows":
+        """Bản đồ chunk id -> row của graph này cho 1 ChunkStore (tạo 1 lần, dùng lại mỗi query)."""
+        r = self._rows.get(tokens)
+        if r is None:
+            r = self._rows[tokens] = _GraphRows(self, tokens)
+        return r
+
+_EMPTY_BATCH = ([], [], np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+_STATS_CACHE: Dict[int, Tuple[Any, GraphStats]] = {}
+
+def graph_stats(graph) -> GraphStats:
+    """GraphStats dùng chung cho 1 graph (graph.json dạng dict không weakref được -> khoá theo id)."""
+    hit = _STATS_CACHE.get(id(graph))
+    if hit is None or hit[0] is not graph:
+        hit = _STATS_CACHE[id(graph)] = (graph, GraphStats(graph))
+    return hit[1]
+
+class _GraphRows:
+    """
+    GraphStats quy về row của 1 ChunkStore:
+      node(nid)         -> (row không trùng, đã sort; vị trí row của từng evidence, -1 nếu chunk không có trong store)
+      pot_rows/w/n      -> pot_* của GraphStats theo row (sort theo row, tra bằng searchsorted)
+      by_w / by_n       -> thứ tự pot_w / pot_n giảm dần (cận cho chunk chưa node nào chạm tới)
+    """
+
+    def __init__(self, stats: GraphStats, tokens: "ChunkTokens"):
+        self._stats = stats
+        self._tokens = tokens
+        self._nodes: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        rows = tokens.lookup(stats.pot_ids)
+        ok = rows >= 0
+        order = np.argsort(rows[ok], kind="stable")
+        self.pot_rows = rows[ok][order]
+        self.pot_w = stats.pot_w[ok][order]
+        self.pot_n = stats.pot_n[ok][order]
+        self.by_w = np.argsort(-self.pot_w, kind="stable")
+        self.by_n = np.argsort(-self.pot_n, kind="stable")
+
+    def node(self, nid: str) -> Tuple[np.ndarray, np.ndarray]:
+        hit = self._nodes.get(nid)
+        if hit is None:
+            ev_rows = self._tokens.lookup(self._stats.batch.get(nid, _EMPTY_BATCH)[3])
+            u_rows = np.unique(ev_rows[ev_rows >= 0])
+            pos = np.where(ev_rows >= 0, np.searchsorted(u_rows, ev_rows), -1)
+            hit = self._nodes[nid] = (u_rows, pos)
+        return hit
+
+    def pot(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(pot_w, pot_n) của các row (0 cho row không có cạnh nào trỏ tới)."""
+        if not self.pot_rows.size:
+            return np.zeros(rows.size), np.zeros(rows.size)
+        i = np.minimum(np.searchsorted(self.pot_rows, rows), self.pot_rows.size - 1)
+        hit = self.pot_rows[i] == rows
+        return np.where(hit, self.pot_w[i], 0.0), np.where(hit, self.pot_n[i], 0.0)
+
+class _TouchedRows:
+    """
+    Cột theo chunk (điểm, thứ tự chạm, overlap, cận trên) cho riêng các chunk mà 1 query đã chạm tới,
+    đánh id cục bộ 0..m-1 -> không cấp phát / quét mảng n phần tử mỗi query.
+    """
+
+    def __init__(self, grows: _GraphRows, cap: int = 256):
+        self._grows = grows
+        self.index: Dict[int, int] = {}
+        self.m = 0
+        self.rows = np.empty(cap, dtype=np.int64)
+        self.scores = np.zeros(cap)
+        self.first_seen = np.full(cap, -1, dtype=np.int64)   # thứ tự chunk được chấm lần đầu (tie-break)
+        self.ov = np.full(cap, np.nan)                        # overlap với query, tính khi chunk được chấm lần đầu
+        self.found = np.zeros(cap)                            # cận trên từ các node đang nằm trong heap
+        self.unseen_w = np.zeros(cap)                         # pot_* còn lại từ các node chưa push
+        self.unseen_n = np.zeros(cap)
+
+    def _grow(self, need: int) -> None:
+        cap = self.rows.size
+        if need <= cap:
+            return
+        cap = max(need, 2 * cap)
+        for name, fill in (("rows", 0), ("scores", 0.0), ("first_seen", -1), ("ov", np.nan),
+                           ("found", 0.0), ("unseen_w", 0.0), ("unseen_n", 0.0)):
+            old = getattr(self, name)
+            arr = np.full(cap, fill, dtype=old.dtype)
+            arr[:self.m] = old[:self.m]
+            setattr(self, name, arr)
+
+    def ids(self, rows: np.ndarray) -> np.ndarray:
+        """Id cục bộ của các row (row mới được thêm, cận chưa gặp khởi tạo từ pot tĩnh)."""
+        index = self.index
+        new = [r for r in dict.fromkeys(rows.tolist()) if r not in index]
+        if new:
+            start = self.m
+            self._grow(start + len(new))
+            for r in new:
+                index[r] = self.m
+                self.m += 1
+            arr = np.asarray(new, dtype=np.int64)
+            self.rows[start:self.m] = arr
+            self.unseen_w[start:self.m], self.unseen_n[start:self.m] = self._grows.pot(arr)
+        return np.fromiter((index[r] for r in rows.tolist()), dtype=np.int64, count=rows.size)
+
 def expand_and_collect(
-    seeds, graph, chunks, budget: int = 30, topk: int = 5, query: str = "",
+    seeds, graph, chunks: ChunkStore, budget: int = 30, topk: int = 5, query: str = "",
     intent_sections: set | None = None,
     allowed_sections: set | None = None,     # <— MỚI
+    max_hops: int = 2,
+    max_cost: int = 2000,
 ):
+    """
+    Best-first trên graph có kiểu (Disease/Symptom/Test/Drug/Section), bắt đầu từ seeds.
+      - Ưu tiên node = seed_score/100 * 1/(1+hop); node không phải seed nhân thêm damping
+        1/(1+log degree) của chính nó (hub như "sốt" được mở muộn và đóng góp ít).
+      - Mở node: mỗi chunk evidence được chấm 1 lần theo cạnh tốt nhất
+          boost * (prio * weight + 0.30 * overlap(query) * prio / (seed_score/100))
+        boost = 1.8 nếu cạnh khớp intent (dst là section của intent, hoặc rel ứng với section đó).
+      - Giới hạn: budget node được mở, max_cost evidence được chấm (node không phải seed vượt phần còn lại bị bỏ qua),
+        max_hops bước từ seed.
+      - Dừng sớm khi không chunk nào ngoài top-k vượt được chunk thứ k kể cả khi cộng cận trên
+        phần điểm còn lại (tập top-k đã chốt; thứ tự bên trong và điểm có thể thấp hơn khi chạy hết).
+        Node chỉ còn được push (lại) từ node cha ở hop >= h = hop nhỏ nhất trong heap còn mở rộng được,
+        nên prio sau này <= s_max/(2+h) * damping:
+          node đang trong heap: max(prio hiện tại, s_max/(2+h) * damping);
+          node chưa gặp:        pot_* tĩnh x 1/(2+h);  cả hai chỉ còn phần prio hiện tại / = 0 khi hết hop.
+        Sổ sách cận trên chỉ giữ trên các chunk đã chạm (_TouchedRows); chunk chưa node nào chạm tới
+        dùng pot_w / pot_n lớn nhất còn lại.
+    allowed_sections: chỉ xét cạnh vào các node section này (cạnh sang thực thể vẫn giữ).
+    """
     if not seeds:
         return []
-    adj = graph.get("adj", {})
+    tokens = chunk_tokens(chunks)
+    stats = graph_stats(graph)
+    grows = stats.rows_for(tokens)
+    qtoks = _kw_tokens(query) if query else set()   # tokenize query 1 lần / request
+    ov_max = sum(t in tokens.vocab for t in qtoks) / (1 + len(qtoks)) if qtoks else 0.0
+    boost_max = INTENT_BOOST if intent_sections else 1.0
+    k = max(topk, 1)
+    s_max = max(sc for _, sc in seeds) / 100.0
+    n = len(chunks)
+
+    t = _TouchedRows(grows)
+    n_seen = 0
+    node_ids: Dict[str, np.ndarray] = {}     # nid -> id cục bộ của các chunk node trỏ tới
+
+    def ids_of_node(nid: str) -> np.ndarray:
+        r = node_ids.get(nid)
+        if r is None:
+            r = node_ids[nid] = t.ids(grows.node(nid)[0])
+        return r
+
+    # heap: (-prio, thứ tự push, nid, hop, seed_sc); mỗi node chỉ giữ entry có prio cao nhất
+    heap, pushed, order = [], {}, 0
+    # node đang chờ trong heap: nid -> (hop, rel, cận trên đã cộng vào found); số node chờ theo hop
+    queued: Dict[str, Tuple[int, float, float]] = {}
+    hop_count = [0] * (max_hops + 1)
+    h_used: Optional[int] = 0      # h dùng cho cận của node trong heap (chỉ tăng -> cận cũ vẫn đúng)
+
+    def node_ub(nid: str, prio: float, rel: float) -> float:
+        d = stats.damping.get(nid, 1.0)
+        if h_used is not None:
+            prio = max(prio, s_max * d / (2.0 + h_used))
+            rel = max(rel, d / (2.0 + h_used))
+        return boost_max * (prio * stats.wmax.get(nid, 0.0) + OVERLAP_WEIGHT * ov_max * rel)
+
+    def dequeue(nid: str) -> None:
+        hop, _, ub = queued.pop(nid)
+        hop_count[hop] -= 1
+        t.found[ids_of_node(nid)] -= ub
+
+    def push(nid: str, prio: float, hop: int, seed_sc: float) -> None:
+        nonlocal order
+        if prio <= pushed.get(nid, -1.0):
+            return
+        r = ids_of_node(nid)
+        if nid not in pushed:
+            d = stats.damping.get(nid, 1.0)
+            t.unseen_w[r] -= d * stats.wmax.get(nid, 0.0)
+            t.unseen_n[r] -= d
+        if nid in queued:
+            dequeue(nid)
+        rel = prio / (seed_sc / 100.0) if seed_sc else 0.0
+        ub = node_ub(nid, prio, rel)
+        t.found[r] += ub
+        queued[nid] = (hop, rel, ub)
+        hop_count[hop] += 1
+        pushed[nid] = prio
+        heapq.heappush(heap, (-prio, order, nid, hop, seed_sc))
+        order += 1
+
+    for nid, sc in seeds:
+        push(nid, sc / 100.0, 0, sc)
+
     seen = set()
-    q = deque((nid, 0, sc) for nid, sc in seeds)
-    scores = defaultdict(float)
-
-    def kw_overlap(txt: str, qtext: str) -> float:
-        if not qtext: return 0.0
-        qtoks = set(re.findall(r"[a-zA-Z0-9À-ỹ]+", qtext.lower()))
-        ttoks = set(re.findall(r"[a-zA-Z0-9À-ỹ]+", (txt or "").lower()))
-        return len(qtoks & ttoks) / (1 + len(qtoks)) if qtoks else 0.0
-
-    steps = 0
-    while q and steps < budget:
-        nid, hop, seed_sc = q.popleft()
-        if nid in seen: 
+    steps = spent = 0
+    iw = i_n = 0                   # con trỏ vào by_w / by_n (bỏ qua chunk đã chạm)
+    while heap and steps < budget:
+        neg_prio, _, nid, hop, seed_sc = heapq.heappop(heap)
+        prio = -neg_prio
+        if nid in seen or prio < pushed.get(nid, -1.0) or nid not in queued:
+            continue
+        dequeue(nid)
+        cost = stats.cost.get(nid, 0)
+        if hop and spent + cost > max_cost:     # seed luôn được mở
             continue
         seen.add(nid)
-        for edge in adj.get(nid, []):
-            dst = edge.get("dst")  # dạng "sec:diagnosis", "sec:symptoms", ...
-            # nếu truyền allowed_sections thì chỉ xét edge vào các section cho phép
-            if allowed_sections and dst not in allowed_sections:
+        rel = prio / (seed_sc / 100.0) if seed_sc else 0.0
+        dsts, rels, w_edge, ev, ev_edge = stats.batch.get(nid, _EMPTY_BATCH)
+        # boost theo cạnh; allowed_sections chỉ lọc cạnh vào node section (cạnh sang thực thể vẫn giữ)
+        boost_edge = np.ones(len(dsts))
+        keep_edge = np.ones(len(dsts), dtype=bool)
+        for e, (dst, rel_name) in enumerate(zip(dsts, rels)):
+            if allowed_sections and dst.startswith("sec:") and dst not in allowed_sections:
+                keep_edge[e] = False
                 continue
+            if intent_sections and (dst in intent_sections or REL_SECTIONS.get(rel_name) in intent_sections):
+                boost_edge[e] = INTENT_BOOST
+            if hop < max_hops and dst not in seen:
+                push(dst, (seed_sc / 100.0) / (2.0 + hop) * stats.damping.get(dst, 1.0), hop + 1, seed_sc)
+        steps += 1
+        spent += cost
 
-            w = float(edge.get("weight", 1.0))
-            hop_penalty = 1.0 / (1.0 + hop)
+        pos = grows.node(nid)[1]
+        ok = (pos >= 0) & keep_edge[ev_edge]
+        if ok.any():
+            loc, ev_edge = ids_of_node(nid)[pos[ok]], ev_edge[ok]
+            # mỗi chunk chấm 1 lần theo cạnh tốt nhất của node này
+            uniq, inv = np.unique(loc, return_inverse=True)
+            miss = uniq[np.isnan(t.ov[uniq])]
+            if miss.size:
+                t.ov[miss] = tokens.overlap(t.rows[miss], qtoks)
+            vals = boost_edge[ev_edge] * (prio * w_edge[ev_edge] + OVERLAP_WEIGHT * rel * t.ov[loc])
+            best = np.zeros(uniq.size)
+            np.maximum.at(best, inv, vals)
+            t.scores[uniq] += best
 
-            for cid in edge.get("evidence", []):
-                ch = chunks.get(int(cid))
-                if not ch: 
-                    continue
-                base = (seed_sc/100.0) * w * hop_penalty
-                base += 0.30 * kw_overlap(ch.get("text",""), query)
-                if intent_sections and dst in intent_sections:
-                    base *= 1.8
-                scores[int(cid)] += base
-
-            if hop < 1:
-                q.append((dst, hop+1, seed_sc))
-        steps += 1
+            new = uniq[t.first_seen[uniq] < 0]
+            new = new[np.argsort(t.rows[new], kind="stable")]      # trong 1 node: theo thứ tự row
+            t.first_seen[new] = n_seen + np.arange(new.size)
+            n_seen += new.size
+
+        # ---- dừng sớm: tập top-k không còn đổi được ----
+        if n_seen < k or n <= k:
+            continue
+        h = next((hh for hh in range(max_hops) if hop_count[hh]), None)
+        if h != h_used:
+            # h chỉ tăng (node mới luôn ở hop > h) -> tính lại cận của các node trong heap, tối đa max_hops lần
+            h_used = h
+            for qn, (qh, qrel, qub) in list(queued.items()):
+                ub = node_ub(qn, pushed[qn], qrel)
+                t.found[ids_of_node(qn)] += ub - qub
+                queued[qn] = (qh, qrel, ub)
+        m = t.m
+        reach = t.scores[:m] + t.found[:m]
+        rest = 0.0
+        if h is not None:
+            f = boost_max / (2.0 + h)
+            reach += f * (s_max * t.unseen_w[:m] + OVERLAP_WEIGHT * ov_max * t.unseen_n[:m])
+            while iw < grows.by_w.size and int(grows.pot_rows[grows.by_w[iw]]) in t.index:
+                iw += 1
+            while i_n < grows.by_n.size and int(grows.pot_rows[grows.by_n[i_n]]) in t.index:
+                i_n += 1
+            if iw < grows.by_w.size:
+                rest = f * (s_max * grows.pot_w[grows.by_w[iw]] + OVERLAP_WEIGHT * ov_max * grows.pot_n[grows.by_n[i_n]])
+        top = np.argpartition(-t.scores[:m], k - 1)[:k]
+        kth = t.scores[top].min()
+        reach[top] = -np.inf
+        if max(reach.max(), rest) < kth:
+            break
 
-    ranked = sorted(scores.items(), key=lambda x: -x[1])[:max(topk, 1)]
+    loc = np.flatnonzero(t.first_seen[:t.m] >= 0)
+    ranked = loc[np.lexsort((t.first_seen[loc], -t.scores[loc]))][:k]
     out = []
-    for rank, (cid, sc) in enumerate(ranked, start=1):
-        ch = chunks[int(cid)]
-        out.append({
-            "rank": rank, "score": float(sc), "id": int(cid),
-            "title": ch.get("title",""), "section": ch.get("section",""),
-            "source": ch.get("source",""), "text": (ch.get("text","") or "").strip()
-        })
+    for rank, li in enumerate(ranked.tolist(), start=1):
+        row = int(t.rows[li])
+        out.append({"rank": rank} | chunks.hit(row, float(t.scores[li])))
     return out
 
 # ---------- Context builder ----------
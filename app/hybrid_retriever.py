@@ -27,3 +27,66 @@ def filter_by_section(hits: List[Dict[str,Any]], allowed_sections_names: set | N
     if not allowed_sections_names:
         return hits
     return [h for h in hits if h.get("section","").title() in allowed_sections_names]
+
+def merge_adjacent(hits: List[Dict[str,Any]], chunks, max_chars: int = 6000) -> List[Dict[str,Any]]:
+    """
+    Ghép các hit là cửa sổ liền kề của cùng 1 tài liệu (chunker theo token: parent/seq/start/end)
+    thành 1 passage, bỏ phần overlap. Hit ghép đứng ở vị trí hit xếp hạng cao nhất của nhóm,
+    score = max, "ids" = các chunk id đã ghép. Hit không có span (chunk theo đoạn) giữ nguyên.
+    """
+    groups: Dict[str, List[Tuple[int, int, int, int]]] = {}
+    for i, h in enumerate(hits):
+        row = chunks.row_of(h["id"])
+        span = chunks.span(row) if row is not None else None
+        parent = chunks.field(row, "parent") if span is not None else ""
+        if parent:
+            groups.setdefault(parent, []).append((span[0], span[1], span[2], i))
+    if not groups:
+        return hits
+
+    merged_into: Dict[int, int] = {}     # index hit -> index hit đại diện của nhóm
+    merged: Dict[int, Dict[str,Any]] = {}
+
+    def flush(run):
+        head = min(r[3] for r in run)
+        for r in run:
+            merged_into[r[3]] = head
+        if len({r[0] for r in run}) < 2:
+            return
+        text, seq, end = "", None, None
+        for r_seq, start, stop, i in run:
+            if r_seq == seq:
+                continue            # cùng 1 chunk xuất hiện 2 lần
+            t = chunks.text(chunks.row_of(hits[i]["id"]))
+            if end is None:
+                text = t
+            elif start < end:
+                text += t[end - start:]
+            else:
+                text += " " + t
+            seq, end = r_seq, stop
+        merged[head] = hits[head] | {
+            "score": max(float(hits[r[3]].get("score") or 0.0) for r in run),
+            "text": text.strip(),
+            "ids": list(dict.fromkeys(int(hits[r[3]]["id"]) for r in run)),
+        }
+
+    for members in groups.values():
+        members.sort()
+        run = [members[0]]
+        for m in members[1:]:
+            if m[0] <= run[-1][0] + 1 and m[2] - run[0][1] <= max_chars:
+                run.append(m)
+            else:
+                flush(run)
+                run = [m]
+        flush(run)
+
+    out = []
+    for i, h in enumerate(hits):
+        head = merged_into.get(i)
+        if head is None:
+            out.append(h)
+        elif head == i:
+            out.append(merged.get(i, h))
+    return out
@@ -0,0 +1,287 @@
+# reranker.py
+# -*- coding: utf-8 -*-
+"""
+Rerank passage sau RRF / dedup, trước khi cắt top_k đưa vào prompt (chạy trên CPU).
+
+- FeatureReranker (RERANKER=features): chấm bằng đặc trưng từ vựng, không cần model —
+  độ phủ term của query có trọng số idf (lấy từ BM25 index), cụm 2 từ liền kề
+  ("triệu chứng", "giang mai"), độ phủ trên tiêu đề.
+- OnnxCrossEncoder (tuỳ chọn): cross-encoder nhỏ export ONNX + tokenizer.json,
+  cần onnxruntime và tokenizers.
+- RerankStage: chấm theo lô, cache điểm theo (hash query, chunk id), giới hạn
+  thời gian; quá hạn thì giữ nguyên thứ tự RRF. Điểm cuối = điểm model (chuẩn hoá
+  min-max trong lô ứng viên) trộn với vị trí sau fusion (prior_weight), cộng
+  section_weight nếu section của passage khớp intent của câu hỏi.
+"""
+from __future__ import annotations
+
+import asyncio
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .embed_cache import cache_key
+
+_TOKEN_RE = re.compile(r"[a-zA-Z0-9À-ỹ]+")
+# từ hỏi/hư từ không mang nội dung (VI/EN), bỏ khỏi query khi tính độ phủ
+STOPWORDS = {
+    "là", "gì", "có", "không", "của", "và", "bị", "thì", "như", "thế", "nào", "các", "những",
+    "cho", "tôi", "em", "mình", "với", "khi", "bao", "lâu", "sao", "ạ", "ơi", "hay", "hoặc", "được",
+    "the", "a", "an", "is", "are", "what", "of", "and", "or", "to", "in", "for", "how", "do",
+    "does", "can", "i", "my", "with", "about", "on",
+}
+
+
+def _tok(s: str) -> List[str]:
+    return _TOKEN_RE.findall((s or "").lower())
+
+
+def _hit_key(hit: Dict[str, Any]) -> str:
+    # hit ghép từ nhiều chunk (merge_adjacent) có text khác chunk đơn -> khoá theo cả nhóm id
+    ids = hit.get("ids")
+    return ",".join(str(i) for i in ids) if ids else str(hit.get("id"))
+
+
+# ---------- Scorers ----------
+class FeatureReranker:
+    """
+    score = 0.55 * phủ term (idf) + 0.30 * phủ cụm 2 từ + 0.15 * phủ term trên tiêu đề,
+    nhân hệ số độ dài (chunk quá ngắn bị giảm điểm).
+    idf: BM25Index (dùng df trong postings) hoặc None (mọi term trọng số 1).
+    """
+
+    name = "features"
+
+    def __init__(self, idf=None, min_tokens: int = 40):
+        self.min_tokens = max(1, int(min_tokens))
+        self._idf: Dict[str, float] = {}
+        if idf is not None:
+            n = max(int(idf.n_docs), 1)
+            df = np.diff(np.asarray(idf.indptr))
+            self._idf = {t: math.log(1.0 + (n - df[i] + 0.5) / (df[i] + 0.5)) for t, i in idf.vocab.items()}
+            self._idf_default = math.log(1.0 + (n + 0.5) / 0.5)
+        else:
+            self._idf_default = 1.0
+
+    def score(self, query: str, hits: List[Dict[str, Any]]) -> np.ndarray:
+        q = [t for t in _tok(query) if t not in STOPWORDS] or _tok(query)
+        if not q:
+            return np.zeros(len(hits))
+        terms = list(dict.fromkeys(q))
+        w = np.array([self._idf.get(t, self._idf_default) for t in terms])
+        w_sum = float(w.sum()) or 1.0
+        bigrams = {(a, b) for a, b in zip(q, q[1:])}
+
+        out = np.zeros(len(hits))
+        for i, h in enumerate(hits):
+            toks = _tok(h.get("text", ""))
+            if not toks:
+                continue
+            doc = set(toks)
+            title = set(_tok(h.get("title", "")))
+            cov = float(w[[t in doc for t in terms]].sum()) / w_sum
+            tcov = float(w[[t in title for t in terms]].sum()) / w_sum
+            if bigrams:
+                pairs = set(zip(toks, toks[1:]))
+                bcov = sum(p in pairs for p in bigrams) / len(bigrams)
+            else:
+                bcov = cov
+            length = min(1.0, len(toks) / self.min_tokens)
+            out[i] = (0.55 * cov + 0.30 * bcov + 0.15 * tcov) * length
+        return out
+
+
+class OnnxCrossEncoder:
+    """
+    Cross-encoder (query, passage) -> logit, model ONNX + tokenizer.json (HF tokenizers).
+    Output [B, 1] lấy cột 0, [B, 2] lấy cột cuối (nhãn "relevant").
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_path: str, tokenizer_path: str, max_length: int = 256, threads: int = 0):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        opts = ort.SessionOptions()
+        if threads:
+            opts.intra_op_num_threads = int(threads)
+        self.session = ort.InferenceSession(model_path, sess_options=opts, providers=["CPUExecutionProvider"])
+        self.inputs = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=int(max_length))
+        self.tokenizer.enable_padding()
+        self.name = f"onnx:{model_path}"
+
+    def score(self, query: str, hits: List[Dict[str, Any]]) -> np.ndarray:
+        if not hits:
+            return np.zeros(0)
+        enc = self.tokenizer.encode_batch([(query, h.get("text", "")) for h in hits])
+        feed = {
+            "input_ids": np.array([e.ids for e in enc], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in enc], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in enc], dtype=np.int64),
+        }
+        logits = self.session.run(None, {k: v for k, v in feed.items() if k in self.inputs})[0]
+        logits = np.asarray(logits, dtype=np.float64)
+        return logits[:, -1] if logits.ndim == 2 else logits.reshape(-1)
+
+
+# ---------- Stage ----------
+class RerankStage:
+    def __init__(
+        self,
+        reranker,
+        budget_ms: float = 150.0,
+        max_candidates: int = 20,
+        batch_size: int = 16,
+        prior_weight: float = 0.3,
+        section_weight: float = 0.4,
+        cache_size: int = 4096,
+    ):
+        self.reranker = reranker
+        self.budget_s = max(0.0, float(budget_ms)) / 1000.0
+        self.max_candidates = max(1, int(max_candidates))
+        self.batch_size = max(1, int(batch_size))
+        self.prior_weight = min(max(float(prior_weight), 0.0), 1.0)
+        self.section_weight = max(0.0, float(section_weight))
+        self.cache_size = max(0, int(cache_size))
+        self._cache: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"calls": 0, "cached": 0, "scored": 0, "timeouts": 0, "errors": 0}
+
+    # ---------- cache ----------
+    def _get(self, key: Tuple[str, str]) -> Optional[float]:
+        with self._lock:
+            v = self._cache.get(key)
+            if v is not None:
+                self._cache.move_to_end(key)
+            return v
+
+    def _put(self, key: Tuple[str, str], v: float) -> None:
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[key] = v
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    # ---------- scoring ----------
+    def _score(self, query: str, hits: List[Dict[str, Any]], deadline: float) -> Optional[np.ndarray]:
+        """Điểm model cho từng hit (cache trước, phần thiếu chấm theo lô). None = hết giờ."""
+        qkey = cache_key(self.reranker.name, query)
+        keys = [(qkey, _hit_key(h)) for h in hits]
+        scores = np.empty(len(hits))
+        todo = []
+        for i, key in enumerate(keys):
+            v = self._get(key)
+            if v is None:
+                todo.append(i)
+            else:
+                scores[i] = v
+        with self._lock:
+            self.stats["cached"] += len(hits) - len(todo)
+
+        for b in range(0, len(todo), self.batch_size):
+            if time.monotonic() > deadline:
+                return None
+            idx = todo[b:b + self.batch_size]
+            out = self.reranker.score(query, [hits[i] for i in idx])
+            for i, v in zip(idx, np.asarray(out, dtype=np.float64).tolist()):
+                scores[i] = v
+                self._put(keys[i], v)
+            with self._lock:
+                self.stats["scored"] += len(idx)
+        return scores
+
+    def _order(self, scores: np.ndarray, match: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        lo, hi = float(scores.min()), float(scores.max())
+        rel = (scores - lo) / (hi - lo) if hi > lo else np.zeros_like(scores)
+        prior = 1.0 / (1.0 + np.arange(scores.size))
+        final = (1.0 - self.prior_weight) * rel + self.prior_weight * prior + self.section_weight * match
+        # hoà điểm thì giữ thứ tự RRF
+        return np.lexsort((np.arange(scores.size), -final)), final
+
+    def _deadline(self) -> float:
+        return time.monotonic() + self.budget_s if self.budget_s else math.inf
+
+    def rerank(self, query: str, hits: List[Dict[str, Any]], sections: Optional[set] = None,
+               deadline: Optional[float] = None):
+        """
+        Trả về (hits đã sắp lại, info). max_candidates hit đầu được chấm lại, phần sau giữ nguyên.
+        Quá deadline / lỗi -> hits giữ nguyên thứ tự, info["fallback"] ghi lý do.
+        sections: tên section khớp intent câu hỏi (vd. {"Symptoms"}), không tính vào cache.
+        """
+        out, info = self._rerank(query, hits, sections, self._deadline() if deadline is None else deadline)
+        if info["fallback"] == "timeout":
+            with self._lock:
+                self.stats["timeouts"] += 1
+        return out, info
+
+    def _rerank(self, query: str, hits: List[Dict[str, Any]], sections: Optional[set], deadline: float):
+        t0 = time.perf_counter()
+        with self._lock:
+            self.stats["calls"] += 1
+        info: Dict[str, Any] = {"model": self.reranker.name, "fallback": None}
+        head, tail = hits[:self.max_candidates], hits[self.max_candidates:]
+        if len(head) < 2:
+            info["ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            return hits, info
+        try:
+            scores = self._score(query, head, deadline)
+        except Exception as e:
+            print("[Rerank] scoring failed:", e)
+            with self._lock:
+                self.stats["errors"] += 1
+            scores, info["fallback"] = None, "error"
+        if scores is None:
+            info["fallback"] = info["fallback"] or "timeout"
+            info["ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            return hits, info
+
+        match = np.array([bool(sections) and (h.get("section") or "").title() in sections for h in head], dtype=np.float64)
+        order, final = self._order(scores, match)
+        out = [head[i] | {"rerank": round(float(final[i]), 4)} for i in order.tolist()]
+        info["ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        return out + tail, info
+
+    async def arerank(self, query: str, hits: List[Dict[str, Any]], sections: Optional[set] = None):
+        """
+        Chạy rerank trong thread; quá budget thì trả thứ tự RRF ngay. Thread vẫn chấm nốt
+        lô đang chạy (rồi dừng vì quá deadline) — điểm đã chấm vẫn vào cache cho lần sau.
+        """
+        try:
+            out, info = await asyncio.wait_for(
+                asyncio.to_thread(self._rerank, query, hits, sections, self._deadline()), timeout=self.budget_s or None
+            )
+        except asyncio.TimeoutError:
+            out, info = hits, {"model": self.reranker.name, "fallback": "timeout", "ms": round(self.budget_s * 1000, 2)}
+        if info["fallback"] == "timeout":
+            with self._lock:
+                self.stats["timeouts"] += 1
+        return out, info
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, size=len(self._cache))
+
+
+def make_reranker(kind: str, idf=None, model_path: str = "", tokenizer_path: str = "", **kw):
+    """"features" | "onnx" | "off"; onnx không load được thì lùi về features."""
+    kind = (kind or "off").lower()
+    if kind in ("off", "none", ""):
+        return None
+    if kind == "onnx":
+        try:
+            return OnnxCrossEncoder(model_path, tokenizer_path, **kw)
+        except Exception as e:
+            print("[Rerank] cannot load ONNX cross-encoder, using feature scorer:", e)
+    elif kind != "features":
+        print(f"[Rerank] unknown RERANKER={kind!r}, using feature scorer")
+    return FeatureReranker(idf=idf)
@@ -2,14 +2,18 @@
 # -*- coding: utf-8 -*-
 import os
 import json
-from typing import Dict, Any, List
+import asyncio
+from typing import Dict, Any, List, Optional
 from pathlib import Path
 
 import numpy as np
 import faiss
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 
+from .chunk_store import ChunkStore, load_chunk_store
+from .embed_cache import EmbeddingCache
+
 # =============================
 # Load .env giống build_faiss
 # =============================
@@ -23,6 +27,15 @@ load_dotenv(ENV_PATH, override=True)
 EMB_MODEL = os.getenv("EMB_MODEL", "text-embedding-3-small")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+
+# Cache embedding cho query: LRU trong RAM + SQLite trên đĩa (để trống = tắt tầng đĩa)
+EMB_CACHE_SIZE = int(os.getenv("EMB_CACHE_SIZE", "2048"))
+EMB_CACHE_PATH = os.getenv("EMB_CACHE_PATH", str(ROOT_DIR / "data" / "emb_cache.sqlite"))
+
+# Tham số search cho index ANN (build_faiss.py --index-type ivf/ivfpq/hnsw); bỏ trống = mặc định của index
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "0")) or None
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "0")) or None
 
 def _resolve_path(p: str) -> Path:
     path = Path(p)
@@ -56,6 +69,10 @@ class FaissStore:
         index_path: str = "data/faiss.index",
         ids_path: str = "data/faiss.ids.npy",
         chunks_path: str = "data/chunks.jsonl",
+        chunks: Optional[ChunkStore] = None,
+        emb_cache: Optional[EmbeddingCache] = None,
+        nprobe: Optional[int] = FAISS_NPROBE,
+        ef_search: Optional[int] = FAISS_EF_SEARCH,
     ):
         self.index_path = str(_resolve_path(index_path))
         self.ids_path = str(_resolve_path(ids_path))
@@ -63,19 +80,97 @@ class FaissStore:
 
         # Load index + ids + chunks
         self.index = faiss.read_index(self.index_path)
-        self.ids = np.load(self.ids_path)
-        self.chunks = load_chunks_map(self.chunks_path)
+        # index mới (build_faiss.py) là IndexIDMap2: label = chunk id, không cần faiss.ids.npy
+        if isinstance(self.index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            self.ids = None
+        else:
+            self.ids = np.load(self.ids_path)
+        # dùng ChunkStore chung nếu backend truyền vào, tránh parse lại chunks.jsonl
+        self.chunks = chunks if chunks is not None else load_chunk_store(str(_resolve_path(chunks_path)))
+
+        if emb_cache is None:
+            try:
+                emb_cache = EmbeddingCache(EMB_CACHE_SIZE, EMB_CACHE_PATH or None)
+            except Exception as e:
+                print("[FAISS] embedding disk cache disabled:", e)
+                emb_cache = EmbeddingCache(EMB_CACHE_SIZE, None)
+        self.emb_cache = emb_cache
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
 
         print(
             f"[FAISS] store ready | dim={self.index.d}, "
             f"nvecs={self.index.ntotal}, "
-            f"ids={self.ids.shape[0]}"
+            f"ids={'idmap' if self.ids is None else self.ids.shape[0]}, "
+            f"type={type(self.index).__name__}"
         )
 
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> None:
+        """
+        Knob runtime cho index ANN: nprobe (IVF*) và efSearch (HNSW).
+        Bỏ qua tham số không áp dụng cho loại index hiện tại.
+        """
+        ps = faiss.ParameterSpace()
+        for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+            if not value:
+                continue
+            try:
+                ps.set_index_parameter(self.index, name, int(value))
+            except RuntimeError:
+                print(f"[FAISS] {name} is not applicable to {type(self.index).__name__}, ignored")
+
+    def _stored_vectors(self):
+        """
+        (vectors, labels) đang lưu trong index; với PQ là vector đã nén (xấp xỉ).
+        IVF cần direct map để reconstruct: index từ build_faiss.py đã có sẵn; index cũ thì
+        dựng trên bản clone, không sửa index đang phục vụ search.
+        """
+        base, labels = self.index, None
+        if isinstance(base, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            labels = faiss.vector_to_array(base.id_map)
+            base = faiss.downcast_index(base.index)
+        ivf = faiss.try_extract_index_ivf(base)
+        if ivf is not None and ivf.direct_map.no():
+            base = faiss.clone_index(base)
+            faiss.extract_index_ivf(base).make_direct_map()
+        X = base.reconstruct_n(0, base.ntotal)
+        if labels is None:
+            labels = np.arange(base.ntotal, dtype="int64")
+        return X, labels
+
+    def recall_vs_exact(self, n_queries: int = 100, k: int = 10, seed: int = 0) -> float:
+        """
+        Recall@k của index hiện tại so với tìm kiếm chính xác (IndexFlatIP) trên
+        chính các vector trong index, dùng n_queries vector ngẫu nhiên làm query.
+        """
+        X, labels = self._stored_vectors()
+        if not len(X):
+            return 1.0
+        exact = faiss.IndexFlatIP(X.shape[1])
+        exact.add(X)
+        rng = np.random.default_rng(seed)
+        Q = X[rng.choice(len(X), size=min(n_queries, len(X)), replace=False)]
+        _, I_exact = exact.search(Q, k)
+        _, I_ann = self.index.search(Q, k)
+        hit = 0
+        for ex, ann in zip(I_exact, I_ann):
+            hit += len(set(labels[ex[ex >= 0]].tolist()) & set(ann[ann >= 0].tolist()))
+        return hit / float(I_exact.size)
+
+    @staticmethod
+    def _to_query_vec(embedding) -> np.ndarray:
+        x = np.array(embedding, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(x)
+        return x
+
     def _embed(self, q: str) -> np.ndarray:
         """
         Embed một câu query → vector 1 x dim, đã normalize L2.
+        Query lặp lại được lấy từ emb_cache thay vì gọi lại OpenAI.
         """
+        cached = self.emb_cache.get(EMB_MODEL, q)
+        if cached is not None:
+            return cached
+
         if not client:
             raise RuntimeError("OpenAI client is not configured (missing OPENAI_API_KEY)")
 
@@ -83,30 +178,57 @@ class FaissStore:
             model=EMB_MODEL,
             input=[q],
         )
-        x = np.array(resp.data[0].embedding, dtype="float32").reshape(1, -1)
-        faiss.normalize_L2(x)
+        x = self._to_query_vec(resp.data[0].embedding)
+        self.emb_cache.put(EMB_MODEL, q, x)
         return x
 
-    def search(self, query: str, k: int = 8) -> List[Dict[str, Any]]:
+    async def _aembed(self, q: str) -> np.ndarray:
         """
-        Tìm k chunks gần nhất cho query.
-        Trả về list các dict: id, score, title, section, source, text.
+        Giống _embed nhưng dùng AsyncOpenAI (không giữ thread trong lúc chờ mạng).
+        Trên event loop chỉ tra LRU trong RAM; tầng SQLite (có busy timeout) chạy qua asyncio.to_thread.
         """
-        x = self._embed(query)
+        cached = self.emb_cache.peek(EMB_MODEL, q)
+        if cached is None and self.emb_cache.db_path:
+            cached = await asyncio.to_thread(self.emb_cache.get, EMB_MODEL, q)
+        if cached is not None:
+            return cached
+
+        if not aclient:
+            raise RuntimeError("OpenAI client is not configured (missing OPENAI_API_KEY)")
+
+        resp = await aclient.embeddings.create(
+            model=EMB_MODEL,
+            input=[q],
+        )
+        x = self._to_query_vec(resp.data[0].embedding)
+        await asyncio.to_thread(self.emb_cache.put, EMB_MODEL, q, x)
+        return x
+
+    def _lookup(self, x: np.ndarray, k: int) -> List[Dict[str, Any]]:
         D, I = self.index.search(x, k)
 
         out: List[Dict[str, Any]] = []
         for score, idx in zip(D[0], I[0]):
-            cid = int(self.ids[idx])
-            ch = self.chunks.get(cid, {})
-            out.append(
-                {
-                    "id": cid,
-                    "score": float(score),
-                    "title": ch.get("title", ""),
-                    "section": ch.get("section", ""),
-                    "source": ch.get("source", ""),
-                    "text": (ch.get("text", "") or "").strip(),
-                }
-            )
+            if idx < 0:  # index có ít hơn k vector
+                continue
+            cid = int(idx) if self.ids is None else int(self.ids[idx])
+            row = self.chunks.row_of(cid)
+            if row is None:
+                out.append(
+                    {"id": cid, "score": float(score), "title": "", "section": "", "source": "", "text": ""}
+                )
+                continue
+            out.append(self.chunks.hit(row, score))
         return out
+
+    def search(self, query: str, k: int = 8) -> List[Dict[str, Any]]:
+        """
+        Tìm k chunks gần nhất cho query.
+        Trả về list các dict: id, score, title, section, source, text.
+        """
+        return self._lookup(self._embed(query), k)
+
+    async def asearch(self, query: str, k: int = 8) -> List[Dict[str, Any]]:
+        """Bản async của search (embedding qua AsyncOpenAI, index.search chạy ngoài event loop)."""
+        x = await self._aembed(query)
+        return await asyncio.to_thread(self._lookup, x, k)
@@ -0,0 +1,246 @@
+# write_behind.py
+# -*- coding: utf-8 -*-
+"""
+Write-behind cho các lệnh ghi không cần trả kết quả ngay (chat_messages, touch conversations).
+
+Request chỉ đẩy (sql, params) vào queue rồi trả lời; 1 thread nền gom lại và ghi
+theo lô khi đủ batch_size hoặc sau flush_interval giây.
+- INSERT ... VALUES (...) cùng SQL được ghép thành 1 câu nhiều dòng
+  VALUES (...),(...),... (tự dựng, nên giá trị SQL như NOW() / 'text' trong template vẫn dùng được).
+- Queue có giới hạn: khi đầy, put chờ tối đa put_timeout giây (backpressure),
+  quá hạn thì enqueue trả False để caller tự ghi đồng bộ.
+- touch() gộp các UPDATE updated_at trùng convo trong 1 lô thành 1 câu IN (...).
+- Lỗi tạm thời (is_transient: mất kết nối, pool timeout) -> thử lại phần chưa ghi tối đa
+  max_retries lần (backoff); vẫn lỗi thì bỏ và đếm vào metrics["dropped"].
+  Lỗi của từng dòng (SQL sai, vi phạm khoá) -> ghi lại từng dòng, dòng lỗi bị bỏ và đếm.
+- close() ghi hết phần còn lại trước khi tắt (dùng trong shutdown).
+"""
+from __future__ import annotations
+
+import queue
+import re
+import threading
+import time
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Tuple
+
+_TOUCH = "__touch__"
+# INSERT ... VALUES (<template>) [;] — template có thể chứa hằng SQL (NOW(), 'user', ...)
+_INSERT_VALUES_RE = re.compile(r"^\s*((?:INSERT|REPLACE)\b.+?\bVALUES\s*)(\(.*\))\s*;?\s*$", re.I | re.S)
+
+
+class _Marker:
+    def __init__(self, stop: bool = False):
+        self.stop = stop
+        self.done = threading.Event()
+
+
+def multi_row_insert(sql: str, n: int) -> Optional[str]:
+    """'INSERT ... VALUES (t)' -> 'INSERT ... VALUES (t),(t),...' n lần; None nếu không phải dạng đó."""
+    m = _INSERT_VALUES_RE.match(sql)
+    if not m or "ON DUPLICATE" in sql.upper():
+        return None
+    return m.group(1) + ",".join([m.group(2)] * n)
+
+
+class WriteBehindQueue:
+    def __init__(
+        self,
+        connection: Callable[[], ContextManager[Any]],
+        touch_sql: str = "UPDATE conversations SET updated_at=NOW() WHERE id IN ({ids})",
+        max_queue: int = 10000,
+        batch_size: int = 200,
+        flush_interval: float = 0.5,
+        put_timeout: float = 1.0,
+        max_retries: int = 3,
+        retry_backoff: float = 0.2,
+        is_transient: Callable[[BaseException], bool] = lambda e: True,
+        max_rows_per_statement: int = 500,
+    ):
+        self._connection = connection
+        self._touch_sql = touch_sql
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.put_timeout = float(put_timeout)
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff = max(0.0, float(retry_backoff))
+        self._is_transient = is_transient
+        self.max_rows_per_statement = max(1, int(max_rows_per_statement))
+        self._q: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._closed = False
+        self._inflight = 0
+        self._state = threading.Condition()     # _closed / _inflight
+        self._lock = threading.Lock()           # metrics
+        self.metrics: Dict[str, int] = {
+            "enqueued": 0, "rejected": 0, "batches": 0, "rows": 0, "statements": 0,
+            "retries": 0, "errors": 0, "dropped": 0,
+        }
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def _inc(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self.metrics[key] += n
+
+    # ---------- producer side ----------
+    def _put(self, item) -> bool:
+        # _inflight: close() chờ các put đang chạy xong rồi mới xếp marker dừng,
+        # nên mọi item đã được nhận (True) đều nằm trước marker và được ghi
+        with self._state:
+            if self._closed:
+                return False
+            self._inflight += 1
+        try:
+            self._q.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            self._inc("rejected")
+            return False
+        finally:
+            with self._state:
+                self._inflight -= 1
+                self._state.notify_all()
+        self._inc("enqueued")
+        return True
+
+    def execute(self, sql: str, params: tuple = ()) -> bool:
+        """Xếp 1 câu ghi vào queue. False = queue đầy/đã đóng, caller phải ghi trực tiếp."""
+        return self._put((sql, tuple(params)))
+
+    def touch(self, key: Any) -> bool:
+        """Xếp 1 lần cập nhật updated_at cho conversation `key`."""
+        return self._put((_TOUCH, (key,)))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Chờ mọi lệnh đã xếp trước đó được ghi xong (read-your-writes)."""
+        with self._state:
+            if self._closed:
+                return True
+        marker = _Marker()
+        try:
+            self._q.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(timeout)
+
+    def close(self, timeout: float = 10.0) -> None:
+        with self._state:
+            if self._closed:
+                return
+            self._closed = True
+            self._state.wait_for(lambda: self._inflight == 0, timeout)
+        marker = _Marker(stop=True)
+        self._q.put(marker)
+        marker.done.wait(timeout)
+        self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.metrics, pending=self._q.qsize())
+
+    # ---------- consumer side ----------
+    def _run(self) -> None:
+        while True:
+            try:
+                first = self._q.get()
+            except Exception:
+                continue
+            batch: List[Tuple[str, tuple]] = []
+            markers: List[_Marker] = []
+            item = first
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, _Marker):
+                    markers.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write(batch)
+            stop = False
+            for m in markers:
+                stop = stop or m.stop
+                m.done.set()
+            if stop:
+                return
+
+    def _group(self, batch: List[Tuple[str, tuple]]) -> List[Tuple[str, List[tuple]]]:
+        # gom các lệnh liên tiếp cùng SQL, giữ nguyên thứ tự
+        groups: List[Tuple[str, List[tuple]]] = []
+        touched: List[Any] = []
+        for sql, params in batch:
+            if sql == _TOUCH:
+                if params[0] not in touched:
+                    touched.append(params[0])
+                continue
+            if groups and groups[-1][0] == sql:
+                groups[-1][1].append(params)
+            else:
+                groups.append((sql, [params]))
+        if touched:
+            ids = ",".join(["%s"] * len(touched))
+            groups.append((self._touch_sql.format(ids=ids), [tuple(touched)]))
+        return groups
+
+    def _write(self, batch: List[Tuple[str, tuple]]) -> None:
+        # mỗi dòng ghi xong bị xoá khỏi groups -> lần thử lại chỉ ghi phần còn thiếu (không ghi trùng)
+        groups = self._group(batch)
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._connection() as conn:
+                    with conn.cursor() as cur:
+                        while groups:
+                            sql, rows = groups[0]
+                            self._exec_group(cur, sql, rows)
+                            groups.pop(0)
+                self._inc("batches")
+                return
+            except Exception as e:
+                left = sum(len(rows) for _, rows in groups)
+                if attempt < self.max_retries and self._is_transient(e):
+                    self._inc("retries")
+                    print(f"[WriteBehind] batch write failed ({left} rows left), retrying:", e)
+                    time.sleep(self.retry_backoff * (2 ** attempt))
+                    continue
+                self._inc("errors")
+                self._inc("dropped", left)
+                print(f"[WriteBehind] batch write failed, dropped {left} rows:", e)
+                return
+
+    def _exec_group(self, cur, sql: str, rows: List[tuple]) -> None:
+        """Ghi rows (xoá dần phần đã ghi). Lỗi tạm thời được ném lên để _write thử lại."""
+        while rows:
+            part = rows[:self.max_rows_per_statement]
+            multi = multi_row_insert(sql, len(part)) if len(part) > 1 else None
+            try:
+                if multi:
+                    cur.execute(multi, tuple(p for params in part for p in params))
+                elif len(part) == 1:
+                    cur.execute(sql, part[0])
+                else:
+                    cur.executemany(sql, part)
+                self._inc("statements")
+                self._inc("rows", len(part))
+                del rows[:len(part)]
+                continue
+            except Exception as e:
+                if self._is_transient(e):
+                    raise
+                if len(part) == 1:
+                    self._inc("errors")
+                    self._inc("dropped")
+                    print("[WriteBehind] write failed, row dropped:", e)
+                    del rows[:1]
+                    continue
+                print("[WriteBehind] multi-row write failed, retrying row by row:", e)
+            # 1 dòng lỗi không làm mất cả lô
+            for _ in range(len(part)):
+                self._exec_group(cur, sql, [rows[0]])
+                del rows[:1]
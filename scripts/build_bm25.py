@@ -0,0 +1,40 @@
+# build_bm25.py — build BM25 inverted index offline (postings, impacts, vocab)
+# và ghi ra data/bm25.idx để backend mmap lúc khởi động thay vì tokenize lại corpus.
+#
+#   python scripts/build_bm25.py [--chunks data/chunks.jsonl] [--out data/bm25.idx]
+import os
+import sys
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))   # .../Thesis
+sys.path.insert(0, ROOT_DIR)
+
+from app.chunk_store import load_chunk_store  # noqa: E402
+from app.bm25_index import BM25Index, _tok  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chunks", default="data/chunks.jsonl")
+    ap.add_argument("--out", default="data/bm25.idx")
+    ap.add_argument("--k1", type=float, default=1.5)
+    ap.add_argument("--b", type=float, default=0.75)
+    ap.add_argument("--epsilon", type=float, default=0.25)
+    args = ap.parse_args()
+
+    store = load_chunk_store(args.chunks)
+    index = BM25Index.build([_tok(t) for t in store.texts()], k1=args.k1, b=args.b, epsilon=args.epsilon)
+    index.save(args.out, store.ids, digest=store.digest)
+
+    # kiểm tra đọc lại
+    loaded = BM25Index.load(args.out)
+    assert loaded.vocab == index.vocab and (loaded.impacts == index.impacts).all()
+
+    print(
+        f"Saved: {args.out} | docs: {index.n_docs} | terms: {len(index.vocab)} "
+        f"| postings: {index.rows.shape[0]} | size: {os.path.getsize(args.out)} bytes"
+    )
+
+
+if __name__ == "__main__":
+    main()
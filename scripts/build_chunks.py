@@ -1,16 +1,32 @@
 # build_chunks.py — corpus builder with Normalization for VI/EN medical texts
+# Modes: concurrent crawl (default, HTTP cache) | --stream (bounded-memory generator pipeline)
 # Normalization covered:
 #   • Unicode & Vietnamese diacritics normalization; remove boilerplate/navigation text
 #   • Sentence & paragraph fixes; strip tables that cannot be parsed reliably
 
+import os
 import re
 import json
 import time
+import pathlib
 import hashlib
+import argparse
+import threading
 import unicodedata
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
 import requests
+import requests.adapters
 from bs4 import BeautifulSoup
 
+try:
+    from pypdf import PdfReader   # optional: chỉ cần khi ingest PDF cục bộ (--stream)
+except ImportError:
+    PdfReader = None
+
 # ---------------------------
 # Section heuristics
 # ---------------------------
@@ -42,34 +58,91 @@ STOP_PHRASES = [
     "bản quyền", "liên hệ", "về chúng tôi"
 ]
 
+def compile_stop_phrases(phrases) -> "re.Pattern":
+    """
+    Gộp toàn bộ stop phrase thành 1 regex dạng trie (tiền tố chung chỉ so khớp 1 lần),
+    nên remove_boilerplate chỉ quét văn bản 1 lượt dù danh sách có hàng trăm cụm.
+    Khi 1 cụm là tiền tố của cụm khác thì cụm dài hơn được ưu tiên.
+    """
+    trie = {}
+    for p in phrases:
+        node = trie
+        for ch in p.lower():
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node) -> str:
+        end = "" in node
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not end:
+            return branches[0]
+        body = "(?:" + "|".join(branches) + ")"
+        return body + "?" if end else body
+
+    if not trie:
+        return re.compile(r"(?!)")
+    # lookahead ký tự đầu giúp bỏ qua nhanh các vị trí không thể khớp
+    firsts = "".join(sorted(trie))
+    return re.compile("(?=[%s])" % re.escape(firsts) + emit(trie), re.IGNORECASE)
+
+# Compiled once at import; gọi lại compile_stop_phrases nếu sửa STOP_PHRASES lúc chạy
+_STOP_RE = compile_stop_phrases(STOP_PHRASES)
+_MENU_RE = re.compile(r"(home|trang chủ)(\s*[•|>\-]\s*\w+){3,}", re.I)
+
+_TABLE_ROW_RE = re.compile(r"(?m)^\s*\|.*\|\s*$")
+_TABLE_SEP_RE = re.compile(r"(?m)^\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)+$")
+_ASCII_TABLE_RE = re.compile(r"(?m)^\s*\+\-[-\+]+\+\s*$")
+
+# 1 lượt cho: gộp space/tab, tối đa 1 dòng trống, thêm dấu chấm cuối đoạn.
+# Space đơn lẻ không khớp (không cần thay) nên callback chỉ chạy ở chỗ thật sự đổi.
+_LAYOUT_RE = re.compile(r"[ \t]+(\n+)|[ \t]{2,}|\t|\n{3,}")
+_WORD_CHAR_RE = re.compile(r"[A-Za-zÀ-ỹ0-9]")
+
+def _layout_sub(m) -> str:
+    nl = m.group(1)
+    if nl is not None:
+        if len(nl) >= 3:
+            nl = "\n\n"
+        start = m.start()
+        if start and _WORD_CHAR_RE.match(m.string, start - 1):
+            return "." + nl      # ensure period at paragraph end
+        return " " + nl
+    return "\n\n" if m.group(0)[0] == "\n" else " "
+
+_PARA_SPLIT_RE = re.compile(r"\n{2,}")
+_WS_RE = re.compile(r"\s+")
+
 def normalize_unicode(text: str) -> str:
     t = text.replace("\u00A0", " ")
     t = unicodedata.normalize("NFC", t)
     return t
 
 def strip_tables(text: str) -> str:
-    # Markdown table rows and header separators
-    t = re.sub(r"(?m)^\s*\|.*\|\s*$", " ", text)
-    t = re.sub(r"(?m)^\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)+$", " ", t)
+    # bỏ qua cả pass khi không có ký tự nào có thể tạo thành bảng
+    t = text
+    if "|" in t:
+        # Markdown table rows and header separators
+        t = _TABLE_ROW_RE.sub(" ", t)
+        if "|" in t:
+            t = _TABLE_SEP_RE.sub(" ", t)
     # ASCII-art tables
-    t = re.sub(r"(?m)^\s*\+\-[-\+]+\+\s*$", " ", t)
+    if "+-" in t:
+        t = _ASCII_TABLE_RE.sub(" ", t)
     return t
 
 def remove_boilerplate(text: str) -> str:
-    t = text
-    for p in STOP_PHRASES:
-        t = re.sub(re.escape(p), " ", t, flags=re.IGNORECASE)
+    t = _STOP_RE.sub(" ", text)
     # Remove long menu-like chains (e.g., Home | A | B | C ...)
-    t = re.sub(r"(home|trang chủ)(\s*[•|>\-]\s*\w+){3,}", " ", t, flags=re.I)
+    # Giữ pass riêng, chạy SAU khi bỏ stop phrase như trước
+    t = _MENU_RE.sub(" ", t)
     return t
 
 def fix_sentences_and_paragraphs(text: str) -> str:
-    t = text
-    t = t.replace("•", "- ").replace("–", "- ").replace("—", "- ")
-    t = re.sub(r"[ \t]+", " ", t)             # collapse spaces
-    t = re.sub(r"\r\n|\r", "\n", t)           # unify line breaks
-    t = re.sub(r"\n{3,}", "\n\n", t)          # max one blank line
-    t = re.sub(r"([A-Za-zÀ-ỹ0-9])( +)\n", r"\1.\n", t)  # ensure period at paragraph end
+    t = text.replace("•", "- ").replace("–", "- ").replace("—", "- ")
+    t = t.replace("\r\n", "\n").replace("\r", "\n")   # unify line breaks (str.replace, không cần regex)
+    t = _LAYOUT_RE.sub(_layout_sub, t)
     return t.strip()
 
 def clean_text(raw: str) -> str:
@@ -80,14 +153,123 @@ def clean_text(raw: str) -> str:
     return t
 
 def split_paragraphs(text: str):
-    parts = [re.sub(r"\s+", " ", t).strip() for t in re.split(r"\n{2,}", text)]
+    parts = [_WS_RE.sub(" ", t).strip() for t in _PARA_SPLIT_RE.split(text)]
     return [p for p in parts if len(p) > 60]
 
 # HTML fetch & robust text extraction
-def fetch_and_parse(url: str):
-    r = requests.get(url, timeout=30, headers={"User-Agent": "Mozilla/5.0"})
+def make_session(pool_size: int = 10) -> requests.Session:
+    """Session dùng chung (keep-alive, connection pool) cho các lần fetch."""
+    sess = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    sess.mount("http://", adapter)
+    sess.mount("https://", adapter)
+    sess.headers.update({"User-Agent": "Mozilla/5.0"})
+    return sess
+
+def fetch_html(url: str, session=None, timeout: float = 30) -> str:
+    r = (session or requests).get(url, timeout=timeout, headers={"User-Agent": "Mozilla/5.0"})
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+    return r.text
+
+# ---------------------------
+# HTTP cache (conditional GET)
+# ---------------------------
+class HttpCache:
+    """
+    Cache HTML thô theo URL trong data/http_cache:
+      <sha1(url)>.html  : nội dung trang lần tải gần nhất
+      <sha1(url)>.json  : {url, etag, last_modified, fetched_at, chunks}
+    Lần chạy sau gửi If-None-Match / If-Modified-Since; 304 → trang không đổi,
+    dùng lại chunks đã sinh (giữ nguyên text/hash/date_accessed) mà không parse lại.
+    """
+
+    def __init__(self, root: str = "data/http_cache", signature: str = ""):
+        self.root = pathlib.Path(root)
+        self.signature = signature      # cấu hình chunking; khác thì không dùng lại chunks cũ
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, url: str, ext: str) -> pathlib.Path:
+        return self.root / (hashlib.sha1(url.encode("utf-8")).hexdigest() + ext)
+
+    @staticmethod
+    def _write(path: pathlib.Path, data: str) -> None:
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(data, encoding="utf-8")
+        os.replace(tmp, path)
+
+    def meta(self, url: str):
+        path = self._path(url, ".json")
+        if not path.exists():
+            return None
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def html(self, url: str):
+        path = self._path(url, ".html")
+        return path.read_text(encoding="utf-8") if path.exists() else None
+
+    def conditional_headers(self, url: str) -> dict:
+        meta = self.meta(url)
+        if not meta or not self._path(url, ".html").exists():
+            return {}
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def store_page(self, url: str, resp, html: str) -> None:
+        # trang mới → chunks cũ không còn đúng, sẽ được ghi lại sau khi parse
+        self._write(self._path(url, ".html"), html)
+        self._write(self._path(url, ".json"), json.dumps({
+            "url": url,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "fetched_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "chunks": None,
+        }, ensure_ascii=False))
+
+    def chunks(self, url: str):
+        meta = self.meta(url)
+        if not meta or meta.get("chunk_signature", "") != self.signature:
+            return None
+        return meta.get("chunks")
+
+    def store_chunks(self, url: str, chunks) -> None:
+        meta = self.meta(url)
+        if meta is None:
+            return
+        # id được gán lại mỗi lần build nên không lưu
+        meta["chunks"] = [{k: v for k, v in c.items() if k != "id"} for c in chunks]
+        meta["chunk_signature"] = self.signature
+        self._write(self._path(url, ".json"), json.dumps(meta, ensure_ascii=False))
+
+def fetch_page(url: str, session=None, timeout: float = 30, cache: HttpCache = None):
+    """
+    GET có điều kiện. Trả về ("fresh", html) khi trang đổi/chưa cache,
+    ("cached", chunks) khi server trả 304 và đã có chunks lần trước,
+    ("stale", html) khi 304 nhưng chưa có chunks (parse lại HTML đã cache).
+    """
+    headers = {"User-Agent": "Mozilla/5.0"}
+    if cache is not None:
+        headers.update(cache.conditional_headers(url))
+    r = (session or requests).get(url, timeout=timeout, headers=headers)
+    if r.status_code == 304 and cache is not None:
+        chunks = cache.chunks(url)
+        if chunks is not None:
+            return "cached", chunks
+        return "stale", cache.html(url)
+    r.raise_for_status()
+    html = r.text
+    if cache is not None:
+        cache.store_page(url, r, html)
+    return "fresh", html
+
+def parse_html(url: str, html: str):
+    soup = BeautifulSoup(html, "html.parser")
     title = (soup.title.text if soup.title else url).strip()
     for tag in soup(["script", "style", "nav", "header", "footer", "aside", "noscript", "form", "button", "svg"]):
         tag.decompose()
@@ -100,39 +282,501 @@ def fetch_and_parse(url: str):
     text = clean_text(raw_text)
     return title, text
 
+def fetch_and_parse(url: str):
+    return parse_html(url, fetch_html(url))
+
 # Chunking with section guess
-def to_chunks(url: str, next_id: int):
-    title, text = fetch_and_parse(url)
+_HEADING_RE = re.compile(r"^\s*([A-ZÀ-Ỹ][A-Za-zÀ-ỹ \-/]+)\s*:\s*(.+)$")
+
+def chunk_record(url: str, title: str, p: str, cid: int, date_accessed: str) -> dict:
+    # Detect local "Heading: body" pattern
+    m = _HEADING_RE.match(p)
+    heading = m.group(1) if m else ""
+    body = m.group(2) if m else p
+
+    section = guess_section(heading, body)
+    body_trim = body[:1800]  # keep prompt budget friendly
+
+    # Simple content hash for traceability
+    h = hashlib.sha1((title + url + body_trim).encode("utf-8")).hexdigest()[:16]
+
+    return {
+        "id": cid,
+        "title": title,
+        "source": url,
+        "section": section,
+        "date_accessed": date_accessed,
+        "hash": h,
+        "text": body_trim
+    }
+
+# ---------------------------
+# Token-aware sliding windows
+# ---------------------------
+# Đếm token bằng tokenizer cục bộ: tiktoken (nếu cài và có sẵn bảng BPE), không thì
+# ước lượng theo từ/dấu câu. Chỉ dùng để định kích thước cửa sổ nên sai số nhỏ chấp nhận được.
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "cl100k_base")
+try:
+    import tiktoken
+    _ENC = tiktoken.get_encoding(CHUNK_TOKENIZER)
+except Exception:
+    _ENC = None
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_SENT_RE = re.compile(r"\S.*?(?:[.!?…](?=\s|$)|$)")
+_WORD_RE = re.compile(r"\S+")
+
+def count_tokens(text: str) -> int:
+    if _ENC is not None:
+        return len(_ENC.encode(text, disallowed_special=()))
+    return len(_TOKEN_RE.findall(text))
+
+def _units(paragraph: str, max_tokens: int):
+    """Cắt đoạn thành câu (start, end, n_tokens); câu dài hơn max_tokens cắt tiếp theo từ."""
+    for m in _SENT_RE.finditer(paragraph):
+        n = count_tokens(m.group(0))
+        if n <= max_tokens:
+            yield m.start(), m.end(), n
+            continue
+        start = end = None
+        acc = 0
+        for w in _WORD_RE.finditer(m.group(0)):
+            k = count_tokens(w.group(0))
+            if start is not None and acc + k > max_tokens:
+                yield m.start() + start, m.start() + end, acc
+                start, acc = None, 0
+            if start is None:
+                start = w.start()
+            end, acc = w.end(), acc + k
+        if start is not None:
+            yield m.start() + start, m.start() + end, acc
+
+def iter_windows(paragraphs, max_tokens: int = 300, overlap: int = 50):
+    """
+    Gộp đoạn văn thành cửa sổ <= max_tokens token; cửa sổ sau lặp lại các câu cuối
+    (tổng <= overlap token) của cửa sổ trước. Offset tính trên tài liệu
+    "\n\n".join(paragraphs); yield (start, end, text) với text == doc[start:end].
+    Chỉ giữ các câu / đoạn của cửa sổ hiện tại trong RAM (dùng được với --stream).
+    """
+    units = []      # (start, end, n_tokens) các câu của cửa sổ đang gom
+    paras = []      # (offset, paragraph) còn nằm trong cửa sổ
+    total, base, n_paras, fresh = 0, 0, 0, False
+
+    def window():
+        a, b = units[0][0], units[-1][1]
+        parts = [p[max(a - off, 0):b - off] for off, p in paras if off < b and off + len(p) > a]
+        return a, b, "\n\n".join(parts)
+
+    for p in paragraphs:
+        if n_paras:
+            base += 2                   # "\n\n" giữa 2 đoạn
+        n_paras += 1
+        paras.append((base, p))
+        for a, b, n in _units(p, max_tokens):
+            if units and total + n > max_tokens:
+                yield window()
+                keep, acc = len(units), 0
+                while keep > 1 and acc + units[keep - 1][2] <= overlap:
+                    keep -= 1
+                    acc += units[keep][2]
+                units, total = units[keep:], acc
+                while units and total + n > max_tokens:
+                    total -= units.pop(0)[2]
+                fresh = False
+            units.append((base + a, base + b, n))
+            total += n
+            fresh = True
+        base += len(p)
+        start = units[0][0] if units else base
+        while paras and paras[0][0] + len(paras[0][1]) <= start:
+            paras.pop(0)
+    if fresh:
+        yield window()
+
+def window_record(url: str, title: str, text: str, cid: int, date_accessed: str,
+                  seq: int, start: int, end: int) -> dict:
+    m = _HEADING_RE.match(text.split("\n", 1)[0])
+    section = guess_section(m.group(1) if m else "", m.group(2) if m else text)
+    h = hashlib.sha1((title + url + text).encode("utf-8")).hexdigest()[:16]
+    return {
+        "id": cid,
+        "title": title,
+        "source": url,
+        "section": section,
+        "date_accessed": date_accessed,
+        "hash": h,
+        "parent": hashlib.sha1(url.encode("utf-8")).hexdigest()[:12],
+        "seq": seq,
+        "start": start,
+        "end": end,
+        "text": text
+    }
+
+def window_chunks(url: str, title: str, paragraphs, next_id: int, max_tokens: int = 300,
+                  overlap: int = 50, date_accessed: str = None):
+    """
+    Chunk theo cửa sổ token thay cho cắt cứng 1800 ký tự. Mỗi chunk ghi thêm
+    parent (tài liệu gốc), seq (thứ tự cửa sổ), start/end (offset ký tự trong tài liệu)
+    để lúc truy vấn ghép lại được các chunk liền kề (hybrid_retriever.merge_adjacent).
+    """
+    date_accessed = date_accessed or time.strftime("%Y-%m-%d")
+    for seq, (start, end, text) in enumerate(iter_windows(paragraphs, max_tokens, overlap)):
+        yield window_record(url, title, text, next_id + seq, date_accessed, seq, start, end)
+
+def make_chunks(url: str, title: str, text: str, next_id: int, window=None):
+    """window=(max_tokens, overlap) → chunk theo cửa sổ token; None → mỗi đoạn 1 chunk (≤1800 ký tự)."""
     paras = split_paragraphs(text)
+    if window:
+        out = list(window_chunks(url, title, paras, next_id, *window))
+        return out, next_id + len(out)
     out = []
     date_accessed = time.strftime("%Y-%m-%d")
 
     for p in paras:
-        # Detect local "Heading: body" pattern
-        m = re.match(r"^\s*([A-ZÀ-Ỹ][A-Za-zÀ-ỹ \-/]+)\s*:\s*(.+)$", p)
-        heading = m.group(1) if m else ""
-        body = m.group(2) if m else p
-
-        section = guess_section(heading, body)
-        body_trim = body[:1800]  # keep prompt budget friendly
-
-        # Simple content hash for traceability
-        h = hashlib.sha1((title + url + body_trim).encode("utf-8")).hexdigest()[:16]
-
-        out.append({
-            "id": next_id,
-            "title": title,
-            "source": url,
-            "section": section,
-            "date_accessed": date_accessed,
-            "hash": h,
-            "text": body_trim
-        })
+        out.append(chunk_record(url, title, p, next_id, date_accessed))
         next_id += 1
     return out, next_id
 
+def to_chunks(url: str, next_id: int):
+    title, text = fetch_and_parse(url)
+    return make_chunks(url, title, text, next_id)
+
+# ---------------------------
+# Streaming pipeline (bounded memory)
+# ---------------------------
+# fetch → parse → clean → split → chunk → write đều là generator: trang HTML
+# nhiều MB hay file PDF/HTML cục bộ được xử lý theo từng khối, không giữ cả
+# tài liệu / cây DOM trong RAM.
+STREAM_PIECE = 1 << 16          # kích thước mỗi lần đọc (ký tự / byte)
+STREAM_MAX_BUFFER = 1 << 16     # flush đoạn văn khi buffer vượt ngưỡng này
+STREAM_MAX_DEPTH = 16           # số block lồng nhau tối đa có slot riêng (sâu hơn: text chỉ vào block cha)
+
+_SKIP_TAGS = {"script", "style", "nav", "header", "footer", "aside", "noscript", "form", "button", "svg", "table"}
+_BLOCK_TAGS = {"h1", "h2", "h3", "p", "li"}
+_HEADING_TAGS = {"h1", "h2", "h3"}
+_LIST_TAGS = {"ul", "ol"}
+
+class _ContSlot(list):
+    """Slot tiếp nối của block đã emit 1 phần (flush vì quá max_buffer)."""
+
+class _BlockParser(HTMLParser):
+    """
+    Parser tăng dần (feed từng khúc) trích text của h1/h2/h3/p/li như parse_html,
+    bỏ qua nội dung trong _SKIP_TAGS. Block lồng nhau (li > p) được emit theo thứ
+    tự mở thẻ giống find_all; chỉ giữ trong RAM block ngoài cùng đang mở.
+    Thẻ không đóng được đóng ngầm như trình duyệt (<p> mở khi đang có <p>, <li> cùng
+    danh sách, heading trong heading, </ul>/</ol> đóng các <li> bên trong), nên
+    "<p>a<p>b<p>c" là 3 block a / b / c thay vì lồng nhau. RAM bị chặn bởi max_depth
+    slot và max_buffer ký tự chờ emit (vượt thì emit phần đã có rồi tiếp tục).
+    """
+
+    def __init__(self, max_depth: int = STREAM_MAX_DEPTH, max_buffer: int = STREAM_MAX_BUFFER):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self._in_title = False
+        self._title_parts = []
+        self._skip = 0
+        self.max_depth = max_depth
+        self.max_buffer = max_buffer
+        self._open = []        # stack các block đang mở: (tag, slot); ul/ol có slot None (chỉ làm ranh giới li)
+        self._slots = []       # text từng block theo thứ tự mở thẻ, chờ block ngoài cùng đóng
+        self._depth = 0        # số block (có slot) đang mở
+        self._pending = 0      # số ký tự trong _slots
+        self.events = []
+
+    def _close_to(self, tags, stop=()):
+        """Đóng block gần nhất có tag trong `tags` (cùng mọi block mở sau nó), không vượt qua tag trong `stop`."""
+        for i in range(len(self._open) - 1, -1, -1):
+            t = self._open[i][0]
+            if t in tags:
+                break
+            if t in stop:
+                return
+        else:
+            return
+        for t, slot in self._open[i:]:
+            if slot is not None:
+                self._depth -= 1
+        del self._open[i:]
+        if not self._depth:
+            self._flush_slots()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip += 1
+        elif self._skip:
+            return
+        elif tag == "title" and self.title is None:
+            self._in_title = True
+        elif tag in _LIST_TAGS:
+            self._close_to(("p",), _LIST_TAGS)
+            self._open.append((tag, None))
+        elif tag in _BLOCK_TAGS:
+            # đóng ngầm: p không chứa block; li đóng li cùng danh sách; heading không lồng heading
+            self._close_to(("p",), _LIST_TAGS)
+            if tag == "li":
+                self._close_to(("li",), _LIST_TAGS)
+            elif tag in _HEADING_TAGS and self._open and self._open[-1][0] in _HEADING_TAGS:
+                self._close_to(_HEADING_TAGS)
+            slot = None
+            if self._depth < self.max_depth:
+                slot = []
+                self._slots.append(slot)
+                self._depth += 1
+            self._open.append((tag, slot))
+
+    def handle_startendtag(self, tag, attrs):
+        pass   # thẻ tự đóng (<br/>, <svg/>) không mở block/vùng skip nào
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+            return
+        if self._skip:
+            return
+        if tag == "title" and self._in_title:
+            self._in_title = False
+            self.title = " ".join(self._title_parts).strip()
+            self.events.append(("title", self.title))
+            return
+        if tag in _LIST_TAGS:
+            self._close_to((tag,))
+        elif tag in _BLOCK_TAGS:
+            self._close_to((tag,), _LIST_TAGS if tag == "li" else ())
+
+    def handle_data(self, data):
+        if self._in_title:
+            self._title_parts.append(data)
+            return
+        if self._skip or not self._depth:
+            return
+        s = data.strip()
+        if s:
+            for _, slot in self._open:
+                if slot is not None:
+                    slot.append(s)
+                    self._pending += len(s) + 1
+            if self._pending > self.max_buffer:
+                self._flush_slots(partial=True)
+
+    def _flush_slots(self, partial=False):
+        if not partial:
+            for slot in self._slots:
+                if slot or not isinstance(slot, _ContSlot):
+                    self.events.append(("block", " ".join(slot)))
+            self._slots = []
+            self._pending = 0
+            return
+        # flush giữa chừng: emit phần đã có; block còn mở đã có text nhận slot tiếp nối
+        # (emit thành block kế tiếp; rỗng khi đóng thì bỏ, không tạo ranh giới đoạn giả)
+        open_slots = {id(slot): i for i, (_, slot) in enumerate(self._open) if slot is not None}
+        slots = []
+        for slot in self._slots:
+            i = open_slots.get(id(slot))
+            if i is not None and not slot:
+                slots.append(slot)          # block mở chưa có text: giữ nguyên chỗ
+                continue
+            if slot or not isinstance(slot, _ContSlot):
+                self.events.append(("block", " ".join(slot)))
+            if i is not None:
+                cont = _ContSlot()
+                self._open[i] = (self._open[i][0], cont)
+                slots.append(cont)
+        self._slots = slots
+        self._pending = 0
+
+    def close(self):
+        super().close()
+        self._open = []
+        self._depth = 0
+        self._flush_slots()
+
+def iter_html_events(pieces):
+    """Nhận các khúc HTML (str), yield ("title", text) / ("block", text) khi parse tới."""
+    parser = _BlockParser()
+    for piece in pieces:
+        parser.feed(piece)
+        if parser.events:
+            yield from parser.events
+            parser.events = []
+    parser.close()
+    yield from parser.events
+
+def iter_pdf_events(path: str):
+    """PDF cục bộ qua pypdf (tuỳ chọn): mỗi dòng là 1 block, dòng trống / hết trang là ranh giới đoạn."""
+    if PdfReader is None:
+        raise RuntimeError("pypdf is not installed (pip install pypdf) — cannot read " + path)
+    reader = PdfReader(path)
+    meta_title = (reader.metadata.title if reader.metadata else None) or ""
+    if meta_title.strip():
+        yield "title", meta_title.strip()
+    for page in reader.pages:       # pypdf đọc từng trang khi truy cập
+        for line in (page.extract_text() or "").splitlines():
+            yield "block", line.strip()
+        yield "block", ""
+
+def _read_pieces(f, size: int = STREAM_PIECE):
+    while True:
+        piece = f.read(size)
+        if not piece:
+            return
+        yield piece
+
+def iter_source_events(src: str, session=None, timeout: float = 30):
+    """Nguồn là URL (tải dạng stream) hoặc đường dẫn cục bộ .html/.htm/.pdf/.txt."""
+    if src.startswith(("http://", "https://")):
+        r = (session or requests).get(src, timeout=timeout, stream=True, headers={"User-Agent": "Mozilla/5.0"})
+        with r:
+            r.raise_for_status()
+            if r.encoding is None:
+                r.encoding = "utf-8"
+            yield from iter_html_events(r.iter_content(chunk_size=STREAM_PIECE, decode_unicode=True))
+        return
+    path = src[len("file://"):] if src.startswith("file://") else src
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        yield from iter_pdf_events(path)
+    elif ext == ".txt":
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                yield "block", line.strip()
+    else:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            yield from iter_html_events(_read_pieces(f))
+
+def iter_paragraphs(blocks, max_buffer: int = STREAM_MAX_BUFFER):
+    """
+    Gom block thành đoạn như parse_html + split_paragraphs: block rỗng là ranh giới
+    đoạn ("\n".join tạo ra "\n\n"). clean_text chạy trên từng buffer; buffer quá
+    max_buffer ký tự thì flush ở ranh giới block để RAM không phụ thuộc độ dài tài liệu.
+    """
+    buf, size = [], 0
+    for b in blocks:
+        if b:
+            buf.append(b)
+            size += len(b) + 1
+            if size < max_buffer:
+                continue
+        if buf:
+            # giữ "\n\n" ở ranh giới đoạn như văn bản gốc (ảnh hưởng dấu chấm cuối đoạn)
+            tail = "" if b else "\n\n"
+            yield from split_paragraphs(clean_text("\n".join(buf) + tail))
+            buf, size = [], 0
+    if buf:
+        yield from split_paragraphs(clean_text("\n".join(buf)))
+
+def stream_chunks(src: str, next_id: int, session=None, timeout: float = 30, window=None):
+    """Yield từng chunk của 1 nguồn; title lấy từ <title>/metadata PDF (mặc định là src)."""
+    state = {"title": None}
+
+    def blocks():
+        for kind, text in iter_source_events(src, session=session, timeout=timeout):
+            if kind == "title":
+                if state["title"] is None:
+                    state["title"] = text
+            else:
+                yield text
+
+    date_accessed = time.strftime("%Y-%m-%d")
+    if window:
+        windows = iter_windows(iter_paragraphs(blocks()), *window)
+        for seq, (start, end, text) in enumerate(windows):
+            yield window_record(src, state["title"] or src, text, next_id + seq, date_accessed, seq, start, end)
+        return
+    for p in iter_paragraphs(blocks()):
+        yield chunk_record(src, state["title"] or src, p, next_id, date_accessed)
+        next_id += 1
+
+def write_stream(sources, dst: pathlib.Path, timeout: float = 30, window=None):
+    """Ghi chunks.jsonl theo dòng ngay khi sinh ra; mỗi nguồn chỉ giữ 1 buffer đoạn văn."""
+    session = make_session(pool_size=1)
+    next_id = 0
+    tmp = dst.with_name(dst.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        for src in sources:
+            n = 0
+            try:
+                for c in stream_chunks(src, next_id, session=session, timeout=timeout, window=window):
+                    f.write(json.dumps(c, ensure_ascii=False) + "\n")
+                    n += 1
+            except Exception as e:
+                # các chunk đã ghi của nguồn này vẫn giữ (id liên tục)
+                print(f"[SKIP] {src} after {n} chunks: {e}")
+            else:
+                print(f"[OK] {src} -> {n} chunks")
+            next_id += n
+    os.replace(tmp, dst)
+
+# ---------------------------
+# Concurrent ingest
+# ---------------------------
+def crawl(urls, workers: int = 8, per_host: int = 4, parse_procs: int = 0, timeout: float = 30,
+          cache: HttpCache = None):
+    """
+    Fetch song song (Session dùng chung, giới hạn số request đồng thời mỗi host),
+    parse + clean_text trong process pool. Trả về theo đúng thứ tự urls (để id chunk
+    không phụ thuộc thứ tự hoàn thành), mỗi phần tử là:
+      ("parsed", (title, text)) | ("cached", chunks) | Exception
+    """
+    session = make_session(pool_size=max(workers, 1))
+    host_locks = defaultdict(lambda: threading.BoundedSemaphore(max(per_host, 1)))
+    locks_guard = threading.Lock()
+
+    def fetch(url):
+        host = urlparse(url).netloc
+        with locks_guard:
+            sem = host_locks[host]
+        with sem:
+            return fetch_page(url, session=session, timeout=timeout, cache=cache)
+
+    results = [None] * len(urls)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as fetch_pool, \
+            ProcessPoolExecutor(max_workers=parse_procs or None) as parse_pool:
+        fetches = {fetch_pool.submit(fetch, u): i for i, u in enumerate(urls)}
+        parses = {}
+        for fut in as_completed(fetches):
+            i = fetches[fut]
+            try:
+                status, payload = fut.result()
+            except Exception as e:
+                results[i] = e
+                continue
+            if status == "cached":
+                results[i] = ("cached", payload)
+            else:
+                parses[parse_pool.submit(parse_html, urls[i], payload)] = i
+        for fut in as_completed(parses):
+            i = parses[fut]
+            try:
+                results[i] = ("parsed", fut.result())
+            except Exception as e:
+                results[i] = e
+    return results
+
+def run_dedup(dst: pathlib.Path):
+    from dedup_chunks import dedup_file   # scripts/dedup_chunks.py
+    dedup_file(str(dst), str(dst), report_path=str(dst.parent / "dedup_report.json"))
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Build data/chunks.jsonl from data/sources_urls.txt")
+    ap.add_argument("--workers", type=int, default=8, help="số request HTTP song song")
+    ap.add_argument("--per-host", type=int, default=4, help="số request đồng thời tối đa mỗi host")
+    ap.add_argument("--parse-procs", type=int, default=0, help="số process parse HTML (0 = số CPU)")
+    ap.add_argument("--timeout", type=float, default=30)
+    ap.add_argument("--cache-dir", default="data/http_cache", help="thư mục cache HTML (ETag/Last-Modified)")
+    ap.add_argument("--no-cache", action="store_true", help="tải lại toàn bộ, bỏ qua cache")
+    ap.add_argument("--chunking", choices=["paragraph", "window"], default="paragraph",
+                    help="paragraph: mỗi đoạn 1 chunk (cắt 1800 ký tự); window: cửa sổ token có overlap")
+    ap.add_argument("--max-tokens", type=int, default=300, help="số token tối đa mỗi cửa sổ (--chunking window)")
+    ap.add_argument("--overlap-tokens", type=int, default=50, help="số token lặp lại giữa 2 cửa sổ liền kề")
+    ap.add_argument("--dedup", action="store_true",
+                    help="sau khi ghi, bỏ câu boilerplate lặp & chunk gần trùng (scripts/dedup_chunks.py)")
+    ap.add_argument("--stream", action="store_true",
+                    help="pipeline generator, RAM giới hạn; nhận cả file .html/.pdf/.txt cục bộ trong danh sách nguồn")
+    return ap.parse_args()
+
 def main():
-    import pathlib
+    args = parse_args()
     src = pathlib.Path("data/sources_urls.txt")
     dst = pathlib.Path("data/chunks.jsonl")
     dst.parent.mkdir(parents=True, exist_ok=True)
@@ -143,17 +787,45 @@ def main():
         if u.strip() and not u.strip().startswith("#")
     ]
 
+    window = (args.max_tokens, args.overlap_tokens) if args.chunking == "window" else None
+    if args.stream:
+        write_stream(urls, dst, timeout=args.timeout, window=window)
+        print("Done. Output -> data/chunks.jsonl")
+        if args.dedup:
+            run_dedup(dst)
+        return
+
+    # chunks cache chỉ dùng lại khi cùng cấu hình chunking
+    signature = "paragraph" if window is None else "window:%d:%d:%s" % (window + (CHUNK_TOKENIZER if _ENC else "regex",))
+    cache = None if args.no_cache else HttpCache(args.cache_dir, signature=signature)
+    results = crawl(urls, workers=args.workers, per_host=args.per_host,
+                    parse_procs=args.parse_procs, timeout=args.timeout, cache=cache)
+
+    # gán id theo thứ tự urls (không theo thứ tự hoàn thành) → id ổn định giữa các lần chạy
     next_id = 0
     with dst.open("w", encoding="utf-8") as f:
-        for u in urls:
-            try:
-                chunks, next_id = to_chunks(u, next_id)
-                for c in chunks:
-                    f.write(json.dumps(c, ensure_ascii=False) + "\n")
-                print(f"[OK] {u} -> {len(chunks)} chunks")
-            except Exception as e:
-                print(f"[SKIP] {u}: {e}")
+        for u, res in zip(urls, results):
+            if isinstance(res, Exception):
+                print(f"[SKIP] {u}: {res}")
+                continue
+            status, payload = res
+            if status == "cached":
+                # trang không đổi (304): giữ nguyên chunks cũ, chỉ đánh lại id
+                chunks = []
+                for c in payload:
+                    chunks.append({"id": next_id, **c})
+                    next_id += 1
+            else:
+                title, text = payload
+                chunks, next_id = make_chunks(u, title, text, next_id, window=window)
+                if cache is not None:
+                    cache.store_chunks(u, chunks)
+            for c in chunks:
+                f.write(json.dumps(c, ensure_ascii=False) + "\n")
+            print(f"[OK] {u} -> {len(chunks)} chunks" + (" (unchanged)" if status == "cached" else ""))
     print("Done. Output -> data/chunks.jsonl")
+    if args.dedup:
+        run_dedup(dst)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,41 @@
+# build_chunks_bin.py — đóng gói data/chunks.jsonl thành data/chunks.bin
+# (cột metadata cố định + bảng offset + blob UTF-8) để backend đọc qua mmap.
+#
+#   python scripts/build_chunks_bin.py [--src data/chunks.jsonl] [--dst data/chunks.bin]
+import os
+import sys
+import json
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))   # .../Thesis
+sys.path.insert(0, ROOT_DIR)
+
+from app.chunk_store import write_chunk_bin, file_digest, MmapChunkStore  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--src", default="data/chunks.jsonl")
+    ap.add_argument("--dst", default="data/chunks.bin")
+    args = ap.parse_args()
+
+    records = []
+    with open(args.src, "r", encoding="utf-8") as f:
+        for ln in f:
+            ln = ln.strip()
+            if ln:
+                records.append(json.loads(ln))
+
+    write_chunk_bin(records, args.dst, src_size=os.path.getsize(args.src), src_digest=file_digest(args.src))
+
+    # kiểm tra đọc lại
+    store = MmapChunkStore(args.dst)
+    for row, r in enumerate(records):
+        if int(store.ids[row]) != int(r["id"]) or store.text(row) != (r.get("text", "") or ""):
+            raise RuntimeError(f"round-trip mismatch at row {row} (id={r['id']})")
+
+    print(f"Saved: {args.dst} | chunks: {len(records)} | size: {os.path.getsize(args.dst)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
-import os, json, numpy as np, faiss
+import os, json, time, random, sqlite3, hashlib, argparse, numpy as np, faiss
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import openai
 from openai import OpenAI
 from dotenv import load_dotenv
 
@@ -27,27 +29,266 @@ def load_chunks(path="data/chunks.jsonl"):
                 metas.append(obj)
     return ids, texts, metas
 
-def embed_batches(texts, batch=256):
-    vecs = []
-    for i in range(0, len(texts), batch):
-        batch_texts = texts[i:i+batch]
-        resp = client.embeddings.create(
-            model=EMB_MODEL,
-            input=batch_texts,
+def chunk_hash(obj) -> str:
+    # chunks.jsonl đã có "hash" (build_chunks.py); fallback cho file cũ không có
+    return obj.get("hash") or hashlib.sha1((obj.get("text", "") or "").encode("utf-8")).hexdigest()[:16]
+
+# =============================
+# Vector store: hash -> embedding (giữ qua các lần build, để chỉ embed chunk mới/đổi)
+# =============================
+class VectorStore:
+    def __init__(self, path="data/faiss.vecs.sqlite", model=EMB_MODEL):
+        self.model = model
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS vecs ("
+            " hash TEXT NOT NULL, model TEXT NOT NULL, dim INTEGER NOT NULL, vec BLOB NOT NULL,"
+            " PRIMARY KEY (hash, model))"
         )
-        vecs.extend([item.embedding for item in resp.data])
-    X = np.array(vecs, dtype="float32")
-    faiss.normalize_L2(X)
-    return X
+
+    def get_many(self, hashes):
+        out = {}
+        wanted = list(set(hashes))
+        for i in range(0, len(wanted), 500):
+            part = wanted[i:i+500]
+            rows = self.conn.execute(
+                f"SELECT hash, dim, vec FROM vecs WHERE model=? AND hash IN ({','.join('?' * len(part))})",
+                [self.model, *part],
+            ).fetchall()
+            for h, dim, blob in rows:
+                out[h] = np.frombuffer(blob, dtype="float32").reshape(dim)
+        return out
+
+    def put_many(self, hashes, X):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO vecs (hash, model, dim, vec) VALUES (?,?,?,?)",
+                [(h, self.model, int(x.shape[0]), np.asarray(x, dtype="float32").tobytes()) for h, x in zip(hashes, X)],
+            )
+
+    def prune(self, keep_hashes):
+        """Xoá vector của chunk không còn trong corpus."""
+        keep = set(keep_hashes)
+        stale = [h for (h,) in self.conn.execute("SELECT hash FROM vecs WHERE model=?", (self.model,)) if h not in keep]
+        with self.conn:
+            self.conn.executemany("DELETE FROM vecs WHERE hash=? AND model=?", [(h, self.model) for h in stale])
+        return len(stale)
+
+# =============================
+# Embedding: batch theo số token, nhiều request song song, retry khi 429/5xx
+# =============================
+EMB_CONCURRENCY = int(os.getenv("EMB_CONCURRENCY", "4"))
+EMB_BATCH_TOKENS = int(os.getenv("EMB_BATCH_TOKENS", "100000"))  # API giới hạn ~300k token/request
+EMB_MAX_RETRIES = int(os.getenv("EMB_MAX_RETRIES", "6"))
+
+try:
+    import tiktoken
+    _ENC = tiktoken.encoding_for_model(EMB_MODEL)
+except Exception:
+    _ENC = None
+
+def count_tokens(text: str) -> int:
+    if _ENC is not None:
+        return len(_ENC.encode(text or ""))
+    # ước lượng khi không có tiktoken (tiếng Việt có dấu tốn token hơn tiếng Anh)
+    return len(text or "") // 3 + 1
+
+def plan_batches(texts, batch=256, max_tokens=EMB_BATCH_TOKENS):
+    """Chia texts thành các lô [start, end) không vượt quá batch item hoặc max_tokens."""
+    out, start, tok = [], 0, 0
+    for i, t in enumerate(texts):
+        n = count_tokens(t)
+        if i > start and (i - start >= batch or tok + n > max_tokens):
+            out.append((start, i))
+            start, tok = i, 0
+        tok += n
+    if start < len(texts):
+        out.append((start, len(texts)))
+    return out
+
+def _retryable(e) -> bool:
+    if isinstance(e, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+def _embed_one(texts, max_retries=EMB_MAX_RETRIES):
+    delay = 1.0
+    for attempt in range(max_retries + 1):
+        try:
+            resp = client.embeddings.create(model=EMB_MODEL, input=texts)
+            return [item.embedding for item in resp.data]
+        except Exception as e:
+            if attempt >= max_retries or not _retryable(e):
+                raise
+            wait = delay * (1 + random.random())
+            print(f"[embed] {type(e).__name__}, retry {attempt + 1}/{max_retries} in {wait:.1f}s")
+            time.sleep(wait)
+            delay = min(delay * 2, 60.0)
+
+def embed_batches(texts, batch=256, max_tokens=EMB_BATCH_TOKENS, concurrency=EMB_CONCURRENCY, on_batch=None):
+    """
+    Embed texts với tối đa `concurrency` request đồng thời.
+    on_batch(start, end, X_part) được gọi (ở thread chính) mỗi khi 1 lô xong,
+    dùng để checkpoint: crash giữa chừng thì lần chạy sau chỉ embed phần còn thiếu.
+    """
+    if not texts:
+        return np.empty((0, 0), dtype="float32")
+    spans = plan_batches(texts, batch=batch, max_tokens=max_tokens)
+    parts, error = {}, None
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futs = {pool.submit(_embed_one, texts[a:b]): (a, b) for a, b in spans}
+        for fut in as_completed(futs):
+            a, b = futs[fut]
+            try:
+                X_part = np.array(fut.result(), dtype="float32")
+            except Exception as e:
+                # vẫn thu các lô khác đang chạy để checkpoint, báo lỗi ở cuối
+                error = error or e
+                continue
+            faiss.normalize_L2(X_part)
+            parts[a] = X_part
+            if on_batch:
+                on_batch(a, b, X_part)
+            print(f"[embed] {len(parts)}/{len(spans)} batches")
+    if error is not None:
+        raise error
+    return np.vstack([parts[a] for a, _ in spans])
+
+# =============================
+# Index types: flat (exact) | ivf | ivfpq | hnsw
+# =============================
+INDEX_TYPES = ("flat", "ivf", "ivfpq", "hnsw")
+
+def default_nlist(n: int) -> int:
+    # ~4*sqrt(n) cụm, nhưng mỗi cụm cần >= 39 điểm train (khuyến nghị của faiss)
+    return max(1, min(int(4 * np.sqrt(n)), n // 39))
+
+def build_index(X, index_type="flat", nlist=None, pq_m=64, pq_nbits=8, hnsw_m=32, ef_construction=200, ids=None):
+    """
+    Tạo index inner-product (cosine với vector đã normalize) và train nếu cần.
+    Nếu truyền ids thì bọc IndexIDMap2: label trả về chính là chunk id.
+    """
+    d = X.shape[1]
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(d)
+    elif index_type in ("ivf", "ivfpq"):
+        nlist = nlist or default_nlist(X.shape[0])
+        quantizer = faiss.IndexFlatIP(d)
+        if index_type == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            if d % pq_m:
+                raise ValueError(f"dim {d} is not divisible by --pq-m {pq_m}")
+            if X.shape[0] < (1 << pq_nbits):
+                print(f"[WARN] {X.shape[0]} vectors < 2^{pq_nbits} PQ centroids; consider a smaller --pq-nbits")
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        print(f"Training {index_type} | nlist={nlist} ...")
+        index.train(X)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+    else:
+        raise ValueError(f"unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    if ids is None:
+        index.add(X)
+    else:
+        index = faiss.IndexIDMap2(index)
+        index.add_with_ids(X, np.asarray(ids, dtype="int64"))
+    # IVF: direct map build sẵn (được ghi cùng index) để reconstruct / recall_vs_exact lúc chạy
+    # không phải sửa index đang phục vụ
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index
+
+def recall_at_k(index, X, k=10, n_queries=200, seed=0, ids=None):
+    """Recall@k của index so với tìm kiếm chính xác trên X (dùng vector trong X làm query)."""
+    exact = faiss.IndexFlatIP(X.shape[1])
+    exact.add(X)
+    rng = np.random.default_rng(seed)
+    Q = X[rng.choice(X.shape[0], size=min(n_queries, X.shape[0]), replace=False)]
+    _, I_exact = exact.search(Q, k)
+    _, I_ann = index.search(Q, k)
+    labels = np.asarray(ids, dtype="int64") if ids is not None else np.arange(X.shape[0])
+    hit = sum(len(set(labels[a].tolist()) & set(b[b >= 0].tolist())) for a, b in zip(I_exact, I_ann))
+    return hit / float(I_exact.size)
+
+def write_index_atomic(index, path):
+    tmp = f"{path}.tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, path)
+
+def corpus_vectors(ids, texts, metas, store, incremental=True, concurrency=EMB_CONCURRENCY,
+                   batch_tokens=EMB_BATCH_TOKENS):
+    """
+    Vector cho toàn corpus theo thứ tự chunk: lấy từ store theo hash,
+    chỉ gọi OpenAI cho chunk có hash mới (hoặc tất cả nếu incremental=False).
+    """
+    hashes = [chunk_hash(m) for m in metas]
+    have = store.get_many(hashes) if incremental else {}
+    todo = {}
+    for h, t in zip(hashes, texts):
+        if h not in have and h not in todo:
+            todo[h] = t
+    print(f"Chunks: {len(ids)} | cached vectors: {len(hashes) - sum(h in todo for h in hashes)} | to embed: {len(todo)}")
+    if todo:
+        todo_hashes = list(todo.keys())
+
+        # checkpoint từng lô vào store ngay khi xong
+        def save(a, b, X_part):
+            store.put_many(todo_hashes[a:b], X_part)
+            have.update(zip(todo_hashes[a:b], X_part))
+
+        embed_batches(list(todo.values()), concurrency=concurrency, max_tokens=batch_tokens, on_batch=save)
+    removed = store.prune(hashes)
+    if removed:
+        print(f"Dropped {removed} vectors of removed/changed chunks")
+    return np.vstack([have[h] for h in hashes]).astype("float32")
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Build FAISS index from data/chunks.jsonl")
+    ap.add_argument("--index-type", choices=INDEX_TYPES, default=os.getenv("FAISS_INDEX_TYPE", "flat"))
+    ap.add_argument("--nlist", type=int, default=None, help="IVF: số cụm (mặc định ~4*sqrt(n))")
+    ap.add_argument("--nprobe", type=int, default=8, help="IVF: số cụm quét khi đo recall")
+    ap.add_argument("--pq-m", type=int, default=64, help="IVF-PQ: số sub-quantizer (dim phải chia hết)")
+    ap.add_argument("--pq-nbits", type=int, default=8, help="IVF-PQ: bit mỗi sub-quantizer")
+    ap.add_argument("--hnsw-m", type=int, default=32, help="HNSW: số láng giềng mỗi node")
+    ap.add_argument("--ef-construction", type=int, default=200, help="HNSW: efConstruction")
+    ap.add_argument("--ef-search", type=int, default=64, help="HNSW: efSearch khi đo recall")
+    ap.add_argument("--recall-k", type=int, default=10, help="k cho kiểm tra recall so với exact (0 = bỏ qua)")
+    ap.add_argument("--full", action="store_true", help="embed lại toàn bộ corpus (mặc định: chỉ chunk có hash mới)")
+    ap.add_argument("--vec-store", default="data/faiss.vecs.sqlite", help="kho vector hash -> embedding")
+    ap.add_argument("--out", default="data/faiss.index")
+    ap.add_argument("--concurrency", type=int, default=EMB_CONCURRENCY, help="số request embedding song song")
+    ap.add_argument("--batch-tokens", type=int, default=EMB_BATCH_TOKENS, help="số token tối đa mỗi request")
+    return ap.parse_args()
 
 if __name__ == "__main__":
-    ids, texts, _ = load_chunks()
-    X = embed_batches(texts)
-    index = faiss.IndexFlatIP(X.shape[1])  # cosine ~ inner product
-    index.add(X)
+    args = parse_args()
+    ids, texts, metas = load_chunks()
+    store = VectorStore(args.vec_store)
+    X = corpus_vectors(ids, texts, metas, store, incremental=not args.full,
+                       concurrency=args.concurrency, batch_tokens=args.batch_tokens)
+    index = build_index(
+        X,
+        index_type=args.index_type,
+        nlist=args.nlist,
+        pq_m=args.pq_m,
+        pq_nbits=args.pq_nbits,
+        hnsw_m=args.hnsw_m,
+        ef_construction=args.ef_construction,
+        ids=ids,
+    )
+
+    if args.index_type != "flat" and args.recall_k > 0:
+        ps = faiss.ParameterSpace()
+        if args.index_type == "hnsw":
+            ps.set_index_parameter(index, "efSearch", args.ef_search)
+        else:
+            ps.set_index_parameter(index, "nprobe", args.nprobe)
+        print(f"recall@{args.recall_k} vs exact: {recall_at_k(index, X, k=args.recall_k, ids=ids):.3f}")
 
-    # ✅ GHI ĐÚNG CÁCH: truyền cả index lẫn đường dẫn
-    faiss.write_index(index, "data/faiss.index")
-    np.save("data/faiss.ids.npy", np.array(ids, dtype="int64"))
+    # IndexIDMap2 giữ chunk id trong index → không cần faiss.ids.npy nữa; ghi tmp rồi rename
+    write_index_atomic(index, args.out)
 
-    print("Saved: data/faiss.index & data/faiss.ids.npy | dim:", X.shape[1], "| nvecs:", X.shape[0])
+    print(f"Saved: {args.out} | type: {args.index_type} + IDMap2 | dim:", X.shape[1], "| nvecs:", X.shape[0])
@@ -1,7 +1,13 @@
-import json, re
+import os, sys, json, re
 from collections import defaultdict
 from typing import Dict, Any, List
 
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app.chunk_store import file_digest  # noqa: E402
+from app.graph_retriever import write_graph_bin  # noqa: E402
+
 DISEASE_KEYS = {
     "d:chlamydia": ["chlamydia"],
     "d:gonorrhea": ["gonorrhea", "gonorrhoea", "lậu"],
@@ -13,6 +19,55 @@ DISEASE_KEYS = {
     "d:hepatitis_b": ["hepatitis b", "hbv"],
 }
 
+# Thực thể có kiểu (Symptom / Test / Drug) nhận diện bằng từ khoá (EN + VI), khớp theo ranh giới từ.
+# Bệnh và thực thể cùng xuất hiện trong 1 chunk -> cạnh 2 chiều, evidence là các chunk đó.
+SYMPTOM_KEYS = {
+    "sym:discharge": ["discharge", "khí hư", "tiết dịch", "chảy mủ", "dịch mủ"],
+    "sym:painful_urination": ["painful urination", "burning sensation", "pain when urinating",
+                              "tiểu buốt", "tiểu rát", "tiểu đau", "đi tiểu đau"],
+    "sym:sores": ["sore", "sores", "ulcer", "chancre", "vết loét", "săng giang mai", "lở loét"],
+    "sym:blisters": ["blister", "blisters", "mụn nước", "phỏng nước"],
+    "sym:warts": ["wart", "warts", "mụn cóc", "sùi mào gà", "mụn sùi"],
+    "sym:rash": ["rash", "phát ban", "nổi ban"],
+    "sym:itching": ["itching", "itchy", "ngứa"],
+    "sym:pelvic_pain": ["pelvic pain", "abdominal pain", "đau bụng dưới", "đau vùng chậu"],
+    "sym:bleeding": ["bleeding", "chảy máu", "xuất huyết"],
+    "sym:fever": ["fever", "sốt"],
+    "sym:swollen_lymph_nodes": ["swollen lymph nodes", "swollen glands", "sưng hạch", "nổi hạch"],
+    "sym:jaundice": ["jaundice", "vàng da"],
+    "sym:fatigue": ["fatigue", "tiredness", "mệt mỏi"],
+}
+TEST_KEYS = {
+    "test:naat": ["naat", "nucleic acid amplification", "pcr"],
+    "test:blood_test": ["blood test", "serology", "xét nghiệm máu", "huyết thanh"],
+    "test:urine_test": ["urine test", "urine sample", "xét nghiệm nước tiểu", "mẫu nước tiểu"],
+    "test:swab": ["swab", "que lấy mẫu", "phết dịch"],
+    "test:rpr_vdrl": ["rpr", "vdrl", "treponemal"],
+    "test:pap_test": ["pap test", "pap smear", "phết tế bào", "xét nghiệm pap"],
+    "test:culture": ["culture", "nuôi cấy"],
+    "test:rapid_test": ["rapid test", "test nhanh", "xét nghiệm nhanh"],
+}
+DRUG_KEYS = {
+    "drug:antibiotics": ["antibiotic", "antibiotics", "kháng sinh"],
+    "drug:ceftriaxone": ["ceftriaxone"],
+    "drug:azithromycin": ["azithromycin"],
+    "drug:doxycycline": ["doxycycline"],
+    "drug:penicillin": ["penicillin", "benzathine"],
+    "drug:metronidazole": ["metronidazole", "tinidazole"],
+    "drug:antivirals": ["antiviral", "antivirals", "acyclovir", "valacyclovir", "famciclovir", "kháng virus"],
+    "drug:art": ["antiretroviral", "art", "arv", "prep", "pep"],
+    "drug:hpv_vaccine": ["hpv vaccine", "gardasil", "vắc xin hpv", "vaccine hpv"],
+    "drug:hbv_vaccine": ["hepatitis b vaccine", "vắc xin viêm gan b", "vaccine viêm gan b"],
+}
+# (type node, lexicon, rel bệnh -> thực thể, rel thực thể -> bệnh)
+ENTITY_LEXICONS = [
+    ("Symptom", SYMPTOM_KEYS, "has_symptom", "symptom_of"),
+    ("Test", TEST_KEYS, "diagnosed_by", "detects"),
+    ("Drug", DRUG_KEYS, "treated_by", "treats"),
+]
+# cạnh thực thể nhẹ hơn cạnh section: 1 chunk liệt kê nhiều triệu chứng không được lấn át mọi chunk khác
+ENTITY_EDGE_WEIGHT = 0.35
+
 SEC2REL = {
     "Symptoms": "has_symptom",
     "Diagnosis": "diagnosed_by",
@@ -31,15 +86,32 @@ def detect_disease(title: str, url: str, text: str) -> List[str]:
             match.append(nid)
     return match
 
+def compile_lexicon(keys: Dict[str, List[str]]) -> Dict[str, "re.Pattern"]:
+    return {
+        nid: re.compile(r"(?<!\w)(?:" + "|".join(re.escape(k) for k in sorted(ks, key=len, reverse=True)) + r")(?!\w)")
+        for nid, ks in keys.items()
+    }
+
+def detect_entities(patterns: Dict[str, "re.Pattern"], text: str) -> List[str]:
+    s = (text or "").lower()
+    return [nid for nid, pat in patterns.items() if pat.search(s)]
+
+def add_edge(adj, src: str, dst: str, rel: str, weight: float, cid: int) -> None:
+    edge = adj[src].setdefault((dst, rel), {"dst": dst, "rel": rel, "weight": weight, "evidence": []})
+    edge["evidence"].append(cid)
+
 def main():
     # input/output
     chunks_path = "data/chunks.jsonl"
     graph_path  = "data/graph.json"
+    graph_bin_path = "data/graph.bin"
     nodes = {}
     for nid in DISEASE_KEYS.keys():
         nodes[nid] = {"type": "Disease", "name": nid.split(":")[1]}
+    lexicons = [(ntype, compile_lexicon(keys), fwd, back) for ntype, keys, fwd, back in ENTITY_LEXICONS]
 
-    adj = defaultdict(list)  # src -> List[edge]
+    # src -> {(dst, rel): edge}; 1 cạnh cho mỗi (src, dst, rel), evidence gộp theo thứ tự chunk
+    adj = defaultdict(dict)
 
     # read chunks
     with open(chunks_path, "r", encoding="utf-8") as f:
@@ -54,18 +126,34 @@ def main():
             # For simplicity, dst is a pseudo-node encoding section name
             dst = f"sec:{sec.lower()}"
             nodes.setdefault(dst, {"type":"Section","name":sec})
+            cid = int(ch["id"])
             for d in diseases:
-                # append evidence chunk_id
-                edge = {"dst": dst, "rel": rel, "weight": 1.0, "evidence": [int(ch["id"])]}
-                adj[d].append(edge)
+                # weight là trọng số trên MỖI evidence (retriever cộng điểm theo từng chunk)
+                add_edge(adj, d, dst, rel, 1.0, cid)
+            # Disease <-> Symptom / Test / Drug cùng xuất hiện trong chunk
+            text = " ".join([ch.get("title", ""), ch.get("text", "")])
+            for ntype, patterns, fwd, back in lexicons:
+                for ent in detect_entities(patterns, text):
+                    nodes.setdefault(ent, {"type": ntype, "name": ent.split(":", 1)[1]})
+                    for d in diseases:
+                        add_edge(adj, d, ent, fwd, ENTITY_EDGE_WEIGHT, cid)
+                        add_edge(adj, ent, d, back, ENTITY_EDGE_WEIGHT, cid)
 
-    graph = {"nodes": nodes, "adj": adj}
-    # convert defaultdict to normal dict
-    graph["adj"] = {k:v for k,v in graph["adj"].items()}
+    graph = {"nodes": nodes, "adj": {k: list(v.values()) for k, v in adj.items()}}
 
     with open(graph_path, "w", encoding="utf-8") as f:
         json.dump(graph, f, ensure_ascii=False, indent=2)
-    print(f"Graph saved -> {graph_path} | nodes={len(nodes)} | srcs={len(graph['adj'])}")
+    n_edges = sum(len(v) for v in graph["adj"].values())
+    n_ev = sum(len(e["evidence"]) for v in graph["adj"].values() for e in v)
+    types = defaultdict(int)
+    for n in nodes.values():
+        types[n["type"]] += 1
+    print(f"Graph saved -> {graph_path} | nodes={len(nodes)} {dict(types)} | srcs={len(graph['adj'])} "
+          f"| edges={n_edges} | evidence={n_ev}")
+
+    # bản CSR nhị phân cho backend (mmap, không parse JSON); src_size / digest để phát hiện file cũ
+    write_graph_bin(graph, graph_bin_path, src_size=os.path.getsize(graph_path), src_digest=file_digest(graph_path))
+    print(f"Graph saved -> {graph_bin_path} | size: {os.path.getsize(graph_bin_path)} bytes")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,238 @@
+# dedup_chunks.py — loại bỏ boilerplate lặp lại & chunk gần trùng trong data/chunks.jsonl
+#
+# 2 bước, chạy sau build_chunks.py (hoặc build_chunks.py --dedup):
+#   1) Câu lặp: câu (đã chuẩn hoá) xuất hiện ở >= --min-sources nguồn khác nhau
+#      (vd. "An official website of the United States government ...") chỉ giữ lần xuất hiện
+#      đầu tiên (chunk id nhỏ nhất), các lần lặp sau bị cắt khỏi chunk; chunk còn < --min-chars
+#      ký tự thì bỏ luôn. Không xoá hẳn câu nào: lời khuyên lâm sàng lặp trên nhiều trang
+#      bệnh (vd. MedlinePlus) vẫn còn 1 bản trong corpus.
+#   2) Gần trùng: MinHash (shingle 3 từ) + LSH theo band để lấy ứng viên, xác nhận bằng
+#      Jaccard thật >= --threshold. Giữ chunk id nhỏ hơn, bỏ chunk sau.
+# Chunk bị sửa text được tính lại "hash" (cùng công thức build_chunks.py). id giữ nguyên.
+# Báo cáo những gì đã bỏ -> data/dedup_report.json.
+#
+#   python scripts/dedup_chunks.py [--src data/chunks.jsonl] [--dst data/chunks.jsonl] [--dry-run]
+# Sau đó build lại chunks.bin / bm25.idx / faiss.index / graph.json.
+import os
+import re
+import json
+import zlib
+import hashlib
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+_SENT_RE = re.compile(r"\S.*?(?:[.!?…](?=\s|$)|$)")
+_TOKEN_RE = re.compile(r"[a-zA-Z0-9À-ỹ]+")
+_PRIME = 4294967311     # số nguyên tố > 2^32 cho họ hash (a*x + b) mod p
+
+# ---------------------------
+# Boilerplate sentences
+# ---------------------------
+def sentence_key(s: str) -> str:
+    return " ".join(_TOKEN_RE.findall(s.lower()))
+
+def find_boilerplate(chunks, min_sources: int = 3, min_chars: int = 30):
+    """Câu xuất hiện ở >= min_sources nguồn khác nhau -> {key: {"text", "sources", "chunks"}}."""
+    seen = defaultdict(lambda: {"text": None, "sources": set(), "chunks": []})
+    for c in chunks:
+        for m in _SENT_RE.finditer(c.get("text", "")):
+            if len(m.group(0)) < min_chars:
+                continue
+            key = sentence_key(m.group(0))
+            if not key:
+                continue
+            e = seen[key]
+            if e["text"] is None:
+                e["text"] = m.group(0)
+            e["sources"].add(c.get("source", ""))
+            e["chunks"].append(c["id"])
+    return {k: e for k, e in seen.items() if len(e["sources"]) >= min_sources}
+
+def strip_sentences(text: str, keys, seen=None) -> str:
+    """
+    Cắt các câu có key trong `keys`, giữ nguyên phần còn lại (kể cả ngắt đoạn).
+    Có `seen` (set, được cập nhật): chỉ cắt câu có key đã gặp trước đó — lần đầu được giữ.
+    """
+    pieces, pos = [], 0
+    for m in _SENT_RE.finditer(text):
+        key = sentence_key(m.group(0))
+        if key not in keys:
+            continue
+        if seen is not None and key not in seen:
+            seen.add(key)
+            continue
+        pieces.append(text[pos:m.start()])
+        pos = m.end()
+        while pos < len(text) and text[pos] in " \t":
+            pos += 1
+    if not pieces:
+        return text
+    pieces.append(text[pos:])
+    return re.sub(r"[ \t]{2,}", " ", "".join(pieces)).strip()
+
+# ---------------------------
+# MinHash + LSH
+# ---------------------------
+def shingles(text: str, n: int = 3) -> set:
+    toks = _TOKEN_RE.findall(text.lower())
+    if len(toks) < n:
+        return {" ".join(toks)} if toks else set()
+    return {" ".join(toks[i:i + n]) for i in range(len(toks) - n + 1)}
+
+class MinHashLSH:
+    """
+    Chữ ký MinHash num_perm hàm (a*x + b) mod p trên crc32 của shingle (ổn định giữa các lần chạy),
+    chia thành `bands` band; 2 chunk trùng ít nhất 1 band thì là ứng viên.
+    Ngưỡng ứng viên xấp xỉ (1/bands)^(1/rows) — để thấp hơn --threshold, rồi xác nhận bằng Jaccard thật.
+    """
+
+    def __init__(self, num_perm: int = 128, bands: int = 32, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.buckets = [defaultdict(list) for _ in range(bands)]
+
+    def signature(self, sh: set) -> np.ndarray:
+        x = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in sh), dtype=np.uint64, count=len(sh))
+        return ((self.a[:, None] * x[None, :] + self.b[:, None]) % _PRIME).min(axis=1)
+
+    def _bands(self, sig: np.ndarray):
+        for i in range(self.bands):
+            yield i, sig[i * self.rows:(i + 1) * self.rows].tobytes()
+
+    def candidates(self, sig: np.ndarray) -> set:
+        out = set()
+        for i, key in self._bands(sig):
+            out.update(self.buckets[i].get(key, ()))
+        return out
+
+    def add(self, key, sig: np.ndarray) -> None:
+        for i, band in self._bands(sig):
+            self.buckets[i][band].append(key)
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+# ---------------------------
+# Pipeline
+# ---------------------------
+def chunk_hash(c) -> str:
+    return hashlib.sha1((c.get("title", "") + c.get("source", "") + c.get("text", "")).encode("utf-8")).hexdigest()[:16]
+
+def dedup(chunks, threshold: float = 0.8, min_sources: int = 3, min_chars: int = 60,
+          num_perm: int = 128, bands: int = 32):
+    """Trả về (chunks còn lại theo thứ tự cũ, report)."""
+    boiler = find_boilerplate(chunks, min_sources=min_sources)
+    report = {
+        "input_chunks": len(chunks),
+        "boilerplate_sentences": [
+            {"text": e["text"], "sources": len(e["sources"]), "chunks": len(e["chunks"]),
+             "kept": min(e["chunks"], key=int)}
+            for e in sorted(boiler.values(), key=lambda e: -len(e["chunks"]))
+        ],
+        "stripped": [],
+        "emptied": [],
+        "near_duplicates": [],
+    }
+
+    # duyệt theo id để lần xuất hiện được giữ luôn là chunk id nhỏ nhất, output giữ thứ tự cũ
+    stripped, seen = {}, set()
+    for c in sorted(chunks, key=lambda c: int(c["id"])):
+        if boiler:
+            stripped[c["id"]] = strip_sentences(c.get("text", ""), boiler, seen)
+
+    cleaned = []
+    for c in chunks:
+        text = stripped.get(c["id"], c.get("text", ""))
+        if text != c.get("text", ""):
+            if len(text) < min_chars:
+                report["emptied"].append({"id": c["id"], "source": c.get("source", "")})
+                continue
+            c = dict(c, text=text)
+            c["hash"] = chunk_hash(c)
+            # offset cửa sổ không còn khớp text -> không ghép lại với chunk kề được nữa
+            for f in ("seq", "start", "end"):
+                c.pop(f, None)
+            report["stripped"].append(c["id"])
+        cleaned.append(c)
+
+    lsh = MinHashLSH(num_perm=num_perm, bands=bands)
+    kept, kept_sh = [], {}
+    for c in sorted(cleaned, key=lambda c: int(c["id"])):
+        sh = shingles(c.get("text", ""))
+        if not sh:
+            kept.append(c)
+            continue
+        sig = lsh.signature(sh)
+        best, best_sim = None, 0.0
+        for cid in lsh.candidates(sig):
+            sim = jaccard(sh, kept_sh[cid])
+            if sim > best_sim:
+                best, best_sim = cid, sim
+        if best is not None and best_sim >= threshold:
+            report["near_duplicates"].append({
+                "dropped": c["id"], "kept": best, "similarity": round(best_sim, 4),
+                "source": c.get("source", ""),
+            })
+            continue
+        lsh.add(c["id"], sig)
+        kept_sh[c["id"]] = sh
+        kept.append(c)
+
+    keep_ids = {c["id"] for c in kept}
+    out = [c for c in cleaned if c["id"] in keep_ids]
+    report["output_chunks"] = len(out)
+    return out, report
+
+def dedup_file(src: str, dst: str, report_path: str = "data/dedup_report.json", dry_run: bool = False, **kw):
+    chunks = []
+    with open(src, "r", encoding="utf-8") as f:
+        for ln in f:
+            ln = ln.strip()
+            if ln:
+                chunks.append(json.loads(ln))
+
+    out, report = dedup(chunks, **kw)
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"[Dedup] {report['input_chunks']} -> {report['output_chunks']} chunks | "
+          f"boilerplate sentences: {len(report['boilerplate_sentences'])} "
+          f"(stripped from {len(report['stripped'])} chunks, {len(report['emptied'])} emptied) | "
+          f"near-duplicates: {len(report['near_duplicates'])}")
+    print(f"[Dedup] report -> {report_path}")
+    if dry_run:
+        return report
+
+    tmp = dst + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for c in out:
+            f.write(json.dumps(c, ensure_ascii=False) + "\n")
+    os.replace(tmp, dst)
+    print(f"[Dedup] wrote {dst} — rebuild chunks.bin / bm25.idx / faiss.index / graph.json")
+    return report
+
+def main():
+    ap = argparse.ArgumentParser(description="Remove boilerplate sentences and near-duplicate chunks")
+    ap.add_argument("--src", default="data/chunks.jsonl")
+    ap.add_argument("--dst", default=None, help="mặc định ghi đè --src")
+    ap.add_argument("--report", default="data/dedup_report.json")
+    ap.add_argument("--threshold", type=float, default=0.8, help="Jaccard (shingle 3 từ) để coi là gần trùng")
+    ap.add_argument("--min-sources", type=int, default=3, help="câu lặp ở >= N nguồn: chỉ giữ lần xuất hiện đầu")
+    ap.add_argument("--min-chars", type=int, default=60, help="bỏ chunk ngắn hơn sau khi cắt boilerplate")
+    ap.add_argument("--num-perm", type=int, default=128)
+    ap.add_argument("--bands", type=int, default=32)
+    ap.add_argument("--dry-run", action="store_true", help="chỉ ghi báo cáo, không sửa chunks.jsonl")
+    args = ap.parse_args()
+    dedup_file(args.src, args.dst or args.src, report_path=args.report, dry_run=args.dry_run,
+               threshold=args.threshold, min_sources=args.min_sources, min_chars=args.min_chars,
+               num_perm=args.num_perm, bands=args.bands)
+
+if __name__ == "__main__":
+    main()
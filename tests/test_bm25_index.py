@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""bm25.idx chỉ được dùng khi build từ đúng corpus của ChunkStore."""
+import json
+
+from app.bm25_index import BM25Index, BM25Store, _tok
+from app.chunk_store import ChunkStore
+
+
+def _store(tmp_path, texts, name="chunks.jsonl"):
+    src = tmp_path / name
+    src.write_text("".join(json.dumps({"id": i, "text": t}) + "\n" for i, t in enumerate(texts)), encoding="utf-8")
+    return ChunkStore.from_jsonl(str(src))
+
+
+def _save(tmp_path, store):
+    path = str(tmp_path / "bm25.idx")
+    BM25Index.build([_tok(t) for t in store.texts()]).save(path, store.ids, digest=store.digest)
+    return path
+
+
+def test_prebuilt_index_is_used_for_same_corpus(tmp_path):
+    store = _store(tmp_path, ["giang mai lây qua đường tình dục", "viêm gan b lây qua máu"])
+    path = _save(tmp_path, store)
+    bm25 = BM25Store(store, path)
+    assert bm25.index.digest == store.digest
+    assert bm25.search("viêm gan", k=1)[0]["id"] == 1
+
+
+def test_recrawl_with_same_chunk_count_rebuilds(tmp_path):
+    old = _store(tmp_path, ["giang mai lây qua đường tình dục", "viêm gan b lây qua máu"])
+    path = _save(tmp_path, old)
+    new = _store(tmp_path, ["hiv lây qua máu", "lậu điều trị bằng kháng sinh"], name="recrawl.jsonl")
+    bm25 = BM25Store(new, path)
+    assert bm25.index.digest is None            # index dựng lại trong RAM
+    assert bm25.search("kháng sinh", k=1)[0]["id"] == 1
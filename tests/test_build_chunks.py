@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Test cho pipeline làm sạch / parse HTML dạng stream của scripts/build_chunks.py."""
+import json
+import pathlib
+import sys
+import tracemalloc
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
+import build_chunks  # noqa: E402
+
+FIXTURES = pathlib.Path(__file__).resolve().parent / "fixtures" / "normalizer"
+# golden.json sinh từ bản clean_text/split_paragraphs trước khi normalizer được biên dịch sẵn
+# (vòng re.sub theo từng STOP_PHRASES); output hiện tại phải trùng từng byte
+GOLDEN = json.loads((FIXTURES / "golden.json").read_text(encoding="utf-8"))
+
+
+@pytest.mark.parametrize("name", sorted(GOLDEN))
+def test_normalizer_matches_golden(name):
+    raw = (FIXTURES / name).read_bytes().decode("utf-8")
+    cleaned = build_chunks.clean_text(raw)
+    assert cleaned == GOLDEN[name]["clean_text"]
+    assert build_chunks.split_paragraphs(cleaned) == GOLDEN[name]["split_paragraphs"]
+
+
+def _blocks(html, **kw):
+    parser = build_chunks._BlockParser(**kw)
+    parser.feed(html)
+    parser.close()
+    return [t for kind, t in parser.events if kind == "block"]
+
+
+def test_implied_end_tags():
+    assert _blocks("<p>a<p>b<p>c") == ["a", "b", "c"]
+    assert _blocks("<ul><li>a<li>b</ul><p>x") == ["a", "b", "x"]
+    assert _blocks("<li><p>a<p>b</li>") == ["a b", "a", "b"]
+    assert _blocks("<ul><li>a<ul><li>b<li>c</ul>d<li>e</ul>") == ["a b c d", "b", "c", "e"]
+    assert _blocks("<h2>a<h3>b</h3></h2>") == ["a", "b"]
+
+
+def test_unclosed_blocks_bounded_memory():
+    words = " ".join(f"w{i}" for i in range(10))
+    for tag in ("<p>", "<li>", "<ul><li>"):
+        html = "<html><body>" + "".join(tag + words for _ in range(3000)) + "</body></html>"
+        tracemalloc.start()
+        try:
+            for _ in build_chunks.iter_html_events([html[i:i + 4096] for i in range(0, len(html), 4096)]):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert peak < 8 << 20, tag      # trước đây ~400 MB với trang ~0.25 MB
+
+
+def test_partial_flush_keeps_text_order():
+    html = "<li>" + "w" * 70 + "<p>" + "x " * 10 + "</p>y</li>"
+    blocks = _blocks(html, max_buffer=60)
+    assert blocks == ["w" * 70, "x x x x x x x x x x y", "x x x x x x x x x x"]
+    assert _blocks("<ul><li>a" * 5 + "z", max_depth=2) == ["a a a a az", "a a a az"]
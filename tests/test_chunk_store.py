@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""ChunkStore / chunks.bin: round-trip và phát hiện chunks.bin cũ."""
+import json
+
+from app.chunk_store import ChunkStore, MmapChunkStore, file_digest, load_chunk_store, write_chunk_bin
+
+RECORDS = [{"id": i, "title": "t", "section": "s", "text": f"chunk {i} text"} for i in range(5)]
+
+
+def _build(tmp_path, records):
+    src, dst = tmp_path / "chunks.jsonl", tmp_path / "chunks.bin"
+    src.write_text("".join(json.dumps(r) + "\n" for r in records), encoding="utf-8")
+    write_chunk_bin(records, str(dst), src_size=src.stat().st_size, src_digest=file_digest(str(src)))
+    return src, dst
+
+
+def test_fresh_bin_is_used(tmp_path):
+    src, dst = _build(tmp_path, RECORDS)
+    store = load_chunk_store(str(src), str(dst))
+    assert isinstance(store, MmapChunkStore)
+    assert store.digest == ChunkStore.from_jsonl(str(src)).digest == file_digest(str(src))
+    assert [store.text(r) for r in range(len(store))] == [r["text"] for r in RECORDS]
+
+
+def test_same_size_edit_makes_bin_stale(tmp_path):
+    src, dst = _build(tmp_path, RECORDS)
+    edited = [dict(r, text=r["text"].replace("text", "TEXT")) for r in RECORDS]
+    src.write_text("".join(json.dumps(r) + "\n" for r in edited), encoding="utf-8")
+    store = load_chunk_store(str(src), str(dst))
+    assert not isinstance(store, MmapChunkStore)
+    assert store.text(0) == "chunk 0 TEXT"
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Test cho scripts/dedup_chunks.py: câu lặp giữ lại 1 bản, MinHash bỏ chunk gần trùng."""
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
+import dedup_chunks  # noqa: E402
+
+ADVICE = "The most reliable way to avoid infection is to not have anal, vaginal, or oral sex."
+BANNER = "An official website of the United States government, here is how you know."
+
+
+def _chunk(cid, source, text):
+    return {"id": cid, "title": f"t{cid}", "source": source, "text": text}
+
+
+def _count(chunks, sentence):
+    key = dedup_chunks.sentence_key(sentence)
+    return sum(
+        dedup_chunks.sentence_key(m.group(0)) == key
+        for c in chunks for m in dedup_chunks._SENT_RE.finditer(c["text"])
+    )
+
+
+def test_repeated_sentence_survives_once():
+    diseases = ["gonorrhea", "syphilis", "chlamydia", "herpes", "trichomoniasis"]
+    chunks = [
+        _chunk(i, f"https://medlineplus.gov/{d}.html",
+               f"{BANNER} {d.capitalize()} is a sexually transmitted infection with its own symptoms "
+               f"and treatment. {ADVICE} Ask your provider how {d} is tested.")
+        for i, d in enumerate(diseases)
+    ]
+    out, report = dedup_chunks.dedup(list(reversed(chunks)))
+
+    # mỗi câu lặp còn đúng 1 bản, nằm ở chunk id nhỏ nhất
+    assert _count(out, ADVICE) == 1
+    assert _count(out, BANNER) == 1
+    first = next(c for c in out if c["id"] == 0)
+    assert ADVICE in first["text"] and BANNER in first["text"]
+    assert all(e["kept"] == 0 for e in report["boilerplate_sentences"])
+
+    # phần riêng của từng trang không bị đụng tới, không chunk nào bị bỏ
+    assert sorted(c["id"] for c in out) == list(range(len(diseases)))
+    for c in out:
+        assert c["text"].endswith(f"Ask your provider how {diseases[c['id']]} is tested.")
+    assert sorted(report["stripped"]) == [1, 2, 3, 4]
+    # thứ tự output giữ như input
+    assert [c["id"] for c in out] == [4, 3, 2, 1, 0]
+
+
+def test_sentence_below_min_sources_is_untouched():
+    chunks = [_chunk(i, f"https://example.org/{i}", f"{ADVICE} Page number {i} has more to say here.")
+              for i in range(2)]
+    out, report = dedup_chunks.dedup(chunks, min_sources=3)
+    assert out == chunks
+    assert report["boilerplate_sentences"] == [] and report["stripped"] == []
+
+
+def test_near_duplicate_dropped_keeps_lowest_id():
+    base = ("Chlamydia is a common sexually transmitted infection that can be cured with antibiotics. "
+            "Many people have no symptoms, so testing every year is recommended for sexually active "
+            "women younger than 25 and for older women with new or multiple partners.")
+    near = base.replace("every year", "each year")
+    other = ("Hepatitis B is a liver infection caused by a virus; a safe vaccine prevents it and is "
+             "recommended for all infants at birth and for adults at increased risk.")
+    chunks = [_chunk(7, "https://a.example/x", near), _chunk(3, "https://b.example/y", base),
+              _chunk(9, "https://c.example/z", other)]
+    assert dedup_chunks.jaccard(dedup_chunks.shingles(base), dedup_chunks.shingles(near)) >= 0.8
+
+    out, report = dedup_chunks.dedup(chunks, threshold=0.8)
+    assert [c["id"] for c in out] == [3, 9]
+    [dup] = report["near_duplicates"]
+    assert dup["dropped"] == 7 and dup["kept"] == 3 and dup["similarity"] >= 0.8
+
+    # dưới ngưỡng thì giữ cả hai
+    out, report = dedup_chunks.dedup(chunks, threshold=0.99)
+    assert [c["id"] for c in out] == [7, 3, 9]
+    assert report["near_duplicates"] == []
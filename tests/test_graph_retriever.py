@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Regression test cho graph.bin, entity linking và best-first + dừng sớm của expand_and_collect."""
+import json
+import random
+
+from app.chunk_store import ChunkStore, file_digest
+from app.graph_retriever import GraphCSR, entity_link, expand_and_collect, invalidate_linker, load_graph, write_graph_bin
+
+
+def _chunks(n=60):
+    return ChunkStore([{"id": i, "title": f"t{i}", "section": "s", "text": f"chunk {i} sốt ho {i % 7}"}
+                       for i in range(n)])
+
+
+ALIAS = {
+    "d:gonorrhea": {"name": "Gonorrhea", "aliases": ["gonorrhea", "gonorrhoea", "lậu"]},
+    "d:syphilis": {"name": "Syphilis", "aliases": ["syphilis", "giang mai"]},
+    "d:hiv": {"name": "HIV", "aliases": ["human immunodeficiency virus"]},
+}
+
+
+def test_unaccented_single_syllable_does_not_link():
+    # "lau" không dấu không được khớp alias 1 âm tiết "lậu"
+    for q in ("benh nay keo dai bao lau", "uong thuoc bao lau thi khoi", "lau chua"):
+        assert entity_link(q, ALIAS) == [], q
+    assert entity_link("bệnh lậu kéo dài bao lâu", ALIAS) == [("d:gonorrhea", 100.0)]
+    assert entity_link("trieu chung giang mai", ALIAS) == [("d:syphilis", 100.0)]
+
+
+def test_linker_cache_follows_alias_map():
+    alias = {"d:syphilis": {"name": "giang mai"}}
+    assert entity_link("hiv", alias) == []
+    alias["d:hiv"] = {"name": "HIV"}                 # thêm node: tự dựng lại
+    assert entity_link("hiv", alias) == [("d:hiv", 100.0)]
+    alias["d:hiv"]["aliases"] = ["aids"]             # sửa tại chỗ: invalidate_linker
+    invalidate_linker(alias)
+    assert entity_link("aids", alias) == [("d:hiv", 100.0)]
+
+
+def _edge(dst, ev, w):
+    return {"dst": dst, "rel": "x", "weight": w, "evidence": ev}
+
+
+def test_queued_node_repushed_at_higher_priority():
+    # P1 (từ S1) đẩy X vào heap với prio thấp; S2 -> P2 đẩy lại X với prio cao hơn,
+    # X -> Y (weight 1.0) mang chunk cX lên đầu -> dừng sớm không được chốt cA
+    cA, cX, cB, cD = 0, 1, 2, 3
+    adj = {
+        "S1": [_edge("P1", [cA], 0.1)],
+        "S2": [_edge("P2", [cB], 0.05)],
+        "P2": [_edge("X", [cB], 0.01)],
+        "P1": [_edge("X", [cD], 0.01)] + [_edge(f"D{i}", [cD], 0.01) for i in range(7)],
+        "X": [_edge("Y", [cX], 1.0)] + [_edge(f"D{i}", [cD], 0.01) for i in range(7)],
+    }
+    graph = {"nodes": {}, "adj": adj}
+    chunks = _chunks()
+    seeds = [("S1", 100), ("S2", 82)]
+    full = expand_and_collect(seeds, graph, chunks, budget=100, topk=len(chunks) + 1, max_hops=2)
+    top1 = expand_and_collect(seeds, graph, chunks, budget=100, topk=1, max_hops=2)
+    assert full[0]["id"] == cX
+    assert [h["id"] for h in top1] == [cX]
+
+
+def test_early_stop_keeps_full_run_topk():
+    chunks = _chunks()
+    for trial in range(300):
+        rnd = random.Random(trial)
+        nodes = [f"n{i}" for i in range(rnd.randint(4, 20))]
+        adj = {
+            a: [_edge(b, rnd.sample(range(40), rnd.randint(1, 6)), rnd.random())
+                for b in rnd.sample(nodes, rnd.randint(0, min(8, len(nodes)))) if b != a]
+            for a in nodes
+        }
+        graph = {"nodes": {}, "adj": adj}
+        seeds = [(s, rnd.randint(40, 100)) for s in rnd.sample(nodes, rnd.randint(1, 3))]
+        k, hops = rnd.randint(1, 5), rnd.randint(1, 3)
+        got = expand_and_collect(seeds, graph, chunks, topk=k, query="sốt ho", max_hops=hops)
+        full = expand_and_collect(seeds, graph, chunks, topk=len(chunks) + 1, query="sốt ho", max_hops=hops)
+        scores = [h["score"] for h in full]
+        if len(scores) > k and abs(scores[k - 1] - scores[k]) < 1e-9:
+            continue    # hoà ở vị trí k: tập top-k không duy nhất
+        assert {h["id"] for h in got} == {h["id"] for h in full[:k]}, trial
+
+
+def test_graph_bin_same_size_edit_is_stale(tmp_path):
+    graph = {"nodes": {}, "adj": {"d:a": [_edge("sec:x", [1, 2], 1.0)]}}
+    src, dst = tmp_path / "graph.json", tmp_path / "graph.bin"
+    src.write_text(json.dumps(graph), encoding="utf-8")
+    write_graph_bin(graph, str(dst), src_size=src.stat().st_size, src_digest=file_digest(str(src)))
+    assert isinstance(load_graph(str(src), str(dst)), GraphCSR)
+    src.write_text(json.dumps(graph).replace("1.0", "2.0"), encoding="utf-8")
+    loaded = load_graph(str(src), str(dst))
+    assert isinstance(loaded, dict) and loaded["adj"]["d:a"][0]["weight"] == 2.0
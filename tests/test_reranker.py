@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""RerankStage: giữ thứ tự RRF khi quá budget, cache theo (hash query, chunk id), khoá cửa sổ ghép."""
+import asyncio
+import threading
+import time
+
+import numpy as np
+
+from app.embed_cache import cache_key
+from app.reranker import RerankStage, _hit_key
+
+
+class _Scorer:
+    """Điểm = giá trị "s" của hit; đếm số hit đã chấm, có thể chậm."""
+
+    name = "fake"
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.seen = []
+        self.done = threading.Event()
+
+    def score(self, query, hits):
+        time.sleep(self.delay)
+        self.seen.extend(_hit_key(h) for h in hits)
+        self.done.set()
+        return np.array([h["s"] for h in hits], dtype=np.float64)
+
+
+def _hits(*scores):
+    return [{"id": i, "text": f"t{i}", "s": s} for i, s in enumerate(scores)]
+
+
+def test_rerank_orders_by_score():
+    stage = RerankStage(_Scorer(), budget_ms=0, prior_weight=0.0, section_weight=0.0)
+    out, info = stage.rerank("q", _hits(0.1, 0.9, 0.5))
+    assert [h["id"] for h in out] == [1, 2, 0]
+    assert info["fallback"] is None and info["model"] == "fake"
+
+
+def test_arerank_timeout_keeps_rrf_order():
+    scorer = _Scorer(delay=0.5)
+    stage = RerankStage(scorer, budget_ms=30, prior_weight=0.0, section_weight=0.0)
+    hits = _hits(0.1, 0.9, 0.5)
+    out, info = asyncio.run(stage.arerank("q", hits))
+    assert out is hits
+    assert all("rerank" not in h for h in out)
+    assert info["fallback"] == "timeout"
+    assert stage.snapshot()["timeouts"] == 1
+
+    # lô đang chấm vẫn chạy xong và vào cache -> lần sau không cần chấm lại
+    assert scorer.done.wait(5)
+    deadline = time.monotonic() + 5
+    while stage.snapshot()["size"] < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    scorer.delay = 0.0
+    out, info = asyncio.run(stage.arerank("q", hits))
+    assert info["fallback"] is None
+    assert [h["id"] for h in out] == [1, 2, 0]
+    assert scorer.seen == ["0", "1", "2"]
+
+
+def test_cache_keyed_by_query_hash_and_chunk_id():
+    scorer = _Scorer()
+    stage = RerankStage(scorer, budget_ms=0)
+    hits = _hits(0.1, 0.9, 0.5)
+    stage.rerank("giang mai", hits)
+    assert set(stage._cache) == {(cache_key("fake", "giang mai"), str(i)) for i in range(3)}
+
+    stage.rerank("giang mai", hits[::-1])
+    assert len(scorer.seen) == 3
+    assert stage.snapshot()["cached"] == 3
+
+    # query khác -> khoá khác, phải chấm lại
+    stage.rerank("viêm gan b", hits)
+    assert len(scorer.seen) == 6
+    assert stage.snapshot()["size"] == 6
+
+
+def test_merged_window_has_its_own_cache_key():
+    assert _hit_key({"id": 3}) == "3"
+    assert _hit_key({"id": 3, "ids": [3, 4]}) == "3,4"
+    assert _hit_key({"id": 3, "ids": []}) == "3"
+
+    scorer = _Scorer()
+    stage = RerankStage(scorer, budget_ms=0)
+    single = [{"id": 3, "text": "a", "s": 0.2}, {"id": 9, "text": "b", "s": 0.4}]
+    merged = [{"id": 3, "ids": [3, 4], "text": "a c", "s": 0.8}, {"id": 9, "text": "b", "s": 0.4}]
+    stage.rerank("q", single)
+    out, _ = stage.rerank("q", merged)
+    # cửa sổ ghép 3+4 không dùng điểm của chunk 3 đơn lẻ
+    assert scorer.seen == ["3", "9", "3,4"]
+    assert out[0]["id"] == 3
+
+
+def test_fewer_than_two_candidates_pass_through():
+    scorer = _Scorer()
+    stage = RerankStage(scorer, budget_ms=0)
+    for hits in ([], _hits(0.3)):
+        out, info = stage.rerank("q", hits)
+        assert out is hits and info["fallback"] is None
+        out, info = asyncio.run(stage.arerank("q", hits))
+        assert out is hits and info["fallback"] is None
+    assert scorer.seen == []